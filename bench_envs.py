@@ -0,0 +1,273 @@
+"""Throughput benchmark of the env stack: env steps/sec and per-step latency percentiles of a single
+`VizDoomCustom` and of the vectorized envs (through `DoomInteractor`, every backend), over a sweep of
+configurations. Results are written as JSON, and two result files can be compared for regressions.
+
+    python bench_envs.py --targets single vector --num-envs 8 32 --screen-formats RGB24 GRAY8 --output base.json
+    # ... change the env stack ...
+    python bench_envs.py --targets single vector --num-envs 8 32 --screen-formats RGB24 GRAY8 --output new.json
+    python bench_envs.py --compare base.json new.json --threshold 0.05  # exits with 1 if anything regressed
+
+With `--repeats` > 1 the whole sweep is run that many times round-robin and every configuration reports its
+median round, so a noisy machine slows all of them down alike instead of whichever ran at the wrong moment.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import itertools
+import subprocess
+import tempfile
+from argparse import ArgumentParser, ArgumentTypeError
+
+import numpy as np
+import vizdoom
+import torch
+
+from custom_doom import VizDoomCustom, SCREEN_FORMATS
+from interactor import DoomInteractor
+from env_worker import ResetPoolSpec
+
+ENV_ID = "VizdoomCustom-v0"
+TARGETS = ("single", "vector")
+BACKENDS = ("serial", "thread", "subproc")
+
+# what a configuration is identified by when comparing results
+CONFIG_KEYS = ("target", "backend", "num_envs", "screen_format", "screen_resolution", "frame_skip", "rewards", "record", "reset_pool")
+
+
+def on_off(value: str) -> bool:
+    if value not in ("on", "off"):
+        raise ArgumentTypeError(f"expected on or off, got {value}")
+    return value == "on"
+
+
+def sweep(args) -> list:
+    """Every configuration of the sweep. The single env has no backend, env count, recording or reset pool,
+    so those dimensions collapse for it.
+    """
+
+    configs = []
+    for target, backend, num_envs, screen_format, screen_resolution, frame_skip, rewards, record, reset_pool in itertools.product(
+        args.targets, args.backends, args.num_envs, args.screen_formats, args.screen_resolutions, args.frame_skips,
+        args.rewards, args.record, args.reset_pools,
+    ):
+        if target == "single":
+            backend, num_envs, record, reset_pool = None, 1, False, 0
+        config = {
+            "target": target, "backend": backend, "num_envs": num_envs, "screen_format": screen_format,
+            "screen_resolution": None if screen_resolution == "default" else screen_resolution,
+            "frame_skip": frame_skip, "rewards": rewards, "record": record, "reset_pool": reset_pool,
+        }
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def config_name(config: dict) -> str:
+    # results from before a dimension existed ran with its default
+    defaults = {"reset_pool": 0}
+    return " ".join(f"{key}={config.get(key, defaults.get(key))}" for key in CONFIG_KEYS)
+
+
+def time_single(config: dict, num_steps: int, warmup: int, rng: np.random.Generator) -> np.ndarray:
+    """Seconds per `VizDoomCustom.step` (the resets after episode ends count towards the step that ended it)."""
+
+    env = VizDoomCustom(
+        compute_reward=config["rewards"], frame_skip=config["frame_skip"],
+        screen_format=config["screen_format"], screen_resolution=config["screen_resolution"],
+    )
+    try:
+        num_actions = env.action_space.n
+        env.reset()
+
+        latencies = np.empty(num_steps)
+        for i in range(-warmup, num_steps):
+            action = rng.integers(num_actions)
+            start = time.perf_counter()
+            _, _, terminated, truncated, _ = env.step(action)
+            if terminated or truncated:
+                env.reset()
+            if i >= 0:
+                latencies[i] = time.perf_counter() - start
+        return latencies
+    finally:
+        env.close()
+
+
+def time_vector(config: dict, num_steps: int, warmup: int, rng: np.random.Generator, num_workers: int = None) -> np.ndarray:
+    """Seconds per vectorized `DoomInteractor.step` over all of the config's envs."""
+
+    with tempfile.TemporaryDirectory() as record_path:
+        interactor = DoomInteractor(
+            config["num_envs"], env_id=ENV_ID, backend=config["backend"], num_workers=num_workers,
+            frame_skip=config["frame_skip"], screen_format=config["screen_format"],
+            screen_resolution=config["screen_resolution"], record_path=record_path if config["record"] else None,
+            reset_pool=ResetPoolSpec(size=config["reset_pool"]) if config["reset_pool"] > 0 else None,
+        )
+        try:
+            if not config["rewards"]:
+                # the envs still hand back their game variables, only the batched reward pass is skipped
+                interactor.env.reward_engine = None
+
+            num_actions = interactor.single_action_space.n
+            interactor.reset()
+
+            latencies = np.empty(num_steps)
+            for i in range(-warmup, num_steps):
+                actions = rng.integers(num_actions, size=config["num_envs"])
+                start = time.perf_counter()
+                interactor.step(actions)
+                if i >= 0:
+                    latencies[i] = time.perf_counter() - start
+            return latencies
+        finally:
+            interactor.close()
+
+
+def summarize(config: dict, latencies: np.ndarray) -> dict:
+    steps_per_sec = config["num_envs"] * len(latencies) / latencies.sum()
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return {
+        "env_steps_per_sec": steps_per_sec,
+        "tics_per_sec": steps_per_sec * config["frame_skip"],
+        "step_p50_ms": p50,
+        "step_p90_ms": p90,
+        "step_p99_ms": p99,
+    }
+
+
+def machine_info() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "hostname": socket.gethostname(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "vizdoom": vizdoom.__version__,
+        "torch": torch.__version__,
+        "git_commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run(args) -> dict:
+    configs = sweep(args)
+    rng = np.random.default_rng(args.seed)
+    rounds = [[] for _ in configs]
+
+    for repeat in range(args.repeats):
+        for i, config in enumerate(configs):
+            if config["target"] == "single":
+                latencies = time_single(config, args.steps, args.warmup, rng)
+            else:
+                latencies = time_vector(config, args.steps, args.warmup, rng, num_workers=args.num_workers)
+            rounds[i].append(summarize(config, latencies))
+
+            stats = rounds[i][-1]
+            print(
+                f"[{repeat + 1}/{args.repeats}] {config_name(config)}: {stats['env_steps_per_sec']:.1f} steps/s,"
+                f" p50 {stats['step_p50_ms']:.3f} ms, p99 {stats['step_p99_ms']:.3f} ms", flush=True,
+            )
+
+    results = []
+    for config, config_rounds in zip(configs, rounds):
+        # the median round by throughput, so its latencies belong to the same run
+        median_round = sorted(config_rounds, key=lambda stats: stats["env_steps_per_sec"])[len(config_rounds) // 2]
+        results.append({"config": config, **median_round, "rounds": config_rounds})
+
+    return {
+        "machine": machine_info(),
+        "settings": {"steps": args.steps, "warmup": args.warmup, "repeats": args.repeats, "num_workers": args.num_workers, "seed": args.seed},
+        "results": results,
+    }
+
+
+def compare(base: dict, new: dict, threshold: float) -> list:
+    """(config, metric, base value, new value, relative change) of every shared configuration whose throughput
+    dropped, or whose p50/p99 step latency rose, by more than `threshold` (a fraction).
+    """
+
+    base_results = {config_name(result["config"]): result for result in base["results"]}
+    regressions = []
+    for result in new["results"]:
+        name = config_name(result["config"])
+        if name not in base_results:
+            continue
+
+        base_result = base_results[name]
+        for metric, higher_is_better in (("env_steps_per_sec", True), ("step_p50_ms", False), ("step_p99_ms", False)):
+            change = result[metric] / base_result[metric] - 1
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                regressions.append((name, metric, base_result[metric], result[metric], change))
+    return regressions
+
+
+def print_comparison(base: dict, new: dict, threshold: float) -> bool:
+    """Prints the per-configuration throughput change and the regressions, returns whether there were any."""
+
+    base_results = {config_name(result["config"]): result for result in base["results"]}
+    for key in ("git_commit", "hostname", "cpu_count"):
+        if base["machine"].get(key) != new["machine"].get(key):
+            print(f"note: {key} differs ({base['machine'].get(key)} -> {new['machine'].get(key)})")
+
+    print(f"{'base sps':>10} {'new sps':>10} {'change':>8}  config")
+    for result in new["results"]:
+        name = config_name(result["config"])
+        if name not in base_results:
+            print(f"{'-':>10} {result['env_steps_per_sec']:>10.1f} {'new':>8}  {name}")
+            continue
+        base_sps, new_sps = base_results[name]["env_steps_per_sec"], result["env_steps_per_sec"]
+        print(f"{base_sps:>10.1f} {new_sps:>10.1f} {new_sps / base_sps - 1:>+8.1%}  {name}")
+
+    regressions = compare(base, new, threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {threshold:.0%}:")
+        for name, metric, base_value, new_value, change in regressions:
+            print(f"  {metric}: {base_value:.3f} -> {new_value:.3f} ({change:+.1%})  {name}")
+    else:
+        print(f"\nno regressions beyond {threshold:.0%}")
+    return bool(regressions)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), default=None, help="Compare two result files instead of running the benchmark.")
+    parser.add_argument("--threshold", type=float, default=0.05, help="Relative change that counts as a regression in --compare mode.")
+    parser.add_argument("--output", type=str, default="bench_envs.json", help="Where the JSON results go.")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS), help="A single VizDoomCustom, and/or the vectorized envs.")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=["serial", "thread"], help="Vectorized env backends.")
+    parser.add_argument("--num-envs", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--num-workers", type=int, default=None, help="Threads/processes of the thread and subproc backends (defaults to the cpu count).")
+    parser.add_argument("--screen-formats", nargs="+", choices=SCREEN_FORMATS, default=["RGB24"])
+    parser.add_argument("--screen-resolutions", nargs="+", default=["default"], help="e.g. 160X120, 'default' is the scenario's.")
+    parser.add_argument("--frame-skips", type=int, nargs="+", default=[1])
+    parser.add_argument("--rewards", nargs="+", type=on_off, default=[True], metavar="{on,off}", help="Reward computation on and/or off.")
+    parser.add_argument("--record", nargs="+", type=on_off, default=[False], metavar="{on,off}", help="Trajectory recording on and/or off (vectorized envs only).")
+    parser.add_argument("--reset-pools", type=int, nargs="+", default=[0], help="Spare games per env process of the fast-reset mode (vectorized envs only), 0 is off.")
+    parser.add_argument("--steps", type=int, default=200, help="Timed steps per configuration.")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed steps before those.")
+    parser.add_argument("--repeats", type=int, default=1, help="Rounds over the whole sweep, the median round is reported.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        sys.exit(1 if print_comparison(base, new, args.threshold) else 0)
+
+    results = run(args)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {len(results['results'])} results to {args.output}")
@@ -0,0 +1,80 @@
+"""Compares acting with `Agent.forward` (autograd, distribution objects) against the `InferenceEngine`
+backends, per batch size.
+
+    python bench_inference.py --obs-shape 3 120 160 --batch-sizes 1 8 64 256
+
+The candidates are timed round-robin, one call each at a time, so a noisy machine slows all of them
+down alike instead of whichever happened to run at the wrong moment.
+"""
+
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from inference import BACKENDS, InferenceEngine
+from train_doom import Agent
+
+
+def time_candidates(candidates: dict, observations: torch.Tensor, hidden_state: torch.Tensor, num_calls: int) -> dict:
+    """{name: seconds per call} of every `act(observations, hidden_state)` in `candidates`, `num_calls` calls each."""
+
+    # warmup, this is also when torch.compile specializes on the batch size
+    for act in candidates.values():
+        for _ in range(3):
+            act(observations, hidden_state)
+
+    times = {name: np.empty(num_calls) for name in candidates}
+    for i in range(num_calls):
+        for name, act in candidates.items():
+            start = time.perf_counter()
+            act(observations, hidden_state)
+            times[name][i] = time.perf_counter() - start
+    return times
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--obs-shape", type=int, nargs="+", default=[3, 120, 160], help="Single observation shape, CHW or HWC.")
+    parser.add_argument("--num-actions", type=int, default=7)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--channels-last", action="store_true", default=False, help="Also time every backend with channels_last weights and inputs.")
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--num-threads", type=int, default=None, help="torch intra-op threads (defaults to torch's).")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    agent = Agent(obs_shape=tuple(args.obs_shape), num_discrete_actions=args.num_actions)
+
+    def agent_act(observations, hidden_state):
+        # what the training loop does: a given hidden state, forward with autograd on
+        agent.hidden_state = hidden_state
+        return agent.forward(observations.float())
+
+    candidates = {"agent.forward": agent_act}
+    for backend in args.backends:
+        for channels_last in [False, True] if args.channels_last else [False]:
+            name = f"{backend}+cl" if channels_last else backend
+            try:
+                candidates[name] = InferenceEngine(agent, backend=backend, channels_last=channels_last).act
+            except Exception as e:
+                print(f"skipping {name}: {e}")
+
+    print(f"{'batch':>6} {'path':>14} {'median ms':>10} {'p90 ms':>8} {'obs/s':>10} {'speedup':>8}  (threads={torch.get_num_threads()})")
+
+    for batch_size in args.batch_sizes:
+        observations = torch.randint(0, 255, (batch_size, *args.obs_shape), dtype=torch.uint8)
+        hidden_state = torch.zeros(batch_size, agent.embedding_size)
+
+        times = time_candidates(candidates, observations, hidden_state, args.calls)
+        baseline = np.median(times["agent.forward"])
+        for name, call_times in times.items():
+            median = np.median(call_times)
+            print(
+                f"{batch_size:>6} {name:>14} {median * 1000:>10.3f} {np.percentile(call_times, 90) * 1000:>8.3f}"
+                f" {batch_size / median:>10.1f} {baseline / median:>7.2f}x"
+            )
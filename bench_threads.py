@@ -0,0 +1,53 @@
+"""Compares the serial and threaded stepping modes of VizDoomVectorized.
+
+    python bench_threads.py --env-id VizdoomCustom-v0 --steps 200
+"""
+
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from interactor import VizDoomVectorized
+
+
+def time_steps(vec_env: VizDoomVectorized, num_steps: int, seed: int = 0) -> float:
+    """Returns env steps per second (summed over all envs) for `num_steps` vectorized steps."""
+
+    rng = np.random.default_rng(seed)
+    num_actions = vec_env.single_action_space.n
+    vec_env.reset()
+
+    # warmup so the first tics of every map don't skew things
+    for _ in range(5):
+        vec_env.step(rng.integers(0, num_actions, size=vec_env.num_envs))
+
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        vec_env.step(rng.integers(0, num_actions, size=vec_env.num_envs))
+    elapsed = time.perf_counter() - start
+
+    return num_steps * vec_env.num_envs / elapsed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--env-id", default="VizdoomCustom-v0")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--num-threads", type=int, default=os.cpu_count())
+    parser.add_argument("--num-envs", type=int, nargs="+", default=[8, 16, 32, 64])
+    args = parser.parse_args()
+
+    print(f"{'envs':>6} {'serial sps':>12} {'thread sps':>12} {'speedup':>8}  (threads={args.num_threads})")
+
+    for num_envs in args.num_envs:
+        serial = VizDoomVectorized(num_envs, env_id=args.env_id)
+        serial_sps = time_steps(serial, args.steps)
+        serial.close()
+
+        threaded = VizDoomVectorized(num_envs, env_id=args.env_id, num_threads=args.num_threads)
+        threaded_sps = time_steps(threaded, args.steps)
+        threaded.close()
+
+        print(f"{num_envs:>6} {serial_sps:>12.1f} {threaded_sps:>12.1f} {threaded_sps / serial_sps:>7.2f}x")
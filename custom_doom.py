@@ -1,11 +1,13 @@
 import gymnasium
 import os
+import hashlib
+import tempfile
 import vizdoom as vzd
-import cv2
 from gymnasium.envs.registration import register
 from vizdoom.gymnasium_wrapper import gymnasium_env_defns
 import numpy as np
-from copy import deepcopy
+
+from profiler import profiler
 
 # Register the custom scenario
 # scenario_file = os.path.join(os.path.dirname(__file__), "scenarios", "oblige_custom.cfg")
@@ -16,139 +18,391 @@ register(
     kwargs={"scenario_file": scenario_file},
 )
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+import json
 
 
 def symlog(x):
     return np.sign(x) * np.log(1 + np.abs(x))
 
-@dataclass
+# https://vizdoom.farama.org/api/python/enums/#vizdoom.GameVariable
+# the fixed column layout of every reward feature record (and of the deltas between them)
+REWARD_FEATURES = (
+    vzd.GameVariable.KILLCOUNT,
+    vzd.GameVariable.ITEMCOUNT,
+    vzd.GameVariable.SECRETCOUNT,
+    vzd.GameVariable.FRAGCOUNT,
+    vzd.GameVariable.DEATHCOUNT,
+    vzd.GameVariable.HITCOUNT,
+    vzd.GameVariable.HITS_TAKEN,
+    vzd.GameVariable.DAMAGECOUNT,
+    vzd.GameVariable.DAMAGE_TAKEN,
+    vzd.GameVariable.HEALTH,
+    vzd.GameVariable.ARMOR,
+    vzd.GameVariable.DEAD,
+    vzd.GameVariable.SELECTED_WEAPON_AMMO,
+    vzd.GameVariable.SELECTED_WEAPON,
+    vzd.GameVariable.POSITION_X,
+    vzd.GameVariable.POSITION_Y,
+    vzd.GameVariable.POSITION_Z,
+)
+FEATURE_NAMES = tuple(variable.name for variable in REWARD_FEATURES)
+FEATURE_INDEX = {name: i for i, name in enumerate(FEATURE_NAMES)}
+POSITION_COLUMNS = [FEATURE_INDEX["POSITION_X"], FEATURE_INDEX["POSITION_Y"]]
+
+
 class VizDoomRewardFeatures:
-    # https://vizdoom.farama.org/api/python/enums/#vizdoom.GameVariable
-
-    KILLCOUNT: int
-    ITEMCOUNT: int
-    SECRETCOUNT: int
-    FRAGCOUNT: int
-    DEATHCOUNT: int
-    HITCOUNT: int
-    HITS_TAKEN: int
-    DAMAGECOUNT: int
-    DAMAGE_TAKEN: int
-    HEALTH: int
-    ARMOR: int
-    DEAD: int
-    SELECTED_WEAPON_AMMO: int
-    SELECTED_WEAPON: int
-    POSITION_X: int
-    POSITION_Y: int
-    POSITION_Z: int
-
-    TRAVELED_BOX: "TraveledBox"
+    """Snapshot of the game variables the reward is built from, stored as one float32 vector laid
+    out like `REWARD_FEATURES`. Fields are readable by name (`features.KILLCOUNT`), and deltas
+    between two snapshots are a single array subtraction.
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self, values: np.ndarray = None):
+        self.values = np.zeros(len(REWARD_FEATURES), dtype=np.float32) if values is None else values
 
     @classmethod
-    def make_from_game(cls, game, traveled_box):
-        # https://vizdoom.farama.org/api/python/enums/#vizdoom.GameVariable
+    def make_from_game(cls, game):
+        features = cls()
+        features.read_from_game(game)
+        return features
+
+    def read_from_game(self, game, gamevariables: np.ndarray = None, columns: np.ndarray = None):
+        """Fills this record in place. If the state's game variable vector is given (`columns` maps
+        it to our layout) it's a single gather, otherwise every variable is queried from the game.
+        """
+
+        if gamevariables is not None:
+            np.take(gamevariables, columns, out=self.values)
+            return
 
-        return cls(
-            KILLCOUNT=game.get_game_variable(vzd.GameVariable.KILLCOUNT),
-            ITEMCOUNT=game.get_game_variable(vzd.GameVariable.ITEMCOUNT),
-            SECRETCOUNT=game.get_game_variable(vzd.GameVariable.SECRETCOUNT),
-            FRAGCOUNT=game.get_game_variable(vzd.GameVariable.FRAGCOUNT),
-            DEATHCOUNT=game.get_game_variable(vzd.GameVariable.DEATHCOUNT),
-            HITCOUNT=game.get_game_variable(vzd.GameVariable.HITCOUNT),
-            HITS_TAKEN=game.get_game_variable(vzd.GameVariable.HITS_TAKEN),
-            DAMAGECOUNT=game.get_game_variable(vzd.GameVariable.DAMAGECOUNT),
-            DAMAGE_TAKEN=game.get_game_variable(vzd.GameVariable.DAMAGE_TAKEN),
-            HEALTH=game.get_game_variable(vzd.GameVariable.HEALTH),
-            ARMOR=game.get_game_variable(vzd.GameVariable.ARMOR),
-            DEAD=game.get_game_variable(vzd.GameVariable.DEAD),
-            SELECTED_WEAPON_AMMO=game.get_game_variable(vzd.GameVariable.SELECTED_WEAPON_AMMO),
-            SELECTED_WEAPON=game.get_game_variable(vzd.GameVariable.SELECTED_WEAPON),
-            POSITION_X=game.get_game_variable(vzd.GameVariable.POSITION_X),
-            POSITION_Y=game.get_game_variable(vzd.GameVariable.POSITION_Y),
-            POSITION_Z=game.get_game_variable(vzd.GameVariable.POSITION_Z),
-            TRAVELED_BOX=deepcopy(traveled_box),  # TODO: probably a better way to do this?
-        )
+        for i, variable in enumerate(REWARD_FEATURES):
+            self.values[i] = game.get_game_variable(variable)
 
     def get_deltas(self, other: "VizDoomRewardFeatures") -> "VizDoomRewardFeatures":
-        # loop through all our fields and subtract the other fields from them
-        field_names = self.__annotations__.keys()
-        return VizDoomRewardFeatures(
-            **{field: getattr(self, field) - getattr(other, field) for field in field_names}
-        )
+        return VizDoomRewardFeatures(self.values - other.values)
     
     def get_summary(self) -> str:
         # new line for every field
         summary = "-" * 20 + "\n"
-        summary += "\n".join([f"{field}: {getattr(self, field)}" for field in self.__annotations__.keys()])
+        summary += "\n".join([f"{field}: {value}" for field, value in zip(FEATURE_NAMES, self.values)])
         return summary
-    
+
+
+def _make_feature_property(i: int):
+    return property(lambda self: self.values[i])
+
+
+for _i, _name in enumerate(FEATURE_NAMES):
+    setattr(VizDoomRewardFeatures, _name, _make_feature_property(_i))
+
+
+DEFAULT_WEIGHTS = {
+    "KILLCOUNT": 1000,
+    "ITEMCOUNT": 10,
+    "SECRETCOUNT": 3000,
+    # "HITCOUNT": 100,
+    "DAMAGECOUNT": 10,
+    "HEALTH": 10,
+    "ARMOR": 10,
+    # 10x negative reward to DAMAGE_TAKEN
+    "DAMAGE_TAKEN": -10,
+    # decrement reward for dying
+    "DEAD": -100,
+}
+
 
 @dataclass
-class TraveledBox:
-    """Tracks the volume of coverage in the map the player has traveled. Grows as the player moves around the map.
-    Used for calculating deltas to view the amount of new map the player has explored.
+class RewardSpec:
+    """Declarative description of the custom reward. Everything is in terms of the per-step
+    game variable deltas (see `custom_doom.REWARD_FEATURES`).
+
+    - `weights`: linear weight per feature name, `reward += deltas.X * weight`.
+    - weapon switch rule: if SELECTED_WEAPON changed, give `weapon_switch_bonus` and ignore the ammo change
+      (SELECTED_WEAPON_AMMO jumps around when picking up a better weapon).
+    - ammo penalty rule: otherwise, `reward += deltas.SELECTED_WEAPON_AMMO * ammo_weight` unless any of
+      `landed_shot_features` changed (we hit or killed something with that shot).
+    - `exploration_weight`: reward per map cell visited for the first time this episode (see `CoverageGrid`).
     """
 
-    min_x: int = None
-    max_x: int = None
-    min_y: int = None
-    max_y: int = None
-    min_z: int = None
-    max_z: int = None
+    weights: dict = field(default_factory=lambda: dict(DEFAULT_WEIGHTS))
+    weapon_switch_bonus: float = 1000
+    ammo_weight: float = 30
+    landed_shot_features: tuple = ("KILLCOUNT", "HITCOUNT")
+    exploration_weight: float = 10.0
 
-    @property
-    def is_initialized(self):
-        return self.min_x is not None
-
-    def update(self, x, y, z):
-        if not self.is_initialized:
-            self.min_x = x
-            self.max_x = x
-            self.min_y = y
-            self.max_y = y
-            self.min_z = z
-            self.max_z = z
+    @classmethod
+    def from_dict(cls, spec: dict) -> "RewardSpec":
+        unknown = set(spec) - set(cls.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"Unknown reward spec keys: {sorted(unknown)}")
+        spec = dict(spec)
+        if "landed_shot_features" in spec:
+            spec["landed_shot_features"] = tuple(spec["landed_shot_features"])
+        return cls(**spec)
+
+    @classmethod
+    def from_json(cls, path: str) -> "RewardSpec":
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+class RewardEngine:
+    """Computes the custom reward for a whole batch of envs at once from their stacked deltas."""
+
+    def __init__(self, spec: RewardSpec = None):
+        self.spec = RewardSpec() if spec is None else spec
+
+        unknown = [name for name in [*self.spec.weights, *self.spec.landed_shot_features] if name not in FEATURE_INDEX]
+        if unknown:
+            raise ValueError(f"Unknown reward features {unknown}, expected names from {FEATURE_NAMES}")
+
+        self.weights = np.zeros(len(FEATURE_NAMES), dtype=np.float32)
+        for name, weight in self.spec.weights.items():
+            self.weights[FEATURE_INDEX[name]] = weight
+
+        self._weapon_column = FEATURE_INDEX["SELECTED_WEAPON"]
+        self._ammo_column = FEATURE_INDEX["SELECTED_WEAPON_AMMO"]
+        self._landed_columns = [FEATURE_INDEX[name] for name in self.spec.landed_shot_features]
+
+    def compute(self, deltas: np.ndarray, exploration: np.ndarray = None, out: np.ndarray = None) -> np.ndarray:
+        """`deltas` is (N, F) laid out like `custom_doom.REWARD_FEATURES`, `exploration` is the (N,) new cell counts.
+        Returns (N,) float32 rewards, written into `out` if given.
+        """
+
+        rewards = np.matmul(deltas, self.weights, out=out)
+
+        # weapon switch / ammo penalty rules
+        switched_weapon = deltas[:, self._weapon_column] != 0
+        landed_shot = (deltas[:, self._landed_columns] != 0).any(axis=1)
+        ammo_term = np.where(landed_shot, 0, deltas[:, self._ammo_column] * self.spec.ammo_weight)
+        rewards += np.where(switched_weapon, self.spec.weapon_switch_bonus, ammo_term).astype(np.float32)
+
+        if exploration is not None:
+            rewards += exploration * self.spec.exploration_weight
+
+        return rewards
+
+
+class CoverageGrid:
+    """Tracks which cells of the map each env has visited this episode, over (POSITION_X, POSITION_Y).
+    Used for the exploration reward: the number of cells an env saw for the first time this step.
+
+    Cells are `cell_size` map units wide and hashed into a fixed table of `num_buckets` slots per env,
+    so memory stays bounded (num_envs * num_buckets bytes) no matter how big the map is. Collisions
+    just make a far away cell look visited already, which is rare at the default sizes.
+
+    Every slot stores the (uint8) episode stamp it was last visited in, so resetting an env is a
+    counter increment instead of clearing its table (the table is only cleared when the stamp wraps).
+    """
+
+    def __init__(self, num_envs: int = 1, cell_size: float = 64.0, num_buckets: int = 1 << 16):
+        assert num_buckets & (num_buckets - 1) == 0, f"num_buckets should be a power of 2, got {num_buckets}"
+
+        self.num_envs = num_envs
+        self.cell_size = cell_size
+        self.num_buckets = num_buckets
+        self.stamps = np.zeros((num_envs, num_buckets), dtype=np.uint8)
+        self.episode_stamps = np.ones(num_envs, dtype=np.uint8)  # 0 means never visited
+        self.visited_counts = np.zeros(num_envs, dtype=np.int64)
+        self._env_indices = np.arange(num_envs)
+
+    def _buckets(self, positions: np.ndarray) -> np.ndarray:
+        cells = np.floor(positions / self.cell_size).astype(np.int64)
+        # spatial hash from Teschner et al. "Optimized Spatial Hashing for Collision Detection of Deformable Objects"
+        hashed = (cells[:, 0] * 73856093) ^ (cells[:, 1] * 19349663)
+        return hashed & (self.num_buckets - 1)
+
+    def update(self, positions: np.ndarray, rows: slice = slice(None)) -> np.ndarray:
+        """Marks the cells at `positions` (N, 2) as visited for the envs in `rows`.
+        Returns the number of new cells per env (0 or 1) as float32.
+        """
+
+        env_indices = self._env_indices[rows]
+        buckets = self._buckets(positions)
+        episode_stamps = self.episode_stamps[env_indices]
+
+        new_cells = self.stamps[env_indices, buckets] != episode_stamps
+        self.stamps[env_indices, buckets] = episode_stamps
+        self.visited_counts[env_indices] += new_cells
+
+        return new_cells.astype(np.float32)
+
+    def reset(self, mask: np.ndarray = None, rows: slice = slice(None)):
+        """Starts a new episode for the envs in `rows` where `mask` is True (all of them if None)."""
+
+        env_indices = self._env_indices[rows]
+        if mask is not None:
+            env_indices = env_indices[mask]
+        if len(env_indices) == 0:
             return
 
-        self.min_x = min(self.min_x, x)
-        self.max_x = max(self.max_x, x)
-        self.min_y = min(self.min_y, y)
-        self.max_y = max(self.max_y, y)
-        self.min_z = min(self.min_z, z)
-        self.max_z = max(self.max_z, z)
-
-    def x_distance(self):
-        if not self.is_initialized:
-            return 0
-        return self.max_x - self.min_x
-
-    def y_distance(self):
-        if not self.is_initialized:
-            return 0
-        return self.max_y - self.min_y
-    
-    def z_distance(self):
-        if not self.is_initialized:
-            return 0
-        return self.max_z - self.min_z
-    
-    def average_distance(self):
-        return (self.x_distance() + self.y_distance() + self.z_distance()) / 3
-    
-    def __sub__(self, other):
-        # return the difference between average distances
-        return abs(self.average_distance() - other.average_distance())
+        self.episode_stamps[env_indices] += 1
+        self.visited_counts[env_indices] = 0
+
+        # the stamp wrapped around to "never visited", this is the only time the tables get cleared
+        wrapped = env_indices[self.episode_stamps[env_indices] == 0]
+        if len(wrapped) > 0:
+            self.stamps[wrapped] = 0
+            self.episode_stamps[wrapped] = 1
+
+
+# ViZDoom screen buffer formats the envs can hand out. RGB24 is (H, W, 3) like the stock gymnasium
+# wrapper, the others are channel-first: CRCGCB is (3, H, W) and GRAY8 is (1, H, W).
+SCREEN_FORMATS = ("RGB24", "CRCGCB", "GRAY8")
+CHANNEL_FIRST_FORMATS = ("CRCGCB", "GRAY8")
+
+
+def get_screen_resolution(screen_resolution: str) -> vzd.ScreenResolution:
+    """"160X120" (or "RES_160X120") -> vzd.ScreenResolution.RES_160X120"""
+
+    name = screen_resolution.upper()
+    if not name.startswith("RES_"):
+        name = f"RES_{name}"
+    if not hasattr(vzd.ScreenResolution, name):
+        raise ValueError(f"Unknown screen resolution: {screen_resolution}, expected one of vizdoom.ScreenResolution (e.g. 160X120)")
+    return getattr(vzd.ScreenResolution, name)
+
+
+# config keys holding paths, which ViZDoom resolves relative to the config file, absolute ones included (camel case works too)
+_CONFIG_PATH_KEYS = ("doomscenariopath", "doomgamepath", "doomconfigpath")
+
+_scenario_configs = {}  # (config, screen format, resolution) -> path of the derived config
+
+
+def scenario_config(config_path: str, screen_format: str = None, screen_resolution: str = None) -> str:
+    """A copy of the scenario config at `config_path` with the screen settings overridden, so the game boots
+    with them the first time instead of being initialized twice. The copy goes to the temp dir under a name
+    derived from its contents, so it's written once per machine and shared by every process.
+    """
+
+    key = (config_path, screen_format, screen_resolution)
+    if key in _scenario_configs:
+        return _scenario_configs[key]
+
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    derived_dir = tempfile.gettempdir()
+    lines = []
+    with open(config_path) as f:
+        for line in f:
+            name, separator, value = line.partition("=")
+            value = value.strip()
+            if separator and name.strip().replace("_", "").lower() in _CONFIG_PATH_KEYS and value and not os.path.isabs(value):
+                line = f"{name.strip()} = {os.path.relpath(os.path.join(config_dir, value), derived_dir)}\n"
+            lines.append(line.rstrip("\n"))
+
+    # later entries win
+    if screen_format is not None:
+        lines.append(f"screen_format = {screen_format}")
+    if screen_resolution is not None:
+        lines.append(f"screen_resolution = {get_screen_resolution(screen_resolution).name}")
+    text = "\n".join(lines) + "\n"
+
+    path = os.path.join(derived_dir, f"vizdoom-{hashlib.sha1(text.encode()).hexdigest()[:16]}.cfg")
+    if not os.path.exists(path):
+        # written next to it and renamed, other processes may be reading it already
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    _scenario_configs[key] = path
+    return path
+
+
+class ScreenFormatWrapper(gymnasium.ObservationWrapper):
+    """Hands out the screens of a stock ViZDoom env in `screen_format` (see `SCREEN_FORMATS`), the game booted
+    with it from a `scenario_config`. The channel-first formats are (C, H, W) views of the engine's buffer: the
+    stock env doesn't boot in CRCGCB, so those games run RGB24 and the copy into the step buffers (which happens
+    either way) does the layout change, GRAY8 (1, H, W) screens are the engine's buffer as is.
+    """
+
+    def __init__(self, env, screen_format: str):
+        super().__init__(env)
+        self.screen_format = screen_format
+        self.channel_first = screen_format in CHANNEL_FIRST_FORMATS
+
+        if self.channel_first:
+            spaces = dict(env.observation_space.spaces)
+            height, width, channels = spaces["screen"].shape
+            spaces["screen"] = gymnasium.spaces.Box(0, 255, (channels, height, width), dtype=spaces["screen"].dtype)
+            self.observation_space = gymnasium.spaces.Dict(spaces)
+
+    def observation(self, observation: dict) -> dict:
+        if self.channel_first:
+            observation["screen"] = observation["screen"].transpose(2, 0, 1)
+        return observation
+
+    def state_observation(self, state) -> dict:
+        """The observation of a game `state` (e.g. right after a `game.load`), as `step`/`reset` would give it."""
+
+        buffers = {"screen": state.screen_buffer, "depth": state.depth_buffer, "labels": state.labels_buffer, "automap": state.automap_buffer}
+        observation = {}
+        for key, space in self.env.observation_space.spaces.items():
+            if key == "gamevariables":
+                observation[key] = state.game_variables.astype(np.float32)
+            else:
+                # the stock env gives the single channel buffers a trailing axis
+                observation[key] = buffers[key].reshape(space.shape)
+        return self.observation(observation)
+
+
+def make_doom_env(env_id: str, frame_skip: int = 1, screen_format: str = "RGB24", screen_resolution: str = None):
+    """`gymnasium.make` for any registered ViZDoom scenario env id, with a configurable `screen_format` and
+    `screen_resolution` (e.g. "160X120", None keeps the scenario's), see `ScreenFormatWrapper`.
+    """
+
+    if screen_format not in SCREEN_FORMATS:
+        raise ValueError(f"Unknown screen format: {screen_format}, expected one of {SCREEN_FORMATS}")
+
+    spec = gymnasium.spec(env_id)
+    config_path = os.path.join(gymnasium_env_defns.scenarios_path, spec.kwargs["scenario_file"])
+    # the stock env forces anything but RGB24 and GRAY8 to RGB24 before booting
+    config_format = "RGB24" if screen_format == "CRCGCB" else screen_format
+    env = gymnasium.make(
+        spec, scenario_file=scenario_config(config_path, config_format, screen_resolution), frame_skip=frame_skip,
+    )
+    return ScreenFormatWrapper(env, screen_format)
+
 
 class VizDoomCustom:
-    def __init__(self, verbose: bool = False):
-        self.env = gymnasium.make("VizdoomCustom-v0")
-        self.game = self.env.env.env.game
-        self._prev_reward_features = None
-        self._current_reward_features = None
+    def __init__(
+        self, verbose: bool = False, reward_spec: RewardSpec = None, compute_reward: bool = True, frame_skip: int = 1,
+        screen_format: str = "RGB24", screen_resolution: str = None,
+    ):
+        """If `compute_reward` is False, `step` returns a reward of 0 and leaves it to the caller to run
+        the reward engine over `info["deltas"]` and its own `CoverageGrid` over the positions in `info["features"]`
+        (batched across envs).
+
+        `frame_skip` repeats every action for that many tics with ViZDoom's multi-tic `make_action`,
+        which only renders the last one. The engine only refreshes game variables together with the
+        (rendered) state, so the deltas span the whole repeat: the linear reward terms add up exactly,
+        a death anywhere in the repeat ends the episode and shows up in DEAD/DEATHCOUNT, and a weapon
+        switch anywhere in the repeat earns the switch bonus and voids the repeat's ammo delta.
+
+        `screen_format` and `screen_resolution` pick the screen buffer, see `ScreenFormatWrapper`.
+        """
+
+        self.env = make_doom_env("VizdoomCustom-v0", frame_skip=frame_skip, screen_format=screen_format, screen_resolution=screen_resolution)
+        self.game = self.env.unwrapped.game
+        self.frame_skip = frame_skip
         self.verbose = verbose
-        self.traveled_box = TraveledBox()
+        self.compute_reward = compute_reward
+        self.reward_engine = RewardEngine(reward_spec)
+        self.coverage = CoverageGrid(num_envs=1)
+
+        # two preallocated records, swapped every step instead of building new ones
+        self._prev_reward_features = VizDoomRewardFeatures()
+        self._current_reward_features = VizDoomRewardFeatures()
+        self._initial_reward_features = VizDoomRewardFeatures()
+
+        # where each reward feature sits in the state's game variable vector. if the scenario
+        # doesn't expose all of them we fall back to querying the game one variable at a time
+        available = self.game.get_available_game_variables()
+        self._gamevariable_columns = None
+        if all(variable in available for variable in REWARD_FEATURES):
+            self._gamevariable_columns = np.array([available.index(variable) for variable in REWARD_FEATURES])
 
     @property
     def action_space(self):
@@ -160,26 +414,79 @@ class VizDoomCustom:
 
     def reset(self):
         observation, info = self.env.reset()
-        self._prev_reward_features = self._get_reward_features()
-        self._initial_reward_features = self._get_reward_features()
-        self.traveled_box = TraveledBox()
+        self._start_episode(observation)
         return observation, info
 
+    def save_state(self, path: str) -> bool:
+        """Saves the running game as a ViZDoom savegame at `path`, `load_state` starts episodes from it.
+
+        Saving runs the game 2 tics forward outside of any `step` (the next step's observation and deltas include
+        them). If those tics end the episode there is no usable savegame: nothing is left at `path` and this
+        returns False, the next `step` then reports the episode end.
+        """
+
+        self.game.save(path)
+        if self.game.is_episode_finished():
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+        return os.path.exists(path)
+
+    def load_state(self, path: str):
+        """Starts a new episode from a `save_state` snapshot (of any `VizDoomCustom` on the same map) instead of
+        the map start. Like `reset`, the reward baselines are read from the restored game and the coverage starts
+        over, so the first step's deltas are relative to the snapshot. Loading runs the game 2 tics forward too, if
+        that ends the restored episode (a snapshot right before the episode timeout) this is a plain `reset`.
+        """
+
+        if self.game.is_episode_finished():
+            # the engine doesn't load into a finished episode
+            self.game.new_episode()
+        self.game.load(path)
+        if self.game.is_episode_finished():
+            return self.reset()
+
+        # the gymnasium env only refreshes its state in `reset`/`step`
+        state = self.game.get_state()
+        self.env.unwrapped.state = state
+        observation = self.env.state_observation(state)
+        self._start_episode(observation)
+        return observation, {}
+
+    def _start_episode(self, observation: dict):
+        self._read_reward_features(self._current_reward_features, observation)
+        self._initial_reward_features.values[:] = self._current_reward_features.values
+        self.coverage.reset()
+
     def step(self, action):
         # Execute the action and observe the next state
-        observation, _, terminated, truncated, info = self.env.step(action)
-        self._current_reward_features = self._get_reward_features()
+        with profiler.scope("doom/simulate"):
+            observation, _, terminated, truncated, info = self.env.step(action)
+
+        # last step's features become the previous ones, then refill the other buffer in place
+        self._prev_reward_features, self._current_reward_features = self._current_reward_features, self._prev_reward_features
+        # there is no state on the terminal step (the observation is zeroed), so read from the game there
+        self._read_reward_features(self._current_reward_features, None if terminated else observation)
 
         # Calculate custom reward
-        reward, deltas = self._get_reward()
-        self._prev_reward_features = self._current_reward_features  # Update previous state
+        with profiler.scope("doom/reward"):
+            reward, deltas = self._get_reward()
 
         info["deltas"] = deltas
+        # the raw game variables after this step (laid out like `REWARD_FEATURES`), copied since the record gets reused
+        info["features"] = self._current_reward_features.values.copy()
+        info["position"] = info["features"][POSITION_COLUMNS]
 
         return observation, reward, terminated, truncated, info
 
-    def _get_reward_features(self) -> VizDoomRewardFeatures:
-        return VizDoomRewardFeatures.make_from_game(self.game, traveled_box=self.traveled_box)
+    def close(self):
+        self.env.close()
+
+    def _read_reward_features(self, features: VizDoomRewardFeatures, observation: dict = None):
+        gamevariables = None
+        if observation is not None and self._gamevariable_columns is not None:
+            gamevariables = observation.get("gamevariables")
+        features.read_from_game(self.game, gamevariables=gamevariables, columns=self._gamevariable_columns)
     
     def verbose_print(self, *args):
         if self.verbose:
@@ -188,55 +495,16 @@ class VizDoomCustom:
     def _get_reward(self):
         # https://vizdoom.farama.org/api/python/enums/#vizdoom.GameVariable
 
-        reward = 0
-
-        if self._prev_reward_features is None:
-            return reward
-        
-        # NOTE: must be before deltas are calculated
-        # give some reward for the distance traveled from spawn
-        # spawn_x, spawn_y, spawn_z = self._initial_reward_features.POSITION_X, self._initial_reward_features.POSITION_Y, self._initial_reward_features.POSITION_Z
-        # last_x, last_y, last_z = self._prev_reward_features.POSITION_X, self._prev_reward_features.POSITION_Y, self._prev_reward_features.POSITION_Z
-        current_x, current_y, current_z = self._current_reward_features.POSITION_X, self._current_reward_features.POSITION_Y, self._current_reward_features.POSITION_Z
-        self.traveled_box.update(current_x, current_y, current_z)
-
         # get deltas
         deltas = self._current_reward_features.get_deltas(self._prev_reward_features)
 
+        if not self.compute_reward:
+            # the vectorized env computes the rewards for all envs at once from the deltas
+            return 0.0, deltas
+
         # map exploration reward
-        # reward += deltas.TRAVELED_BOX
-        reward += 1 / (self.traveled_box.average_distance() + 1)
-
-        reward += deltas.KILLCOUNT * 1000
-        reward += deltas.ITEMCOUNT * 10
-        reward += deltas.SECRETCOUNT * 3000
-        # reward += deltas.HITCOUNT * 100
-        reward += deltas.DAMAGECOUNT * 10
-        reward += deltas.HEALTH * 10
-        reward += deltas.ARMOR * 10
-
-        # 10x negative reward to DAMAGE_TAKEN
-        reward -= deltas.DAMAGE_TAKEN * 10
-
-        # NOTE: this is buggy - goes negative when picking up a better weapon
-        # reward += deltas.SELECTED_WEAPON_AMMO * 10
-        # we need to use SELECTED_WEAPON to see if this value changed. if
-        # SELECTED_WEAPON is non-zero, then we know we picked up a new weapon, so
-        # any ammo decrease should be ignored.
-        if deltas.SELECTED_WEAPON != 0:
-            # if we changed weapons, ignore ammo change reward, but give a nice reward
-            reward += 1000
-        else:
-            # decrement reward for firing a weapon, unless we hit or killed an enemy
-            landed_shot = deltas.KILLCOUNT != 0 or deltas.HITCOUNT != 0
-            if not landed_shot:
-                reward += deltas.SELECTED_WEAPON_AMMO * 30
-
-        # decrement reward for taking damage (already covered in HEALTH and ARMOR)
-        # reward -= deltas.DAMAGE_TAKEN * 10
-
-        # decrement reward for dying
-        reward -= deltas.DEAD * 100
+        new_cells = self.coverage.update(self._current_reward_features.values[None, POSITION_COLUMNS])
+        reward = float(self.reward_engine.compute(deltas.values[None], new_cells)[0])
 
         if reward != 0:
             self.verbose_print(deltas.get_summary())
@@ -247,6 +515,8 @@ class VizDoomCustom:
 
 # Run an example game loop
 if __name__ == "__main__":
+    import cv2
+
     agent = VizDoomCustom()
 
     # Reset environment
@@ -0,0 +1,424 @@
+"""Per-env stepping helpers shared by every VizDoomVectorized backend.
+
+This module is also the entry point for the subprocess workers, so it should stay
+light: no torch, no wandb, just numpy and the env definitions.
+"""
+
+from dataclasses import dataclass, replace
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import numpy as np
+import cv2
+
+from shared_arrays import attach_shared_array
+from profiler import profiler
+from custom_doom import (
+    VizDoomCustom, RewardEngine, CoverageGrid, FEATURE_NAMES, POSITION_COLUMNS, CHANNEL_FIRST_FORMATS, make_doom_env,
+)
+
+
+def get_frame_skip(env_id: str, frame_skip: int | dict = None) -> int:
+    """Tics every agent action is repeated for in `env_id` (see `VizDoomCustom`). `frame_skip` is a number for
+    every env id or an {env_id: tics} mapping. Anything not set steps one tic per action: frame skipping changes
+    what the agent sees and when it acts, so it's always opted into.
+    """
+
+    if frame_skip is None:
+        return 1
+    if isinstance(frame_skip, dict):
+        return frame_skip.get(env_id, 1)
+    return frame_skip
+
+
+def uses_reward_features(env_id: str) -> bool:
+    return env_id == "VizdoomCustom-v0"
+
+
+def make_env(env_id: str, frame_skip: int = 1, screen_format: str = "RGB24", screen_resolution: str = None):
+    screen_kwargs = dict(screen_format=screen_format, screen_resolution=screen_resolution)
+    if uses_reward_features(env_id):
+        # the vectorized envs run the reward engine over all envs at once
+        return VizDoomCustom(compute_reward=False, frame_skip=frame_skip, **screen_kwargs)
+    return make_doom_env(env_id, frame_skip=frame_skip, **screen_kwargs)
+
+
+@dataclass
+class ResetPoolSpec:
+    """Settings of the fast-reset mode (see `ResetPool`).
+
+    - `size`: spare envs per process that are kept reset and ready, 0 turns the mode off.
+    - `snapshot_every`: mean number of steps between mid-episode snapshots of every env, 0 only ever
+      starts episodes at the map start. Snapshots need `VizDoomCustom` envs, and saving one costs about as
+      much as a reset, on the stepping path. It also runs the game 2 tics forward: the step a snapshot is
+      taken on covers `frame_skip` + 2 tics (its observation and deltas include them).
+    - `max_snapshots`: how many snapshots are kept (the oldest gets replaced).
+    - `restore_prob`: chance that a spare starts from a random snapshot instead of the map start.
+    """
+
+    size: int = 0
+    snapshot_every: int = 0
+    max_snapshots: int = 16
+    restore_prob: float = 0.5
+
+
+class ResetPool:
+    """Takes resets off the stepping path. Envs wrapped by `wrap` don't restart their game when they're
+    reset: they swap it for a spare that was already reset in the background, and the finished game is
+    handed to the pool's thread to become the next spare. If no spare is ready the env resets in place.
+
+    With `spec.snapshot_every`, the wrapped envs save their game (ViZDoom savegames) at random points of
+    their episodes and the pool starts some of the spares from those snapshots, for more varied starts.
+    Every game keeps its own reward baselines, which `reset`/`load_state` refresh from the game they start.
+    """
+
+    def __init__(self, env_id: str, env_kwargs: dict, spec: ResetPoolSpec, seed: int = None):
+        self.spec = spec
+        self.rng = np.random.default_rng(seed)
+        self.misses = 0  # resets that happened in place because no spare was ready
+
+        self.snapshot_dir = None
+        self.snapshots = []  # paths of the saved snapshots
+        self._num_saved = 0
+        self._lock = threading.Lock()  # the thread backend steps (and snapshots) envs from several threads
+        if spec.snapshot_every > 0:
+            if not uses_reward_features(env_id):
+                raise ValueError(f"Mid-episode snapshots need VizDoomCustom envs, got {env_id}")
+            self.snapshot_dir = tempfile.mkdtemp(prefix="doom-snapshots-")
+
+        self._ready = queue.Queue()  # (env, observation, info) of spares that started their episode
+        self._stale = queue.Queue()  # finished envs waiting to be reset
+        self.env_id = env_id
+        self.env_kwargs = env_kwargs
+
+        self._refill_rng = np.random.default_rng(self.rng.integers(1 << 32))
+        self._refiller = threading.Thread(target=self._refill, name="reset-pool", daemon=True)
+        self._refiller.start()
+
+    def wrap(self, env) -> "PooledEnv":
+        return PooledEnv(env, self)
+
+    def _refill(self):
+        # the spares boot here too, nothing needs them before the first episode ends
+        for _ in range(self.spec.size):
+            env = make_env(self.env_id, **self.env_kwargs)
+            self._ready.put((env, *env.reset()))
+
+        while True:
+            env = self._stale.get()
+            if env is None:
+                break
+
+            with profiler.scope("env/pool_reset"):
+                snapshots = list(self.snapshots)
+                if snapshots and self._refill_rng.random() < self.spec.restore_prob:
+                    observation, info = env.load_state(snapshots[self._refill_rng.integers(len(snapshots))])
+                else:
+                    observation, info = env.reset()
+            self._ready.put((env, observation, info))
+
+    def swap(self, env):
+        """A ready spare (env, observation, info) in exchange for `env`, None if there is none."""
+
+        try:
+            spare = self._ready.get_nowait()
+        except queue.Empty:
+            self.misses += 1
+            return None
+        self._stale.put(env)
+        return spare
+
+    def save_snapshot(self, env):
+        """Saves `env`'s game into the snapshot ring, skipped if the save's tics ended its episode."""
+
+        with self._lock:
+            path = os.path.join(self.snapshot_dir, f"{self._num_saved % self.spec.max_snapshots}.sav")
+            self._num_saved += 1
+
+        # saved next to it and renamed, so the pool thread never loads a half written file
+        if not env.save_state(path + ".tmp"):
+            return
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            if path not in self.snapshots:
+                self.snapshots.append(path)
+
+    def close(self):
+        self._stale.put(None)
+        self._refiller.join()
+        while not self._ready.empty():
+            self._ready.get_nowait()[0].close()
+        while not self._stale.empty():
+            env = self._stale.get_nowait()
+            if env is not None:
+                env.close()
+        if self.snapshot_dir is not None:
+            shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+
+class PooledEnv:
+    """An env whose `reset` swaps in a ready spare from a `ResetPool`, see there."""
+
+    def __init__(self, env, pool: ResetPool):
+        self.env = env
+        self.pool = pool
+        self.rng = np.random.default_rng(pool.rng.integers(1 << 32))
+        self._steps_to_snapshot = self._sample_snapshot_steps()
+        self._started = False
+
+    @property
+    def action_space(self):
+        return self.env.action_space
+
+    @property
+    def observation_space(self):
+        return self.env.observation_space
+
+    def _sample_snapshot_steps(self) -> int:
+        snapshot_every = self.pool.spec.snapshot_every
+        return int(self.rng.integers(1, 2 * snapshot_every)) if snapshot_every > 0 else -1
+
+    def step(self, action):
+        self._steps_to_snapshot -= 1
+        if self._steps_to_snapshot == 0:
+            # saving runs the game 2 tics forward, so it happens before the action: this step's observation and
+            # deltas then include those tics, and an episode they end is reported by this step
+            with profiler.scope("env/snapshot"):
+                self.pool.save_snapshot(self.env)
+            self._steps_to_snapshot = self._sample_snapshot_steps()
+
+        return self.env.step(action)
+
+    def reset(self):
+        if not self._started:
+            # the first reset starts the env's own fresh game, the spares are for episode ends
+            self._started = True
+            return self.env.reset()
+
+        spare = self.pool.swap(self.env)
+        if spare is None:
+            return self.env.reset()
+        self.env, observation, info = spare
+        return observation, info
+
+    def close(self):
+        self.env.close()
+
+
+# ITU-R 601 luma, what cv2.COLOR_RGB2GRAY uses
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+@dataclass
+class ScreenPreprocessor:
+    """Turns a raw screen into the uint8 frame the agent trains on, right next to the env so only the
+    final (smaller) frame is copied into the step buffers. Applied in order:
+
+    - `crop`: (top, bottom, left, right) pixels cut off the raw screen, e.g. `(0, 30, 0, 0)` drops the HUD.
+    - `grayscale`: a single luminance channel, the output is (H, W, 1) or (1, H, W).
+    - `resolution`: (height, width) to resize to (area interpolation).
+
+    `channel_first` is the layout of the screens (and of the output), the backends set it from the
+    env's screen format. The defaults leave the screen untouched.
+    """
+
+    resolution: tuple = None
+    grayscale: bool = False
+    crop: tuple = (0, 0, 0, 0)
+    channel_first: bool = False
+
+    @property
+    def is_identity(self) -> bool:
+        return self.resolution is None and not self.grayscale and not any(self.crop)
+
+    def for_screen_format(self, screen_format: str) -> "ScreenPreprocessor":
+        return replace(self, channel_first=screen_format in CHANNEL_FIRST_FORMATS)
+
+    def output_shape(self, screen_shape: tuple) -> tuple:
+        if self.channel_first:
+            channels, height, width = screen_shape
+        else:
+            height, width, channels = screen_shape
+        top, bottom, left, right = self.crop
+        height, width = height - top - bottom, width - left - right
+        assert height > 0 and width > 0, f"Crop {self.crop} leaves nothing of a {screen_shape} screen"
+
+        if self.resolution is not None:
+            height, width = self.resolution
+        if self.grayscale:
+            channels = 1
+        return (channels, height, width) if self.channel_first else (height, width, channels)
+
+    def __call__(self, screen: np.ndarray, out: np.ndarray):
+        """Writes the preprocessed `screen` into `out` (a row of the observation buffer)."""
+
+        if self.is_identity:
+            out[...] = screen
+            return
+
+        if self.channel_first:
+            self._process_channel_first(screen, out)
+            return
+
+        top, bottom, left, right = self.crop
+        screen = screen[top:screen.shape[0] - bottom, left:screen.shape[1] - right]
+
+        if self.grayscale and screen.shape[-1] == 3:
+            screen = cv2.cvtColor(screen, cv2.COLOR_RGB2GRAY)
+
+        if self.resolution is not None:
+            height, width = self.resolution
+            screen = cv2.resize(screen, (width, height), interpolation=cv2.INTER_AREA)
+
+        out[...] = screen.reshape(out.shape)
+
+    def _process_channel_first(self, screen: np.ndarray, out: np.ndarray):
+        # (C, H, W): cv2 works on one (H, W) plane at a time, so nothing gets transposed
+        top, bottom, left, right = self.crop
+        screen = screen[:, top:screen.shape[1] - bottom, left:screen.shape[2] - right]
+
+        if self.grayscale and screen.shape[0] == 3:
+            # prefer the GRAY8 screen format, the engine does this for free
+            screen = np.tensordot(GRAY_WEIGHTS, screen, axes=1).round().astype(np.uint8)[None]
+
+        if self.resolution is None:
+            out[...] = screen
+            return
+
+        height, width = self.resolution
+        for channel in range(screen.shape[0]):
+            out[channel] = cv2.resize(screen[channel], (width, height), interpolation=cv2.INTER_AREA)
+
+
+@dataclass
+class StepBuffers:
+    """The preallocated arrays every env writes its step results into, row `i` belongs to env `i`.
+    `deltas` (N, F) and the raw game variables after the step, `features` (N, F), only exist for envs
+    with custom reward features (both laid out like `custom_doom.REWARD_FEATURES`).
+    """
+
+    observations: np.ndarray
+    rewards: np.ndarray
+    dones: np.ndarray
+    deltas: np.ndarray = None
+    features: np.ndarray = None
+
+
+def step_buffer_layout(num_envs: int, obs_shape: tuple, reward_features: bool) -> dict:
+    """{name: (shape, dtype)} of the `StepBuffers` fields, so every backend allocates the same thing."""
+
+    layout = {
+        "observations": ((num_envs, *obs_shape), np.uint8),
+        "rewards": ((num_envs,), np.float32),
+        "dones": ((num_envs,), np.bool_),
+    }
+    if reward_features:
+        layout["deltas"] = ((num_envs, len(FEATURE_NAMES)), np.float32)
+        layout["features"] = ((num_envs, len(FEATURE_NAMES)), np.float32)
+    return layout
+
+
+def compute_rewards(reward_engine: RewardEngine, coverage: CoverageGrid, buffers: StepBuffers, rows: slice = slice(None)):
+    """Runs the exploration coverage update and the reward engine over the stacked deltas of `rows` in one pass."""
+
+    dones = buffers.dones[rows]
+    new_cells = coverage.update(buffers.features[rows, POSITION_COLUMNS], rows)
+    rewards = reward_engine.compute(buffers.deltas[rows], new_cells)
+    rewards[dones] = 0  # No reward on reset
+    buffers.rewards[rows] = rewards
+
+    # the done envs are already on their next episode
+    coverage.reset(dones, rows)
+
+
+def reset_env(env, i: int, buffers: StepBuffers, preprocess: ScreenPreprocessor):
+    obs, _ = env.reset()
+    preprocess(obs["screen"], buffers.observations[i])
+    buffers.dones[i] = False
+
+
+def step_env(env, action, i: int, buffers: StepBuffers, preprocess: ScreenPreprocessor):
+    """Steps a single env and writes its results into row `i` of the buffers (the screen goes through `preprocess`).
+    If the env is done, it is reset and the first observation of the new episode is written instead.
+    The deltas always belong to the step that was taken, even if the env was reset after it.
+    """
+
+    obs, reward, terminated, truncated, infos = env.step(action)
+    done = terminated or truncated
+
+    if buffers.deltas is not None:
+        buffers.deltas[i] = infos["deltas"].values
+        buffers.features[i] = infos["features"]
+
+    if done:
+        # Reset the environment if it was done in the last step
+        with profiler.scope("env/reset"):
+            obs, _ = env.reset()
+        reward = 0  # No reward on reset
+
+    with profiler.scope("env/preprocess"):
+        preprocess(obs["screen"], buffers.observations[i])
+    buffers.rewards[i] = reward
+    buffers.dones[i] = done
+
+
+def worker_loop(
+    remote, parent_remote, env_id: str, env_indices: list, env_kwargs: dict, preprocess: ScreenPreprocessor,
+    reset_pool: ResetPoolSpec = None,
+):
+    """Owns the games for `env_indices` (built with `make_env(env_id, **env_kwargs)`), and their spares if
+    `reset_pool` is on. Results are preprocessed and written straight into the shared arrays, the pipe only
+    carries small commands.
+    """
+
+    parent_remote.close()
+
+    # the parent only needs the spaces to set up, the other games boot while it does
+    envs = [make_env(env_id, **env_kwargs)]
+    remote.send((envs[0].observation_space, envs[0].action_space))
+    envs += [make_env(env_id, **env_kwargs) for _ in env_indices[1:]]
+
+    pool = None
+    if reset_pool is not None and reset_pool.size > 0:
+        pool = ResetPool(env_id, env_kwargs, reset_pool)
+        envs = [pool.wrap(env) for env in envs]
+
+    cmd, specs = remote.recv()
+    assert cmd == "attach", f"Expected attach command, got {cmd}"
+    blocks, arrays = {}, {}
+    for key, spec in specs.items():
+        blocks[key], arrays[key] = attach_shared_array(spec)
+    actions = arrays.pop("actions")
+    buffers = StepBuffers(**arrays)
+
+    try:
+        while True:
+            cmd, _ = remote.recv()
+
+            if cmd == "step":
+                for env, i in zip(envs, env_indices):
+                    step_env(env, actions[i], i, buffers, preprocess)
+                remote.send(None)
+            elif cmd == "reset":
+                for env, i in zip(envs, env_indices):
+                    reset_env(env, i, buffers, preprocess)
+                remote.send(None)
+            elif cmd == "close":
+                break
+            else:
+                raise ValueError(f"Unknown command: {cmd}")
+    except (KeyboardInterrupt, EOFError, ConnectionResetError):
+        # the training process owns the shutdown, just get out of the way
+        pass
+    finally:
+        for env in envs:
+            env.close()
+        if pool is not None:
+            pool.close()
+        # views have to go before the blocks can be closed
+        buffers = actions = arrays = None
+        for shm in blocks.values():
+            shm.close()
+        remote.close()
@@ -0,0 +1,253 @@
+"""Lossless, random-access recording of every env's frames, an alternative to the grid mp4s of
+`VideoTensorStorage` with the same recording interface.
+
+Every env gets its own folder of fixed size chunk files holding individually compressed frames, plus an
+index file of fixed size records (see `FRAME_RECORD_DTYPE`) that can be memory-mapped, so any frame of any
+env is one lookup and one decompression away, no neighbouring frames get decoded. Since the frames are
+stored exactly as the agent saw them, they double as training data. A human-viewable grid mp4 can still be
+exported from the store (`export_grid_video`).
+
+    <folder>/meta.json
+    <folder>/env_000/index.bin
+    <folder>/env_000/chunk_000000.bin
+    ...
+"""
+
+import os
+import json
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import cv2
+
+from video_encoder import compose_grid
+
+# frame t of an env lives in chunk t // chunk_size, at `offset` in that chunk file
+FRAME_RECORD_DTYPE = np.dtype([("offset", "<u8"), ("nbytes", "<u4"), ("episode", "<i4")])
+
+CODECS = ("zlib", "lz4")
+
+
+def _get_codec(codec: str) -> tuple:
+    """(compress, decompress) for `codec`. lz4 is faster but optional, zlib always works."""
+
+    if codec == "zlib":
+        # level 1, these are frames not archives
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    if codec == "lz4":
+        import lz4.block
+        return lz4.block.compress, lz4.block.decompress
+    raise ValueError(f"Unknown codec: {codec}, expected one of {CODECS}")
+
+
+class FrameStore:
+    """Records (N, *frame_shape) uint8 frames every step, like `VideoTensorStorage.update_and_save_frame`.
+
+    Compressing is done on a small thread pool (zlib and lz4 release the GIL) and the compressed frames are
+    written in order once they're ready, so the training thread only pays for one copy of the frames.
+    At most `max_pending` steps can wait for compression before `update_and_save_frame` blocks.
+    """
+
+    def __init__(
+        self, folder: str, num_envs: int, frame_shape: tuple, channel_first: bool = False, chunk_size: int = 256,
+        codec: str = "zlib", num_threads: int = None, max_pending: int = 8,
+    ):
+        self.folder = folder
+        self.num_envs = num_envs
+        self.frame_shape = tuple(frame_shape)
+        self.channel_first = channel_first
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self._compress, self._decompress = _get_codec(codec)
+
+        self.frame_count = 0  # frames written per env
+        self.episode_counters = torch.zeros((num_envs,), dtype=torch.int32)
+
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "meta.json"), "w") as f:
+            json.dump({
+                "num_envs": num_envs, "frame_shape": self.frame_shape, "channel_first": channel_first,
+                "chunk_size": chunk_size, "codec": codec,
+            }, f)
+
+        for env in range(num_envs):
+            os.makedirs(self._env_folder(env), exist_ok=True)
+        self._index_files = [open(os.path.join(self._env_folder(env), "index.bin"), "wb") for env in range(num_envs)]
+        self._chunk_files = [None] * num_envs
+        self._chunk_offsets = np.zeros((num_envs,), dtype=np.uint64)
+        self._records = np.zeros((num_envs,), dtype=FRAME_RECORD_DTYPE)
+
+        if num_threads is None:
+            num_threads = max(1, min(4, os.cpu_count()))
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="frame-store")
+        self.max_pending = max_pending
+        self._pending = deque()
+
+    @classmethod
+    def open(cls, folder: str) -> "FrameStore":
+        """Opens a finished store for reading."""
+
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+
+        store = cls.__new__(cls)
+        store.folder = folder
+        store.num_envs = meta["num_envs"]
+        store.frame_shape = tuple(meta["frame_shape"])
+        store.channel_first = meta["channel_first"]
+        store.chunk_size = meta["chunk_size"]
+        store.codec = meta["codec"]
+        store._compress, store._decompress = _get_codec(store.codec)
+        store._index_files = store._chunk_files = None
+        store._pending = deque()
+        store.executor = None
+        store.frame_count = len(store.index(0))
+        return store
+
+    def _env_folder(self, env: int) -> str:
+        return os.path.join(self.folder, f"env_{env:03d}")
+
+    def _chunk_path(self, env: int, chunk: int) -> str:
+        return os.path.join(self._env_folder(env), f"chunk_{chunk:06d}.bin")
+
+    def _compress_frames(self, frames: np.ndarray) -> list:
+        return [self._compress(frame) for frame in frames]
+
+    def _write_step(self, compressed: list, episodes: np.ndarray, frame: int):
+        chunk, position = divmod(frame, self.chunk_size)
+
+        for env, data in enumerate(compressed):
+            if position == 0:
+                if self._chunk_files[env] is not None:
+                    self._chunk_files[env].close()
+                self._chunk_files[env] = open(self._chunk_path(env, chunk), "wb")
+                self._chunk_offsets[env] = 0
+
+            self._chunk_files[env].write(data)
+
+        self._records["offset"] = self._chunk_offsets
+        self._records["nbytes"] = [len(data) for data in compressed]
+        self._records["episode"] = episodes
+        self._chunk_offsets += self._records["nbytes"].astype(np.uint64)
+        for env in range(self.num_envs):
+            self._index_files[env].write(self._records[env].tobytes())
+
+    def _drain(self, keep: int):
+        # written in submission order, so every env's files stay in frame order
+        while len(self._pending) > keep:
+            future, episodes, frame = self._pending.popleft()
+            self._write_step(future.result(), episodes, frame)
+
+    def update_and_save_frame(self, observations, done_flags):
+        # the backend reuses its observation buffer, the compressor gets its own copy
+        frames = np.array(observations.cpu().numpy(), copy=True)
+        episodes = self.episode_counters.numpy().copy()
+
+        future = self.executor.submit(self._compress_frames, frames)
+        self._pending.append((future, episodes, self.frame_count))
+        self._drain(self.max_pending)
+
+        self.episode_counters[torch.as_tensor(done_flags, dtype=torch.bool)] += 1
+        self.frame_count += 1
+
+    def flush(self):
+        """Writes every frame recorded so far to disk."""
+
+        if self._index_files is None:
+            return
+        self._drain(0)
+        for f in self._index_files + [f for f in self._chunk_files if f is not None]:
+            f.flush()
+
+    def index(self, env: int) -> np.ndarray:
+        """The memory-mapped (frames,) `FRAME_RECORD_DTYPE` index of `env` (only covers flushed frames)."""
+
+        path = os.path.join(self._env_folder(env), "index.bin")
+        if os.path.getsize(path) == 0:
+            return np.zeros((0,), dtype=FRAME_RECORD_DTYPE)
+        return np.memmap(path, dtype=FRAME_RECORD_DTYPE, mode="r")
+
+    def read_frames(self, env: int, start: int, stop: int) -> np.ndarray:
+        """Frames [start, stop) of `env` as a (T, *frame_shape) uint8 array."""
+
+        self.flush()
+        records = self.index(env)[start:stop]
+        frames = np.empty((len(records), *self.frame_shape), dtype=np.uint8)
+
+        chunk_file, chunk_index = None, None
+        for i, record in enumerate(records):
+            chunk = (start + i) // self.chunk_size
+            if chunk != chunk_index:
+                if chunk_file is not None:
+                    chunk_file.close()
+                chunk_file, chunk_index = open(self._chunk_path(env, chunk), "rb"), chunk
+            chunk_file.seek(int(record["offset"]))
+            data = chunk_file.read(int(record["nbytes"]))
+            frames[i] = np.frombuffer(self._decompress(data), dtype=np.uint8).reshape(self.frame_shape)
+        if chunk_file is not None:
+            chunk_file.close()
+
+        return frames
+
+    def read_frame(self, env: int, frame: int) -> np.ndarray:
+        return self.read_frames(env, frame, frame + 1)[0]
+
+    def episode_range(self, env: int, episode: int) -> tuple:
+        """[start, stop) frames of `env`'s `episode`, the episodes of an env are increasing so this is a binary search."""
+
+        self.flush()
+        episodes = self.index(env)["episode"]
+        return int(np.searchsorted(episodes, episode, side="left")), int(np.searchsorted(episodes, episode, side="right"))
+
+    def get_video_slice(self, env_i: int, episode: int):
+        """Same as `VideoTensorStorage.get_video_slice`, but lossless and in the observations' own colors:
+        a (T, C, H, W) uint8 tensor.
+        """
+
+        start, stop = self.episode_range(env_i, episode)
+        print(f"Found {stop - start} frames for environment {env_i}, episode {episode}")
+        if stop == start:
+            raise ValueError(f"No frames found for environment {env_i}, episode {episode}")
+
+        frames = torch.from_numpy(self.read_frames(env_i, start, stop))
+        return frames if self.channel_first else frames.permute(0, 3, 1, 2)
+
+    def export_grid_video(self, path: str, grid_size: int, start: int = 0, stop: int = None, fps: float = 20.0):
+        """Writes frames [start, stop) of all envs as a grid mp4, like the ones `VideoTensorStorage` records."""
+
+        self.flush()
+        stop = self.frame_count if stop is None else stop
+        if self.channel_first:
+            channels, height, width = self.frame_shape
+        else:
+            height, width, channels = self.frame_shape
+
+        grid = np.zeros((height * grid_size, width * grid_size, channels), dtype=np.uint8)
+        conversion = cv2.COLOR_GRAY2BGR if channels == 1 else cv2.COLOR_RGB2BGR
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (grid.shape[1], grid.shape[0]))
+
+        # a chunk's worth of frames of every env at a time
+        for block_start in range(start, stop, self.chunk_size):
+            block_stop = min(block_start + self.chunk_size, stop)
+            frames = np.stack([self.read_frames(env, block_start, block_stop) for env in range(self.num_envs)], axis=1)
+            if self.channel_first:
+                frames = frames.transpose(0, 1, 3, 4, 2)
+            for step_frames in frames:
+                compose_grid(step_frames, grid, grid_size)
+                writer.write(cv2.cvtColor(grid, conversion))
+
+        writer.release()
+
+    def close(self):
+        """Writes everything that's still pending and closes the files."""
+
+        if self._index_files is None:
+            return
+
+        self._drain(0)
+        for f in self._index_files + [f for f in self._chunk_files if f is not None]:
+            f.close()
+        self._index_files = self._chunk_files = None
+        self.executor.shutdown()
@@ -0,0 +1,117 @@
+"""Inference-only acting path for `train_doom.Agent`.
+
+`Agent.forward` is built for learning: autograd is on, and every step builds a `Categorical` whose samples
+and log probs go through `multi_sample_argmax`. Acting needs none of that, so `InferenceEngine` keeps a
+separate copy of the agent's layers as one pure function (conv trunk + blender + action head), optionally
+TorchScript-ed or `torch.compile`-d and in channels_last, and picks the actions with a fused sampler. The
+learner recomputes whatever log probs it needs from the observations and hidden states it stores.
+
+    engine = InferenceEngine(agent, backend="compile")
+    actions, next_hidden_state = engine.act(observations, hidden_state)
+    ...
+    engine.sync(agent)  # after the learner updated the agent
+"""
+
+import copy
+from typing import Tuple
+
+import torch
+from torch import nn
+
+BACKENDS = ("eager", "script", "compile")
+
+
+def fused_multi_sample_argmax(probs: torch.Tensor, k: int = 3, generator: torch.Generator = None) -> torch.Tensor:
+    """`train_doom.multi_sample_argmax` without the distribution objects: draw `k` actions per row of the
+    (B, A) `probs` and keep the most likely one. Comparing the probs of the samples is the same as comparing
+    their log probs, and `torch.multinomial` is what `Categorical.sample` uses under the hood.
+    """
+
+    samples = torch.multinomial(probs, k, replacement=True, generator=generator)
+    best = probs.gather(1, samples).argmax(dim=1, keepdim=True)
+    return samples.gather(1, best).squeeze(1)
+
+
+class ActorPolicy(nn.Module):
+    """The agent's acting computation as a single scriptable function of the observations and hidden state.
+    The submodules have the same names as in `Agent`, so the agent's state dict loads as is.
+    """
+
+    def __init__(self, agent: nn.Module, channels_last: bool = False):
+        super().__init__()
+        self.obs_embedding = copy.deepcopy(agent.obs_embedding)
+        self.embedding_head = copy.deepcopy(agent.embedding_head)
+        self.embedding_blender = copy.deepcopy(agent.embedding_blender)
+        self.action_head = copy.deepcopy(agent.action_head)
+        self.channel_first = agent.channel_first
+        self.channels_last = channels_last
+
+    def forward(self, observations: torch.Tensor, hidden_state: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """(B, *obs_shape) observations of any dtype -> (B, A) action probs and the (B, E) blended embedding."""
+
+        observations = observations.float()
+        if not self.channel_first:
+            # a permuted NHWC batch already has the channels_last strides
+            observations = observations.permute(0, 3, 1, 2)
+        if self.channels_last:
+            observations = observations.contiguous(memory_format=torch.channels_last)
+
+        obs_embedding = self.obs_embedding(observations).mean(dim=(2, 3))
+        obs_embedding = self.embedding_head(obs_embedding)
+        blended_embedding = self.embedding_blender(torch.cat((obs_embedding, hidden_state), dim=1))
+        return self.action_head(blended_embedding), blended_embedding
+
+
+class InferenceEngine:
+    """Picks actions for a batch of envs with a frozen copy of the agent (see the module docstring).
+
+    `backend` is one of `BACKENDS`: the plain module, `torch.jit.script` or `torch.compile` (which needs a
+    working compiler toolchain and a warmup per batch size). `channels_last` lays the conv weights and inputs
+    out NHWC. It's off by default: with 1 or 3 input channels, converting the input costs more than the NHWC
+    kernels save (see bench_inference.py --channels-last).
+    """
+
+    def __init__(self, agent: nn.Module, backend: str = "eager", channels_last: bool = False, num_samples: int = 3, device=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend}, expected one of {BACKENDS}")
+
+        device = next(agent.parameters()).device if device is None else torch.device(device)
+
+        self.backend = backend
+        self.device = device
+        self.num_samples = num_samples
+
+        self.policy = ActorPolicy(agent, channels_last=channels_last).to(device).eval()
+        for parameter in self.policy.parameters():
+            parameter.requires_grad_(False)
+        if channels_last:
+            self.policy = self.policy.to(memory_format=torch.channels_last)
+
+        self.module = self._build_module()
+
+    def _build_module(self) -> nn.Module:
+        """The module `act` runs, made from `self.policy`."""
+
+        # the scripted/compiled versions share the policy's parameters, so `sync` only has to update those
+        if self.backend == "script":
+            return torch.jit.script(self.policy)
+        if self.backend == "compile":
+            return torch.compile(self.policy, dynamic=False)
+        return self.policy
+
+    def sync(self, agent: nn.Module):
+        """Copies the learner's current weights in (in place, so the layouts and the compiled code stay)."""
+        self.policy.load_state_dict(agent.state_dict())
+
+    @torch.no_grad()
+    def act(self, observations: torch.Tensor, hidden_state: torch.Tensor, generator: torch.Generator = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Actions for (B, *obs_shape) `observations` from the (B, E) `hidden_state`, and the hidden state for
+        the next step (same update as `Agent.next_hidden_state`).
+        """
+
+        probs, blended_embedding = self.module(observations.to(self.device), hidden_state.to(self.device))
+        actions = fused_multi_sample_argmax(probs, self.num_samples, generator=generator)
+
+        next_hidden_state = blended_embedding.clone()
+        next_hidden_state[:, -1] = actions
+        return actions, next_hidden_state
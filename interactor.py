@@ -6,8 +6,18 @@ import cv2
 # from vizdoom import gymnasium_wrapper
 # import doom
 import os
-
-from custom_doom import VizDoomCustom
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+
+from custom_doom import RewardEngine, RewardSpec, CoverageGrid, CHANNEL_FIRST_FORMATS
+from env_worker import (
+    StepBuffers, ScreenPreprocessor, ResetPoolSpec, ResetPool, make_env, get_frame_skip, uses_reward_features, step_buffer_layout, compute_rewards,
+    reset_env, step_env, worker_loop,
+)
+from shared_arrays import create_shared_array, lightweight_spawn
+from trajectory import TrajectoryWriter
+from profiler import profiler
 
 # from gymnasium.envs.registration import register
 
@@ -23,27 +33,132 @@ from custom_doom import VizDoomCustom
 DISPLAY_SIZE = (1280, 720)
 
 
+def _group_rows(group: list) -> slice:
+    # groups are always contiguous, so their rows can be sliced (views) instead of fancy indexed (copies)
+    return slice(group[0], group[-1] + 1)
+
+
 class VizDoomVectorized:
-    def __init__(self, num_envs: int, env_id: str):
+    def __init__(
+        self, num_envs: int, env_id: str, num_threads: int = 0, reward_spec: RewardSpec = None, frame_skip: int | dict = None,
+        preprocess: ScreenPreprocessor = None, screen_format: str = "RGB24", screen_resolution: str = None,
+        reset_pool: ResetPoolSpec = None,
+    ):
+        """If `num_threads` > 0, stepping is fanned out to a persistent thread pool. ViZDoom
+        releases the GIL while the engine runs a tic, so this gets a multi-core speedup without
+        spawning processes. Each thread steps one contiguous group of envs per call, which keeps
+        the per-step submit/gather overhead to `num_threads` futures instead of `num_envs`.
+
+        `frame_skip` is the number of tics every action is repeated for, or an {env_id: tics} mapping (see
+        `env_worker.get_frame_skip`). Unset is 1.
+
+        `preprocess` runs on every screen as soon as its env produces it, `obs_shape` is its output shape.
+        With a channel-first `screen_format` (CRCGCB, GRAY8) the observations are (N, C, H, W), otherwise
+        (N, H, W, C). `screen_resolution` is e.g. "160X120" (see `custom_doom.make_doom_env`).
+
+        With a `reset_pool` (see `env_worker.ResetPool`) the done envs swap in spare games that were reset in
+        the background, instead of restarting the map while the other envs wait.
+
+        Only the first game is booted here, the others boot concurrently in the background (ViZDoom releases
+        the GIL while it starts up) and are waited for on first use, so the caller can set up in the meantime.
+        """
+
         self.num_envs = num_envs
+        self.frame_skip = get_frame_skip(env_id, frame_skip)
+        self.screen_format = screen_format
+        env_kwargs = {"frame_skip": self.frame_skip, "screen_format": screen_format, "screen_resolution": screen_resolution}
+
+        first_env = make_env(env_id, **env_kwargs)
+        self._envs = [first_env]
+        self._boot_executor = None
+        self._booting = []  # futures of the other games, None once they're all up
+        if num_envs > 1:
+            self._boot_executor = ThreadPoolExecutor(max_workers=min(num_envs - 1, os.cpu_count()), thread_name_prefix="doom-boot")
+            self._booting = [self._boot_executor.submit(make_env, env_id, **env_kwargs) for _ in range(num_envs - 1)]
+        self.reset_pool = ResetPool(env_id, env_kwargs, reset_pool) if reset_pool is not None and reset_pool.size > 0 else None
+
+        self.single_action_space = first_env.action_space
+        self.preprocess = (preprocess or ScreenPreprocessor()).for_screen_format(screen_format)
+
+        self.executor = None
+        self.groups = [list(range(num_envs))]
+        if num_threads > 0:
+            num_threads = min(num_threads, num_envs)
+            self.groups = [group.tolist() for group in np.array_split(np.arange(num_envs), num_threads)]
+            self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="doom-step")
+
+        # custom reward envs only hand back game variable deltas, the rewards for all
+        # envs are computed here in one vectorized pass
+        self.reward_engine = RewardEngine(reward_spec) if uses_reward_features(env_id) else None
+        self.coverage = CoverageGrid(num_envs) if self.reward_engine is not None else None
 
-        if env_id == "VizdoomCustom-v0":
-            self.envs = [VizDoomCustom() for _ in range(num_envs)]
-        else:
-            self.envs = [gymnasium.make(env_id) for _ in range(num_envs)]
-            
         # Pre-allocate observation and reward tensors
-        first_obs_space = self.envs[0].observation_space['screen']
-        self.obs_shape = first_obs_space.shape
-        self.observations = torch.zeros((num_envs, *self.obs_shape), dtype=torch.uint8)
-        self.rewards = torch.zeros(num_envs, dtype=torch.float32)
-        self.dones = torch.zeros(num_envs, dtype=torch.bool)
+        first_obs_space = first_env.observation_space['screen']
+        self.obs_shape = self.preprocess.output_shape(first_obs_space.shape)
+        layout = step_buffer_layout(num_envs, self.obs_shape, reward_features=self.reward_engine is not None)
+        self.buffers = StepBuffers(**{key: np.zeros(shape, dtype=dtype) for key, (shape, dtype) in layout.items()})
+
+        # the envs write into the numpy buffers, these tensors share their memory
+        self.observations = torch.from_numpy(self.buffers.observations)
+        self.rewards = torch.from_numpy(self.buffers.rewards)
+        self.dones = torch.from_numpy(self.buffers.dones)
+        self.deltas = torch.from_numpy(self.buffers.deltas) if self.buffers.deltas is not None else None
+        self.features = torch.from_numpy(self.buffers.features) if self.buffers.features is not None else None
+
+        # state for the split-batch async api (step_async/step_wait)
+        self._async_actions = np.zeros(num_envs, dtype=np.int64)
+        self._pending = {}
+        self._finished = deque()
+
+    @property
+    def envs(self) -> list:
+        """The games (wrapped by the reset pool if there is one), waits for the ones still booting."""
+        return self._wait_for_envs()
+
+    def _wait_for_envs(self) -> list:
+        if self._booting is not None:
+            envs = self._envs + [future.result() for future in self._booting]
+            if self._boot_executor is not None:
+                self._boot_executor.shutdown()
+            if self.reset_pool is not None:
+                envs = [self.reset_pool.wrap(env) for env in envs]
+            self._envs, self._booting = envs, None
+        return self._envs
+
+    def _reset_group(self, group: list):
+        for i in group:
+            reset_env(self.envs[i], i, self.buffers, self.preprocess)
+
+    def _step_group(self, group: list, actions):
+        for i in group:
+            step_env(self.envs[i], actions[i], i, self.buffers, self.preprocess)
+
+    def _run_groups(self, fn, *args):
+        # the groups read `self.envs` from the step threads, the booting has to be over before
+        self._wait_for_envs()
+        if self.executor is None:
+            fn(self.groups[0], *args)
+            return
+
+        futures = [self.executor.submit(fn, group, *args) for group in self.groups]
+        for future in futures:
+            future.result()
+
+    def _finish_rows(self, rows: slice = slice(None)) -> dict:
+        """Computes the rewards for `rows` in one vectorized pass and returns their columnar infos:
+        "deltas" is the (N, F) game variable deltas of the last step and "features" the (N, F) raw game
+        variables after it (both laid out like `custom_doom.REWARD_FEATURES`), for custom reward envs.
+        """
+
+        if self.reward_engine is not None:
+            with profiler.scope("env/rewards"):
+                compute_rewards(self.reward_engine, self.coverage, self.buffers, rows)
+        return {"deltas": self.deltas[rows], "features": self.features[rows]} if self.deltas is not None else {}
 
     def reset(self):
-        for i in range(self.num_envs):
-            obs, _ = self.envs[i].reset()
-            self.observations[i] = torch.tensor(obs["screen"], dtype=torch.uint8)  # Fill the pre-allocated tensor
-            self.dones[i] = False
+        self._run_groups(self._reset_group)
+        if self.coverage is not None:
+            self.coverage.reset()
         return self.observations
 
     def step(self, actions):
@@ -51,31 +166,264 @@ class VizDoomVectorized:
            If an environment is done, it will automatically reset.
         """
 
-        all_infos = []
+        with profiler.scope("env/step"):
+            self._run_groups(self._step_group, actions)
+        return self.observations, self.rewards, self.dones, self._finish_rows()
 
-        self.dones[:] = False
+    def step_async(self, group_index: int, actions):
+        """Starts stepping only the envs in `self.groups[group_index]` with `actions` (one per env in
+        the group) and returns immediately. Collect the results with `step_wait`.
+        """
 
-        for i in range(self.num_envs):
-            obs, reward, terminated, truncated, infos = self.envs[i].step(actions[i])
-            self.observations[i] = torch.tensor(obs["screen"], dtype=torch.uint8)  # Fill the pre-allocated tensor
-            self.rewards[i] = reward
-            done = terminated or truncated
-            self.dones[i] = done
+        group = self.groups[group_index]
+        self._async_actions[group] = actions
+        self._wait_for_envs()
 
-            if done:
-                # Reset the environment if it was done in the last step
-                obs, infos = self.envs[i].reset()
-                self.observations[i] = torch.tensor(obs["screen"], dtype=torch.uint8)  # Fill the pre-allocated tensor
-                self.rewards[i] = 0  # No reward on reset
-                self.dones[i] = True
+        if self.executor is None:
+            # nothing to overlap with, just step right away
+            self._step_group(group, self._async_actions)
+            self._finished.append(group_index)
+        else:
+            future = self.executor.submit(self._step_group, group, self._async_actions)
+            self._pending[future] = group_index
 
-            all_infos.append(infos)
+    def step_wait(self, group_indices=None):
+        """Blocks until any group started by `step_async` (any of `group_indices` if given) is done, returns
+        (group_index, infos). The group's rows in `self.observations`, `self.rewards` and `self.dones` are up to date.
+        """
+
+        finished = [index for index in self._finished if group_indices is None or index in group_indices]
+        if finished:
+            group_index = finished[0]
+            self._finished.remove(group_index)
+        else:
+            futures = [future for future, index in self._pending.items() if group_indices is None or index in group_indices]
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            future = next(iter(done))
+            group_index = self._pending.pop(future)
+            future.result()
 
-        return self.observations, self.rewards, self.dones, all_infos
+        return group_index, self._finish_rows(_group_rows(self.groups[group_index]))
 
     def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
         for env in self.envs:
             env.close()
+        if self.reset_pool is not None:
+            self.reset_pool.close()
+
+
+class VizDoomSubprocVectorized:
+    """Same interface as `VizDoomVectorized`, but the games live in subprocess workers
+    (each one owning a contiguous group of envs). Workers write screens, dones and reward
+    deltas straight into shared memory that backs `self.observations`, `self.dones` and
+    `self.deltas`, so nothing but tiny commands goes through the pipes.
+
+    The workers start from `env_worker` alone and boot concurrently. Only the first worker's first game is
+    waited for here (for the spaces), the rest are waited for on first use.
+    """
+
+    def __init__(
+        self, num_envs: int, env_id: str, num_workers: int = None, reward_spec: RewardSpec = None, frame_skip: int | dict = None,
+        preprocess: ScreenPreprocessor = None, screen_format: str = "RGB24", screen_resolution: str = None,
+        reset_pool: ResetPoolSpec = None,
+    ):
+        self.num_envs = num_envs
+        self.frame_skip = get_frame_skip(env_id, frame_skip)
+        self.screen_format = screen_format
+        self.preprocess = (preprocess or ScreenPreprocessor()).for_screen_format(screen_format)
+        env_kwargs = {"frame_skip": self.frame_skip, "screen_format": screen_format, "screen_resolution": screen_resolution}
+
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        num_workers = max(1, min(num_workers, num_envs))
+        self.groups = [group.tolist() for group in np.array_split(np.arange(num_envs), num_workers)]
+
+        # spawn instead of fork, ViZDoom and torch don't like being forked
+        ctx = mp.get_context("spawn")
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in self.groups])
+        self.processes = []
+        with lightweight_spawn():
+            for work_remote, remote, group in zip(work_remotes, self.remotes, self.groups):
+                process = ctx.Process(target=worker_loop, args=(work_remote, remote, env_id, group, env_kwargs, self.preprocess, reset_pool), daemon=True)
+                process.start()
+                self.processes.append(process)
+                work_remote.close()
+
+        # every worker reports its spaces once its first game is up, the others only have to be read before
+        # their first command is answered
+        first_obs_space, self.single_action_space = self.remotes[0].recv()
+        self._booting = list(self.remotes[1:])
+        self.obs_shape = self.preprocess.output_shape(first_obs_space['screen'].shape)
+
+        self.reward_engine = RewardEngine(reward_spec) if uses_reward_features(env_id) else None
+        self.coverage = CoverageGrid(num_envs) if self.reward_engine is not None else None
+
+        # Pre-allocate observation and reward arrays in shared memory
+        layout = step_buffer_layout(num_envs, self.obs_shape, reward_features=self.reward_engine is not None)
+        layout["actions"] = ((num_envs,), np.int64)
+        self._shared_blocks = {}
+        arrays = {}
+        for key, (shape, dtype) in layout.items():
+            self._shared_blocks[key], arrays[key] = create_shared_array(shape, dtype)
+
+        self._actions_np = arrays.pop("actions")
+        self.buffers = StepBuffers(**arrays)
+
+        self.observations = torch.from_numpy(self.buffers.observations)
+        self.rewards = torch.from_numpy(self.buffers.rewards)
+        self.dones = torch.from_numpy(self.buffers.dones)
+        self.deltas = torch.from_numpy(self.buffers.deltas) if self.buffers.deltas is not None else None
+        self.features = torch.from_numpy(self.buffers.features) if self.buffers.features is not None else None
+
+        specs = {key: (self._shared_blocks[key].name, shape, np.dtype(dtype).str) for key, (shape, dtype) in layout.items()}
+        for remote in self.remotes:
+            remote.send(("attach", specs))
+
+        # remote -> group index, for the split-batch async api (step_async/step_wait)
+        self._pending = {}
+
+        self.closed = False
+
+    def _wait_for_workers(self):
+        for remote in self._booting:
+            remote.recv()
+        self._booting = []
+
+    def _wait_all(self):
+        for remote in self.remotes:
+            remote.recv()
+
+    def _finish_rows(self, rows: slice = slice(None)) -> dict:
+        # see `VizDoomVectorized._finish_rows`
+        if self.reward_engine is not None:
+            with profiler.scope("env/rewards"):
+                compute_rewards(self.reward_engine, self.coverage, self.buffers, rows)
+        return {"deltas": self.deltas[rows], "features": self.features[rows]} if self.deltas is not None else {}
+
+    def reset(self):
+        self._wait_for_workers()
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        self._wait_all()
+        if self.coverage is not None:
+            self.coverage.reset()
+        return self.observations
+
+    def step(self, actions):
+        """Steps all environments in the workers. Same semantics as `VizDoomVectorized.step`."""
+
+        self._actions_np[:] = np.asarray(actions)
+        self._wait_for_workers()
+        with profiler.scope("env/step"):
+            for remote in self.remotes:
+                remote.send(("step", None))
+            self._wait_all()
+
+        return self.observations, self.rewards, self.dones, self._finish_rows()
+
+    def step_async(self, group_index: int, actions):
+        """Same as `VizDoomVectorized.step_async`, a group is the set of envs owned by one worker."""
+
+        self._actions_np[self.groups[group_index]] = actions
+        self._wait_for_workers()
+        remote = self.remotes[group_index]
+        remote.send(("step", None))
+        self._pending[remote] = group_index
+
+    def step_wait(self, group_indices=None):
+        ready = mp.connection.wait([remote for remote, index in self._pending.items() if group_indices is None or index in group_indices])
+        remote = ready[0]
+        group_index = self._pending.pop(remote)
+        remote.recv()
+        return group_index, self._finish_rows(_group_rows(self.groups[group_index]))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        # let in-flight async steps finish so the workers are listening again
+        for remote in list(self._pending):
+            try:
+                remote.recv()
+            except (EOFError, ConnectionResetError):
+                pass
+        self._pending = {}
+
+        for remote in self.remotes:
+            try:
+                remote.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                # ViZDoom installs its own SIGTERM handler, so terminate() isn't always enough
+                process.kill()
+
+        # drop our views before releasing the blocks
+        self.observations = self.rewards = self.dones = self.deltas = None
+        self.buffers = self._actions_np = None
+        for shm in self._shared_blocks.values():
+            shm.close()
+            shm.unlink()
+        self._shared_blocks = {}
+
+
+class FrameStack:
+    """Keeps the last `num_frames` channel-first frames of every env in a preallocated ring buffer.
+
+    Every frame is written twice, at slot `t % K` and `t % K + K` of a 2K slot buffer, so the last K
+    frames (oldest first) always sit in the contiguous slots `t % K + 1 ... t % K + K`. `push` returns
+    that window as a (n, K * C, H, W) view of the buffer, no frames get copied around. The rows of an env
+    that just finished are zeroed, so a new episode never sees frames of the previous one.
+
+    All envs that are pushed together share a write position (the backends always step whole groups).
+    """
+
+    def __init__(self, num_envs: int, num_frames: int, frame_shape: tuple):
+        self.num_frames = num_frames
+        self.frame_shape = frame_shape
+        channels, height, width = frame_shape
+        self.obs_shape = (num_frames * channels, height, width)
+
+        self.buffer = torch.zeros((num_envs, 2 * num_frames, *frame_shape), dtype=torch.uint8)
+        self.positions = np.zeros(num_envs, dtype=np.int64)
+
+    def _window(self, rows: slice, position: int) -> torch.Tensor:
+        start = position + 1
+        window = self.buffer[rows, start:start + self.num_frames]
+        return window.view(window.size(0), *self.obs_shape)
+
+    def reset(self, frames: torch.Tensor) -> torch.Tensor:
+        """Clears the history of every env and starts it with `frames` (N, C, H, W)."""
+
+        self.buffer.zero_()
+        self.positions[:] = 0
+        return self.push(frames)
+
+    def push(self, frames: torch.Tensor, dones: torch.Tensor = None, rows: slice = slice(None)) -> torch.Tensor:
+        """Appends `frames` for the envs in `rows` (the first frames of the next episode for the ones that
+        are `dones`) and returns their stacked (n, K * C, H, W) view.
+        """
+
+        positions = self.positions[rows]
+        position = int(positions[0])
+        assert (positions == position).all(), "Envs pushed together must share a write position"
+
+        block = self.buffer[rows]
+        if dones is not None and dones.any():
+            block[dones] = 0
+
+        position = (position + 1) % self.num_frames
+        block[:, position] = frames
+        block[:, position + self.num_frames] = frames
+        positions[:] = position
+
+        return self._window(rows, position)
+
 
 class DoomInteractor:
     """This thing manages the state of the environment and uses the agent
@@ -84,12 +432,64 @@ class DoomInteractor:
     internal vectorization, making gradients easier to accumulate.
     """
 
-    def __init__(self, num_envs: int, watch: bool = False, watch_video_path: str = None, env_id: str = "VizdoomCorridor-v0"):
+    def __init__(
+        self, num_envs: int, watch: bool = False, watch_video_path: str = None, env_id: str = "VizdoomCorridor-v0",
+        backend: str = "serial", num_workers: int = None, reward_spec: RewardSpec = None, frame_skip: int | dict = None,
+        preprocess: ScreenPreprocessor = None, screen_format: str = "RGB24", screen_resolution: str = None,
+        frame_stack: int = 1, record_path: str = None, record_shard_steps: int = 1024, record_frame_delta: bool = False,
+        reset_pool: ResetPoolSpec = None,
+    ):
+        """With `frame_stack` > 1 the observations are the last `frame_stack` frames of every env, stacked
+        along the channels (see `FrameStack`), which needs a channel-first `screen_format`.
+        `obs_shape` is the shape of a single env's observation either way.
+
+        With a `record_path`, every transition taken through `step` is streamed to disk as trajectory
+        shards (see `trajectory.TrajectoryWriter`), with single (unstacked) frames as observations.
+
+        `reset_pool` turns on fast resets from pre-warmed spare games (see `env_worker.ResetPool`), every
+        backend process keeps its own spares.
+        """
+
         self.num_envs = num_envs
-        self.env = VizDoomVectorized(num_envs, env_id=env_id)  # Using the vectorized environment
-        self.single_action_space = self.env.envs[0].action_space
+
+        if frame_stack > 1 and screen_format not in CHANNEL_FIRST_FORMATS:
+            raise ValueError(f"Frame stacking needs a channel-first screen format {CHANNEL_FIRST_FORMATS}, got {screen_format}")
+
+        env_kwargs = dict(
+            env_id=env_id, reward_spec=reward_spec, frame_skip=frame_skip, preprocess=preprocess,
+            screen_format=screen_format, screen_resolution=screen_resolution, reset_pool=reset_pool,
+        )
+
+        # Using the vectorized environment
+        if backend == "serial":
+            self.env = VizDoomVectorized(num_envs, **env_kwargs)
+        elif backend == "thread":
+            self.env = VizDoomVectorized(num_envs, num_threads=num_workers or os.cpu_count(), **env_kwargs)
+        elif backend == "subproc":
+            self.env = VizDoomSubprocVectorized(num_envs, num_workers=num_workers, **env_kwargs)
+        else:
+            raise ValueError(f"Unknown backend: {backend}, expected 'serial', 'thread' or 'subproc'")
+
+        self.single_action_space = self.env.single_action_space
         self.action_space = batch_space(self.single_action_space, self.num_envs)
 
+        self.frame_stack = None
+        self.obs_shape = self.env.obs_shape
+        if frame_stack > 1:
+            self.frame_stack = FrameStack(num_envs, frame_stack, self.env.obs_shape)
+            self.obs_shape = self.frame_stack.obs_shape
+
+        self.trajectory_writer = None
+        if record_path is not None:
+            self.trajectory_writer = TrajectoryWriter(
+                record_path, num_envs, self.env.obs_shape, reward_features=self.env.reward_engine is not None,
+                shard_steps=record_shard_steps, frame_delta=record_frame_delta,
+                metadata={
+                    "env_id": env_id, "num_actions": int(self.single_action_space.n),
+                    "frame_skip": self.env.frame_skip, "screen_format": screen_format,
+                },
+            )
+
         self.watch = watch  # If True, OpenCV window will display frames from env 0
         self.watch_index = 0
 
@@ -107,50 +507,120 @@ class DoomInteractor:
             cv2.namedWindow("screen", cv2.WINDOW_NORMAL)
             cv2.resizeWindow("screen", *DISPLAY_SIZE)
 
+    @property
+    def groups(self) -> list:
+        """Env indices stepped together by the backend, used by the async api (`send`/`recv`)."""
+        return self.env.groups
+
     def reset(self):
         self.current_episode_cumulative_rewards = torch.zeros(self.num_envs, dtype=torch.float32)
-        return self.env.reset()
+        observations = self.env.reset()
+        if self.frame_stack is not None:
+            observations = self.frame_stack.reset(observations)
+        return observations
 
     def step(self, actions=None):
         if actions is None:
-            actions = np.array([self.env.envs[i].action_space.sample() for i in range(self.num_envs)])
+            actions = np.array([self.single_action_space.sample() for _ in range(self.num_envs)])
+
+        # the backend overwrites the observations the actions were taken on, so they're recorded first
+        if self.trajectory_writer is not None:
+            with profiler.scope("interactor/record"):
+                self.trajectory_writer.record_observations(self.env.observations)
 
         # Step the environments with the sampled actions
         observations, rewards, dones, infos = self.env.step(actions)
-        self.current_episode_cumulative_rewards += rewards
+        self._after_step(list(range(self.num_envs)), observations, rewards, dones)
 
-        # Show the screen from the 0th environment if watch is enabled
-        if self.watch:
-            # Convert tensor to numpy array for OpenCV display
-            screen = observations[self.watch_index].cpu().numpy()
-            screen = cv2.resize(screen, DISPLAY_SIZE)
+        if self.trajectory_writer is not None:
+            with profiler.scope("interactor/record"):
+                self.trajectory_writer.record_step(actions, rewards, dones, infos)
+
+        if self.frame_stack is not None:
+            with profiler.scope("interactor/frame_stack"):
+                observations = self.frame_stack.push(observations, dones)
+
+        # Return the results
+        return observations, rewards, dones, infos
+
+    def send(self, group_index: int, actions):
+        """EnvPool-style async stepping: starts stepping the envs in `self.groups[group_index]`
+        and returns immediately, so the agent can run on another group in the meantime.
+        """
+
+        if self.trajectory_writer is not None:
+            raise RuntimeError("Trajectories are recorded whole vectorized steps at a time, use `step` instead of `send`/`recv`")
+
+        self.env.step_async(group_index, actions)
 
-            # on the screen, draw the watch_index
-            cv2.putText(screen, f"Env: {self.watch_index}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    def recv(self, group_indices=None):
+        """Waits for whichever group finished first (of `group_indices` if given, the others stay in flight).
+        Returns (group_index, observations, rewards, dones, infos) for the envs in that group only. The returned
+        observations/rewards/dones are copies, so they stay valid after the group is sent again (the columnar
+        `infos` are views, read them before sending).
+        """
+
+        with profiler.scope("env/wait"):
+            group_index, infos = self.env.step_wait(group_indices)
+        env_ids = self.groups[group_index]
+
+        observations = self.env.observations[env_ids]
+        rewards = self.env.rewards[env_ids]
+        dones = self.env.dones[env_ids]
+        self._after_step(env_ids, observations, rewards, dones)
 
-            # also display the current reward
-            cv2.putText(screen, f"Ep Reward: {self.current_episode_cumulative_rewards[self.watch_index]:.3f}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        if self.frame_stack is not None:
+            with profiler.scope("interactor/frame_stack"):
+                observations = self.frame_stack.push(observations, dones, rows=_group_rows(env_ids)).clone()
 
-            if self.video_writer is not None:
-                self.video_writer.write(screen)
+        return group_index, observations, rewards, dones, infos
 
-            if self.watch:
-                cv2.imshow("screen", screen)
-                cv2.waitKey(1)  # Display for 1 ms
+    def _after_step(self, env_ids: list, observations, rewards, dones):
+        """Bookkeeping for the envs in `env_ids`, `observations`/`rewards`/`dones` are rows for just those envs."""
+
+        self.current_episode_cumulative_rewards[env_ids] += rewards
+
+        # Show the screen from the 0th environment if watch is enabled
+        if self.watch and self.watch_index in env_ids:
+            with profiler.scope("interactor/watch"):
+                self._show_watch_screen(observations[env_ids.index(self.watch_index)])
 
         # reset the reward sums for the environments that are done
-        for i in range(self.num_envs):
-            if dones[i]:
+        for row, i in enumerate(env_ids):
+            if dones[row]:
                 self.current_episode_cumulative_rewards[i] = 0
 
-        # Return the results
-        return observations, rewards, dones, infos
+    def _show_watch_screen(self, observation):
+        """Draws the watched env's `observation` and writes it to the watch video."""
+
+        # Convert tensor to numpy array for OpenCV display
+        screen = observation.cpu().numpy()
+        if self.env.preprocess.channel_first:
+            screen = screen.transpose(1, 2, 0)
+        screen = cv2.resize(screen, DISPLAY_SIZE)
+        if screen.ndim == 2:
+            # grayscale observations (cv2 drops the single channel when resizing)
+            screen = cv2.cvtColor(screen, cv2.COLOR_GRAY2BGR)
+
+        # on the screen, draw the watch_index
+        cv2.putText(screen, f"Env: {self.watch_index}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+
+        # also display the current reward
+        cv2.putText(screen, f"Ep Reward: {self.current_episode_cumulative_rewards[self.watch_index]:.3f}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+
+        if self.video_writer is not None:
+            self.video_writer.write(screen)
+
+        cv2.imshow("screen", screen)
+        cv2.waitKey(1)  # Display for 1 ms
 
     def close(self):
         if self.watch:
             cv2.destroyAllWindows()  # Close the OpenCV window
         if self.video_writer is not None:
             self.video_writer.release()
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.close()
         self.env.close()
 
 
@@ -0,0 +1,246 @@
+"""Training metrics that cost (almost) nothing per step.
+
+`MetricsAggregator` keeps running sums of whatever gets logged, as tensors on the device they came from (or
+plain floats), so logging a step never waits on the device or loops over envs in Python. Every `flush_every`
+steps the aggregates are materialized in one transfer per device and handed to a background thread that fans
+them out to the sinks (stdout, wandb, JSONL, Parquet), so slow sinks don't stall training either.
+
+    metrics = MetricsAggregator([StdoutSink(), JsonlSink("run/metrics.jsonl")], flush_every=10)
+    for step in ...:
+        metrics.mean("loss", loss)              # averaged over the flush interval
+        metrics.total("num_done", dones)        # summed over the flush interval
+        metrics.cumulative("kills", deltas[:, KILLCOUNT])  # summed since the start of the run
+        metrics.step()
+    metrics.close()
+"""
+
+import os
+import json
+import queue
+import threading
+import numpy as np
+import torch
+
+
+def _sum(value):
+    """Sum of a tensor (stays on its device), array or number, and how many values went into it."""
+
+    if torch.is_tensor(value):
+        return value.detach().float().sum(), value.numel()
+    value = np.asarray(value, dtype=np.float64)
+    return float(value.sum()), value.size
+
+
+class MetricsAggregator:
+    """Accumulates scalars between flushes, see the module docstring. Every kind of aggregate takes tensors
+    (any device, any shape: all elements count), numpy arrays or numbers. `collectors` are called at every
+    flush and return more {name: number} metrics for the record (e.g. `profiler.summary`).
+    """
+
+    def __init__(self, sinks: list, flush_every: int = 10, max_queued: int = 16, collectors: list = None):
+        self.sinks = sinks
+        self.collectors = collectors or []
+        self.flush_every = flush_every
+        self.num_steps = 0
+
+        self._means = {}  # name -> [sum, count]
+        self._totals = {}
+        self._maxes = {}
+        self._last = {}
+        self._cumulative = {}  # never reset
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._writer = threading.Thread(target=self._write, name="metrics-writer", daemon=True)
+        self._writer.start()
+
+    def mean(self, name: str, value):
+        """Mean of all the values logged under `name` during the interval (skipped if there were none)."""
+
+        value_sum, count = _sum(value)
+        if count == 0:
+            return
+        accumulated = self._means.get(name)
+        if accumulated is None:
+            self._means[name] = [value_sum, count]
+        else:
+            accumulated[0] = accumulated[0] + value_sum
+            accumulated[1] += count
+
+    def total(self, name: str, value):
+        """Sum of all the values logged under `name` during the interval."""
+        self._totals[name] = self._totals.get(name, 0.0) + _sum(value)[0]
+
+    def cumulative(self, name: str, value):
+        """Sum of all the values logged under `name` since the start of the run."""
+        self._cumulative[name] = self._cumulative.get(name, 0.0) + _sum(value)[0]
+
+    def max(self, name: str, value):
+        """Largest value logged under `name` during the interval."""
+
+        value = value.detach().float().max() if torch.is_tensor(value) else float(np.max(value))
+        previous = self._maxes.get(name)
+        if previous is None:
+            self._maxes[name] = value
+        elif torch.is_tensor(value) or torch.is_tensor(previous):
+            self._maxes[name] = torch.maximum(torch.as_tensor(previous), torch.as_tensor(value))
+        else:
+            self._maxes[name] = max(previous, value)
+
+    def last(self, name: str, value):
+        """The most recent value logged under `name` (a scalar)."""
+        self._last[name] = value.detach() if torch.is_tensor(value) else value
+
+    def step(self):
+        self.num_steps += 1
+        if self.num_steps % self.flush_every == 0:
+            self.flush()
+
+    def _aggregates(self) -> dict:
+        aggregates = {name: value_sum / count for name, (value_sum, count) in self._means.items()}
+        aggregates.update(self._totals)
+        aggregates.update(self._maxes)
+        aggregates.update(self._last)
+        aggregates.update(self._cumulative)
+        return aggregates
+
+    def flush(self):
+        """Materializes the interval's aggregates and queues them for the sinks."""
+
+        if self._error is not None:
+            raise RuntimeError("A metrics sink failed") from self._error
+
+        aggregates = self._aggregates()
+        self._means, self._totals, self._maxes, self._last = {}, {}, {}, {}
+        for collect in self.collectors:
+            aggregates.update(collect())
+        if not aggregates:
+            return
+
+        # one stack and one copy per device, instead of an `.item()` sync per metric
+        by_device = {}
+        for name, value in aggregates.items():
+            if torch.is_tensor(value):
+                by_device.setdefault(value.device, []).append(name)
+        record = {name: float(value) for name, value in aggregates.items() if not torch.is_tensor(value)}
+        for names in by_device.values():
+            values = torch.stack([aggregates[name].float().reshape(()) for name in names]).cpu().tolist()
+            record.update(zip(names, values))
+
+        # the running totals only need to stay tensors until they were read once
+        for name in self._cumulative:
+            self._cumulative[name] = record[name]
+
+        self._queue.put((self.num_steps, record))
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            step, record = item
+            for sink in self.sinks:
+                try:
+                    sink.write(step, record)
+                except Exception as e:
+                    self._error = e
+
+    def close(self):
+        """Flushes what's left of the interval and waits for the sinks."""
+
+        if self.num_steps % self.flush_every != 0:
+            self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        for sink in self.sinks:
+            sink.close()
+
+
+class StdoutSink:
+    def write(self, step: int, record: dict):
+        lines = [f"------------- {step} -------------"]
+        lines += [f"{name}:\t{value:.4f}" for name, value in sorted(record.items())]
+        print("\n".join(lines), flush=True)
+
+    def close(self):
+        pass
+
+
+class WandbSink:
+    """Logs to the current wandb run (`wandb.init` has to have been called). `attach` hands it media (e.g. a
+    `wandb.Video`) from any thread, it goes out with the next record so only one thread ever calls `wandb.log`.
+    """
+
+    def __init__(self):
+        import wandb
+        self.wandb = wandb
+        self._attached = queue.Queue()
+
+    def attach(self, name: str, value):
+        self._attached.put((name, value))
+
+    def _drain(self) -> dict:
+        attached = {}
+        while True:
+            try:
+                name, value = self._attached.get_nowait()
+            except queue.Empty:
+                return attached
+            attached[name] = value
+
+    def write(self, step: int, record: dict):
+        self.wandb.log({"step": step, **record, **self._drain()})
+
+    def close(self):
+        # whatever was attached after the last flush
+        attached = self._drain()
+        if attached:
+            self.wandb.log(attached)
+
+
+class JsonlSink:
+    """Appends one JSON object per flush to `path`, readable while the run is going."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+
+    def write(self, step: int, record: dict):
+        self.file.write(json.dumps({"step": step, **record}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """Writes the flushes to `folder` as Parquet files of `rows_per_file` rows each (part_000000.parquet, ...).
+    Files are never appended to, so every finished one is complete. Needs pyarrow.
+    """
+
+    def __init__(self, folder: str, rows_per_file: int = 1000):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+
+        self.folder = folder
+        self.rows_per_file = rows_per_file
+        self.rows = []
+        self.num_files = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _write_file(self):
+        table = self.pyarrow.Table.from_pylist(self.rows)
+        self.pyarrow.parquet.write_table(table, os.path.join(self.folder, f"part_{self.num_files:06d}.parquet"))
+        self.num_files += 1
+        self.rows = []
+
+    def write(self, step: int, record: dict):
+        self.rows.append({"step": step, **record})
+        if len(self.rows) >= self.rows_per_file:
+            self._write_file()
+
+    def close(self):
+        if self.rows:
+            self._write_file()
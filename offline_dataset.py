@@ -0,0 +1,207 @@
+"""Training batches straight from recorded trajectories (see `trajectory.py`), so reward weights and
+architectures can be iterated on at disk speed instead of ViZDoom speed.
+
+`TrajectoryDataset` memory-maps the shards of a recording (optionally recomputing the rewards with a
+different `RewardSpec`) and `SequenceLoader` samples batches of contiguous (env, time) sequences from it
+on background threads, keeping a few batches ready in a prefetch queue.
+"""
+
+import queue
+import threading
+import numpy as np
+import torch
+
+from custom_doom import RewardEngine, RewardSpec, CoverageGrid, POSITION_COLUMNS
+from trajectory import read_recording, read_shard, list_shards
+
+
+class TrajectoryDataset:
+    """All complete shards of a recording. `.npy` fields stay memory-mapped, frame-delta observations are
+    decompressed into memory once (they can't be mapped).
+
+    With a `reward_spec`, the rewards are recomputed from the recorded deltas and game variables by replaying
+    the recording through a `RewardEngine` and a `CoverageGrid`, exactly like the env workers would have
+    (the recording has to start at the first reset, which `DoomInteractor` recordings always do).
+    """
+
+    def __init__(self, folder: str, reward_spec: RewardSpec = None):
+        self.folder = folder
+        self.meta = read_recording(folder)
+        self.num_envs = self.meta["num_envs"]
+        self.obs_shape = tuple(self.meta["obs_shape"])
+        self.num_actions = self.meta.get("num_actions")
+
+        self.shards = [read_shard(path) for path in list_shards(folder)]
+        if not self.shards:
+            raise ValueError(f"No complete trajectory shards in {folder}")
+        self.shard_steps = np.array([len(shard["actions"]) for shard in self.shards])
+
+        if reward_spec is not None:
+            self.relabel_rewards(reward_spec)
+
+    @property
+    def num_steps(self) -> int:
+        return int(self.shard_steps.sum())
+
+    def relabel_rewards(self, reward_spec: RewardSpec):
+        """Replaces the recorded rewards of every shard with the ones `reward_spec` would have given."""
+
+        if "deltas" not in self.shards[0]:
+            raise ValueError("The recording has no reward features, its rewards can't be recomputed")
+
+        engine = RewardEngine(reward_spec)
+        coverage = CoverageGrid(self.num_envs)
+        for shard in self.shards:
+            rewards = np.empty_like(shard["rewards"])
+            for t in range(len(rewards)):
+                dones = shard["dones"][t]
+                new_cells = coverage.update(shard["features"][t][:, POSITION_COLUMNS])
+                rewards[t] = engine.compute(shard["deltas"][t], new_cells)
+                rewards[t, dones] = 0  # No reward on reset
+                coverage.reset(dones)
+            shard["rewards"] = rewards
+
+
+class SequenceLoader:
+    """Endless iterator over time-major batches of `batch_size` sequences of `seq_len` consecutive steps of
+    a single env. Sequences never cross shards, so every step of one really follows the previous one.
+
+    Every batch is a dict of (seq_len, batch_size, ...) tensors:
+    - `observations` (uint8, stacked like `interactor.FrameStack` when `frame_stack` > 1), `actions`, `rewards`, `dones`
+    - `resets`: the hidden state has to be zeroed before this step, it's the first one of a new episode.
+      The hidden state a sequence starts from is zeros too, which is only right if it starts an episode.
+    - `mask`: the steps whose hidden state is known. A sequence that starts mid-episode only gets the steps
+      after `burn_in` (or after its first reset) trained on, the ones before just warm up the hidden state.
+
+    `num_workers` threads assemble batches (the gathers out of the memory maps release the GIL) and keep up to
+    `prefetch` of them queued, so the training loop only waits if it's faster than the disk.
+    """
+
+    def __init__(
+        self, dataset: TrajectoryDataset, batch_size: int, seq_len: int, burn_in: int = 0, frame_stack: int = 1,
+        num_workers: int = 2, prefetch: int = 4, pin_memory: bool = False, seed: int = 0,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.burn_in = burn_in
+        self.frame_stack = frame_stack
+        self.pin_memory = pin_memory
+
+        if frame_stack > 1:
+            channels, height, width = dataset.obs_shape
+            self.obs_shape = (frame_stack * channels, height, width)
+        else:
+            self.obs_shape = dataset.obs_shape
+
+        # a sequence needs its frame history in the same shard, so it starts `frame_stack - 1` steps in
+        self._first_start = frame_stack - 1
+        self._num_starts = dataset.shard_steps - seq_len - self._first_start + 1
+        if (self._num_starts <= 0).all():
+            raise ValueError(f"No shard of {dataset.folder} is long enough for {seq_len} step sequences")
+        self._num_starts = np.maximum(self._num_starts, 0)
+        self._start_offsets = np.concatenate([[0], np.cumsum(self._num_starts)])
+
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._workers = [
+            threading.Thread(target=self._work, args=(seed + i,), name=f"sequence-loader-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _sample_starts(self, rng: np.random.Generator) -> tuple:
+        """(shard, first step, env) of `batch_size` sequences, uniform over all possible sequences."""
+
+        flat = rng.integers(0, self._start_offsets[-1], size=self.batch_size)
+        shards = np.searchsorted(self._start_offsets, flat, side="right") - 1
+        starts = flat - self._start_offsets[shards] + self._first_start
+        envs = rng.integers(0, self.dataset.num_envs, size=self.batch_size)
+        return shards, starts, envs
+
+    def _stack_frames(self, frames: np.ndarray, episode_starts: np.ndarray) -> np.ndarray:
+        """(seq_len + K - 1, ...) frames, and whether each of them starts an episode -> (seq_len, K * C, H, W)
+        stacks, oldest frame first, with the frames of a previous episode zeroed like `FrameStack` does.
+        """
+
+        num_frames = self.frame_stack
+        episodes = np.cumsum(episode_starts)
+        newest_episodes = episodes[num_frames - 1:]
+
+        stacks = np.empty((self.seq_len, num_frames, *frames.shape[1:]), dtype=np.uint8)
+        for k in range(num_frames):
+            # slot k of step t holds frame t + k, the newest one is frame t + K - 1
+            stacks[:, k] = frames[k:k + self.seq_len]
+            stacks[episodes[k:k + self.seq_len] != newest_episodes, k] = 0
+        return stacks.reshape(self.seq_len, *self.obs_shape)
+
+    def _assemble(self, rng: np.random.Generator) -> dict:
+        shards, starts, envs = self._sample_starts(rng)
+        history = self._first_start
+        seq_len, batch_size = self.seq_len, self.batch_size
+
+        observations = np.empty((seq_len, batch_size, *self.obs_shape), dtype=np.uint8)
+        actions = np.empty((seq_len, batch_size), dtype=np.int64)
+        rewards = np.empty((seq_len, batch_size), dtype=np.float32)
+        dones = np.empty((seq_len, batch_size), dtype=np.bool_)
+        resets = np.zeros((seq_len, batch_size), dtype=np.bool_)
+        starts_episode = np.zeros((batch_size,), dtype=np.bool_)
+
+        for b, (shard_index, start, env) in enumerate(zip(shards, starts, envs)):
+            shard = self.dataset.shards[shard_index]
+            steps = slice(start, start + seq_len)
+            actions[:, b] = shard["actions"][steps, env]
+            rewards[:, b] = shard["rewards"][steps, env]
+            dones[:, b] = shard["dones"][steps, env]
+            resets[1:, b] = dones[:-1, b]
+
+            # known start: the very first step of the recording, or right after a done
+            if start > 0:
+                starts_episode[b] = shard["dones"][start - 1, env]
+            else:
+                starts_episode[b] = shard_index == 0
+
+            if self.frame_stack > 1:
+                frames = shard["observations"][start - history:start + seq_len, env]
+                # a frame starts an episode if the step before it was done
+                episode_starts = np.zeros((len(frames),), dtype=np.bool_)
+                episode_starts[1:] = shard["dones"][start - history:start + seq_len - 1, env]
+                observations[:, b] = self._stack_frames(frames, episode_starts)
+            else:
+                observations[:, b] = shard["observations"][steps, env]
+
+        # a step's hidden state is known once the sequence passed an episode start or enough burn-in
+        mask = np.logical_or.accumulate(resets | starts_episode[None], axis=0)
+        mask[self.burn_in:] = True
+
+        batch = {
+            "observations": observations, "actions": actions, "rewards": rewards,
+            "dones": dones, "resets": resets, "mask": mask,
+        }
+        batch = {key: torch.from_numpy(value) for key, value in batch.items()}
+        if self.pin_memory:
+            batch = {key: value.pin_memory() for key, value in batch.items()}
+        return batch
+
+    def _work(self, seed: int):
+        rng = np.random.default_rng(seed)
+        while not self._stop.is_set():
+            batch = self._assemble(rng)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        return self._queue.get()
+
+    def close(self):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
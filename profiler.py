@@ -0,0 +1,178 @@
+"""Named timing scopes for the hot path, cheap enough to leave on for every run.
+
+A scope costs two `perf_counter_ns` calls and two deque appends. Every finished scope is kept in a bounded ring
+of trace events (so the last steps can be dumped as a Chrome trace / Perfetto JSON at any time) and in a rolling
+window of durations per name (for the percentiles that go into the metrics).
+
+    from profiler import profiler
+
+    with profiler.scope("env/step"):
+        ...
+    profiler.step()                     # once per training step, for steps/sec and the trace's step spans
+    profiler.summary()                  # {"profile/env/step_p50_ms": ..., "profile/steps_per_sec": ...}
+    profiler.dump_chrome_trace("trace.json", last_steps=200)  # open in ui.perfetto.dev or chrome://tracing
+
+Scopes can be entered from any thread, each one shows up as its own track in the trace. Processes have their own
+`profiler`, so the scopes inside subprocess env workers stay in the workers (the parent sees the wait).
+"""
+
+import os
+import json
+import signal
+import threading
+from collections import deque
+from time import perf_counter_ns
+
+import numpy as np
+
+
+class _NullScope:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+class _Scope:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, perf_counter_ns() - self.start)
+        return False
+
+
+class Profiler:
+    """Collects the timing scopes, see the module docstring. `window` is how many durations per name (and how
+    many steps) the percentiles and steps/sec are computed over, `max_events` bounds the trace ring.
+    """
+
+    def __init__(self, enabled: bool = True, window: int = 1000, max_events: int = 200_000):
+        self.enabled = enabled
+        self.window = window
+
+        self.events = deque(maxlen=max_events)  # (name, start ns, duration ns, thread id)
+        self.durations = {}  # name -> deque of the last `window` durations (ns)
+        self.step_starts = deque(maxlen=window + 1)  # perf_counter_ns at every step boundary
+        self.thread_names = {}
+
+        self._dump_requested = None  # (path, last_steps) to dump at the next step, set from a signal handler
+
+    def scope(self, name: str):
+        """Context manager timing its block under `name`."""
+
+        if not self.enabled:
+            return _NULL_SCOPE
+        return _Scope(self, name)
+
+    def record(self, name: str, start: int, duration: int):
+        """Adds a finished scope (perf_counter_ns values). Safe to call from any thread."""
+
+        thread_id = threading.get_ident()
+        if thread_id not in self.thread_names:
+            self.thread_names[thread_id] = threading.current_thread().name
+        self.events.append((name, start, duration, thread_id))
+
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations.setdefault(name, deque(maxlen=self.window))
+        durations.append(duration)
+
+    def step(self):
+        """Marks the end of a training step."""
+
+        if not self.enabled:
+            return
+
+        now = perf_counter_ns()
+        if self.step_starts:
+            self.record("step", self.step_starts[-1], now - self.step_starts[-1])
+        self.step_starts.append(now)
+
+        if self._dump_requested is not None:
+            (path, last_steps), self._dump_requested = self._dump_requested, None
+            self.dump_chrome_trace(path, last_steps)
+            print(f"Wrote profiler trace {path}")
+
+    def steps_per_sec(self) -> float:
+        """Over the last `window` steps."""
+
+        step_starts = list(self.step_starts)
+        if len(step_starts) < 2:
+            return 0.0
+        return (len(step_starts) - 1) * 1e9 / (step_starts[-1] - step_starts[0])
+
+    def summary(self, percentiles: tuple = (50, 90, 99)) -> dict:
+        """Rolling percentiles (ms) of every scope plus steps/sec, as flat metrics."""
+
+        if not self.enabled:
+            return {}
+
+        record = {}
+        # list() snapshots are atomic, the env threads may be adding to them meanwhile
+        for name, durations in list(self.durations.items()):
+            durations = np.array(list(durations), dtype=np.float64)
+            if len(durations) == 0:
+                continue
+            for percentile, value in zip(percentiles, np.percentile(durations, percentiles)):
+                record[f"profile/{name}_p{percentile}_ms"] = value / 1e6
+        record["profile/steps_per_sec"] = self.steps_per_sec()
+        return record
+
+    def chrome_trace(self, last_steps: int = None) -> dict:
+        """The recorded scopes as a Chrome trace event dict, only those that ended within the last `last_steps`
+        steps if given (as far back as the ring of events goes).
+        """
+
+        events = list(self.events)
+        step_starts = list(self.step_starts)
+        since = 0
+        if last_steps is not None and len(step_starts) > last_steps:
+            since = step_starts[-last_steps - 1]
+
+        pid = os.getpid()
+        origin = events[0][1] if events else 0
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": name}}
+            for thread_id, name in list(self.thread_names.items())
+        ]
+        for name, start, duration, thread_id in events:
+            if start + duration < since:
+                continue
+            trace_events.append({
+                "name": name, "cat": name.split("/")[0], "ph": "X", "pid": pid, "tid": thread_id,
+                "ts": (start - origin) / 1e3, "dur": duration / 1e3,
+            })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def dump_chrome_trace(self, path: str, last_steps: int = None):
+        """Writes `chrome_trace(last_steps)` to `path`, open it in ui.perfetto.dev or chrome://tracing."""
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(last_steps), f)
+
+    def dump_on_signal(self, path: str, last_steps: int = None, signum: int = signal.SIGUSR1):
+        """Dump the last `last_steps` steps to `path` at the next `step` whenever the process gets `signum`
+        (`kill -USR1 <pid>`). The handler only sets a flag, the dump happens between steps on the training thread.
+        """
+
+        def request_dump(signum, frame):
+            self._dump_requested = (path, last_steps)
+
+        signal.signal(signum, request_dump)
+
+
+# the one every module times into
+profiler = Profiler()
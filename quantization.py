@@ -0,0 +1,144 @@
+"""int8 copy of `train_doom.Agent` for acting on CPU-only rollout machines, while the learner keeps training
+the fp32 weights.
+
+- dynamic: only the linear layers get int8 weights, activations are quantized on the fly. Needs no data, but
+  leaves the convolutions (where the time goes) in fp32.
+- static: FX graph mode quantization of the whole acting path, convolutions included, with the activation
+  ranges calibrated on real observations and hidden states (a recent rollout, or a trajectory recording).
+
+    engine = QuantizedEngine(agent, mode="static", calibration=(observations, hidden_states))
+    actions, next_hidden_state = engine.act(observations, hidden_state)
+    ...
+    engine.sync(agent, calibration=...)  # every few updates: reload the weights and requantize
+    engine.divergence(observations, hidden_states)  # how far the int8 actor is from the fp32 one
+"""
+
+import copy
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from inference import InferenceEngine, ActorPolicy
+from trajectory import read_shard, list_shards
+
+QUANTIZATION_MODES = ("dynamic", "static")
+
+
+def calibration_from_recording(agent: nn.Module, folder: str, num_steps: int = 16) -> tuple:
+    """(observations, hidden states) to calibrate with, from the first `num_steps` steps of every env of a
+    trajectory recording. The hidden states are rebuilt by replaying the recorded actions through the fp32
+    agent, the hidden state input has a very different range than zeros (its last unit holds the last action).
+    """
+
+    shard = read_shard(list_shards(folder)[0])
+    observations = torch.from_numpy(np.array(shard["observations"][:num_steps]))
+    actions = torch.from_numpy(np.array(shard["actions"][:num_steps]))
+    dones = torch.from_numpy(np.array(shard["dones"][:num_steps]))
+
+    policy = ActorPolicy(agent).cpu().eval()
+    if tuple(observations.shape[2:]) != _policy_obs_shape(policy):
+        raise ValueError(f"The recording's observations {tuple(observations.shape[2:])} don't fit the agent")
+
+    hidden_state = torch.zeros(observations.size(1), agent.embedding_size)
+    hidden_states = []
+    with torch.no_grad():
+        for t in range(len(observations)):
+            hidden_states.append(hidden_state)
+            _, blended_embedding = policy(observations[t], hidden_state)
+            hidden_state = blended_embedding.clone()
+            hidden_state[:, -1] = actions[t]
+            hidden_state[dones[t]] = 0
+
+    return observations.flatten(0, 1), torch.stack(hidden_states).flatten(0, 1)
+
+
+def _policy_obs_shape(policy: ActorPolicy) -> tuple:
+    """The single observation shape `policy` was built for, HWC if it permutes its inputs."""
+
+    normalized_shape = tuple(policy.obs_embedding[0].normalized_shape)
+    if policy.channel_first:
+        return normalized_shape
+    channels, height, width = normalized_shape
+    return (height, width, channels)
+
+
+class QuantizedEngine(InferenceEngine):
+    """`InferenceEngine` acting with an int8 version of the agent, on the CPU.
+
+    The fp32 `policy` is kept next to the quantized `module`: `sync` loads the learner's weights into it and
+    requantizes (recalibrating on the given `calibration` batch, or the previous one), and `divergence`
+    compares the two. Static quantization needs a `calibration` (observations, hidden states) batch up front,
+    at most `max_calibration_samples` of it are used.
+    """
+
+    def __init__(
+        self, agent: nn.Module, mode: str = "static", calibration: tuple = None, num_samples: int = 3,
+        max_calibration_samples: int = 256,
+    ):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {mode}, expected one of {QUANTIZATION_MODES}")
+        if mode == "static" and calibration is None:
+            raise ValueError("Static quantization needs a calibration batch of (observations, hidden states)")
+
+        self.mode = mode
+        self.max_calibration_samples = max_calibration_samples
+        self.calibration = None
+        if calibration is not None:
+            self._set_calibration(calibration)
+
+        super().__init__(agent, backend="eager", num_samples=num_samples, device="cpu")
+
+    def _set_calibration(self, calibration: tuple):
+        observations, hidden_states = calibration
+        if len(observations) > self.max_calibration_samples:
+            samples = torch.randperm(len(observations))[:self.max_calibration_samples]
+            observations, hidden_states = observations[samples], hidden_states[samples]
+        self.calibration = (observations.cpu(), hidden_states.cpu())
+
+    def _build_module(self) -> nn.Module:
+        if self.mode == "dynamic":
+            return quantize_dynamic(self.policy, {nn.Linear}, dtype=torch.qint8)
+
+        observations, hidden_states = self.calibration
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        prepared = prepare_fx(copy.deepcopy(self.policy), qconfig_mapping, example_inputs=(observations[:1], hidden_states[:1]))
+
+        # the observers record the activation ranges
+        with torch.no_grad():
+            for start in range(0, len(observations), 64):
+                prepared(observations[start:start + 64], hidden_states[start:start + 64])
+        return convert_fx(prepared)
+
+    def sync(self, agent: nn.Module, calibration: tuple = None):
+        """Loads the learner's weights and requantizes, on the new `calibration` batch if given."""
+
+        super().sync(agent)
+        if calibration is not None:
+            self._set_calibration(calibration)
+        self.module = self._build_module()
+
+    @torch.no_grad()
+    def divergence(self, observations: torch.Tensor = None, hidden_states: torch.Tensor = None) -> dict:
+        """How the int8 action distributions differ from the fp32 ones, on the given batch (the calibration batch
+        if None): the mean and max KL(fp32 || int8) and how often both have the same most likely action.
+        """
+
+        if observations is None:
+            observations, hidden_states = self.calibration
+        observations, hidden_states = observations.cpu(), hidden_states.cpu()
+
+        # the action head ends in a sigmoid, `Categorical` normalizes its outputs the same way
+        fp32_probs = self.policy(observations, hidden_states)[0]
+        int8_probs = self.module(observations, hidden_states)[0]
+        fp32_probs = fp32_probs / fp32_probs.sum(dim=1, keepdim=True)
+        int8_probs = int8_probs / int8_probs.sum(dim=1, keepdim=True)
+
+        kl = (fp32_probs * (fp32_probs.clamp(min=1e-8).log() - int8_probs.clamp(min=1e-8).log())).sum(dim=1)
+        return {
+            "kl_mean": kl.mean().item(),
+            "kl_max": kl.max().item(),
+            "argmax_agreement": (fp32_probs.argmax(dim=1) == int8_probs.argmax(dim=1)).float().mean().item(),
+        }
@@ -0,0 +1,96 @@
+"""Preallocated (T, N) rollout storage, so the agent can be updated once per T env steps on T * N samples
+instead of once per step on N, plus the discounted return / GAE passes over it.
+"""
+
+import torch
+
+
+def compute_returns(rewards: torch.Tensor, dones: torch.Tensor, gamma: float, last_value: torch.Tensor = None) -> torch.Tensor:
+    """Discounted returns of (T, N) rewards, `dones[t]` ends the episode after step t. The return after the
+    last step is `last_value` (zeros if None, i.e. no bootstrapping).
+    """
+
+    return compute_gae(rewards, torch.zeros_like(rewards), dones, gamma, gae_lambda=1.0, last_value=last_value)
+
+
+def compute_gae(
+    rewards: torch.Tensor, values: torch.Tensor, dones: torch.Tensor, gamma: float, gae_lambda: float,
+    last_value: torch.Tensor = None,
+) -> torch.Tensor:
+    """Generalized advantage estimates (Schulman et al. 2015) of (T, N) rewards given the (T, N) value estimates
+    of the steps. One backward pass over T, every step is vectorized over the envs.
+    """
+
+    num_steps = rewards.size(0)
+    not_dones = 1.0 - dones.float()
+    next_values = torch.zeros_like(rewards)
+    next_values[:-1] = values[1:]
+    if last_value is not None:
+        next_values[-1] = last_value
+
+    # all the one-step TD errors at once, only the discounted sum needs the scan
+    td_errors = rewards + gamma * next_values * not_dones - values
+    decays = gamma * gae_lambda * not_dones
+
+    advantages = torch.empty_like(rewards)
+    advantage = torch.zeros_like(rewards[0])
+    for t in reversed(range(num_steps)):
+        advantage = td_errors[t] + decays[t] * advantage
+        advantages[t] = advantage
+    return advantages
+
+
+class RolloutBuffer:
+    """T steps of N envs: the observations, the hidden states the actions were taken from (so the recurrent
+    agent can recompute the action distributions of any subset of samples later), the actions with their
+    log probs at acting time, and the rewards and dones that came back.
+
+    Call `add` right after acting and `add_outcome` once the envs were stepped, `full` tells when the
+    rollout is ready for an update.
+    """
+
+    def __init__(self, num_steps: int, num_envs: int, obs_shape: tuple, hidden_size: int, device=None, obs_dtype=torch.uint8):
+        self.num_steps = num_steps
+        self.num_envs = num_envs
+        self.device = device
+
+        self.observations = torch.zeros((num_steps, num_envs, *obs_shape), dtype=obs_dtype, device=device)
+        self.hidden_states = torch.zeros((num_steps, num_envs, hidden_size), dtype=torch.float32, device=device)
+        self.actions = torch.zeros((num_steps, num_envs), dtype=torch.int64, device=device)
+        self.log_probs = torch.zeros((num_steps, num_envs), dtype=torch.float32, device=device)
+        self.rewards = torch.zeros((num_steps, num_envs), dtype=torch.float32, device=device)
+        self.dones = torch.zeros((num_steps, num_envs), dtype=torch.bool, device=device)
+
+        self.step = 0
+
+    @property
+    def full(self) -> bool:
+        return self.step == self.num_steps
+
+    def add(self, observations: torch.Tensor, hidden_states: torch.Tensor, actions: torch.Tensor, log_probs: torch.Tensor = None):
+        """`log_probs` can be left out if the learner fills them in itself (e.g. an inference-only actor)."""
+
+        self.observations[self.step] = observations
+        self.hidden_states[self.step] = hidden_states
+        self.actions[self.step] = actions
+        if log_probs is not None:
+            self.log_probs[self.step] = log_probs
+
+    def add_outcome(self, rewards: torch.Tensor, dones: torch.Tensor):
+        self.rewards[self.step] = rewards
+        self.dones[self.step] = dones
+        self.step += 1
+
+    def reset(self):
+        self.step = 0
+
+    def minibatches(self, num_minibatches: int, generator: torch.Generator = None):
+        """Shuffled indices into the flattened T * N samples, split into `num_minibatches` parts."""
+
+        num_samples = self.num_steps * self.num_envs
+        permutation = torch.randperm(num_samples, generator=generator).to(self.device)
+        return permutation.chunk(num_minibatches)
+
+    def flat(self, tensor: torch.Tensor) -> torch.Tensor:
+        """A (T, N, ...) tensor of the buffer as (T * N, ...)."""
+        return tensor.reshape(self.num_steps * self.num_envs, *tensor.shape[2:])
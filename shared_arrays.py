@@ -0,0 +1,50 @@
+"""Numpy arrays backed by named shared memory blocks, for handing big buffers to worker processes.
+
+Kept free of any heavy imports, every spawned worker imports this.
+"""
+
+import sys
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def create_shared_array(shape: tuple, dtype) -> tuple:
+    """Allocates a zeroed numpy array backed by a named shared memory block.
+    Returns the block (the caller owns it and must unlink it) and the array view.
+    """
+
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.fill(0)
+    return shm, array
+
+
+def attach_shared_array(spec: tuple) -> tuple:
+    """Attaches to a block made by `create_shared_array`. `spec` is (name, shape, dtype)."""
+
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return shm, array
+
+
+@contextmanager
+def lightweight_spawn():
+    """spawn runs the script that started the run again in every child, in case the process target or its
+    arguments live in it. Processes started inside this block don't: the script is hidden while they start,
+    so they only import the module of their target and skip the trainer's imports (torch, wandb, ...).
+    """
+
+    main_module = sys.modules["__main__"]
+    main_spec = getattr(main_module, "__spec__", None)
+    main_file = main_module.__dict__.pop("__file__", None)
+    main_module.__spec__ = None
+    try:
+        yield
+    finally:
+        main_module.__spec__ = main_spec
+        if main_file is not None:
+            main_module.__file__ = main_file
@@ -1,20 +1,27 @@
-from interactor import DoomInteractor
-from video import VideoTensorStorage
+import time
+STARTUP_TIME = time.perf_counter()  # the time to first step counts from here, imports included
 
-from custom_doom import VizDoomRewardFeatures
+from interactor import DoomInteractor
+from video import VideoTensorStorage, HighlightRecorder
+from frame_store import FrameStore, CODECS
+from rollout import RolloutBuffer, compute_returns
+from inference import BACKENDS as INFERENCE_BACKENDS, InferenceEngine
+from quantization import QUANTIZATION_MODES, QuantizedEngine, calibration_from_recording
+from metrics import MetricsAggregator, StdoutSink, WandbSink, JsonlSink, ParquetSink
+from profiler import profiler
+
+from custom_doom import FEATURE_INDEX, SCREEN_FORMATS, RewardSpec
+from env_worker import ScreenPreprocessor, ResetPoolSpec
 from typing import List
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 from gymnasium.spaces import Discrete
 
 import torch
 from torch import nn
 
-import wandb
-
 import os
-import cv2
 import numpy as np
 import csv
 
@@ -27,17 +34,16 @@ def symlog_torch(x):
     return torch.sign(x) * torch.log(1 + torch.abs(x))
 
 
+IMAGE_CHANNELS = (1, 3)  # grayscale or RGB
+
+
 def _is_channel_first(shape: tuple) -> bool:
-    assert 3 in shape, f"Image shape should have a 3 channel dimension, got {shape}"
-
-    if len(shape) == 4:
-        # check NCHW
-        return shape[1] == 3
-    elif len(shape) == 3:
-        # check CHW
-        return shape[0] == 3
-    else:
+    if len(shape) not in (3, 4):
         raise ValueError(f"Invalid shape: {shape}")
+
+    # HWC/NHWC screens end in their 1 or 3 channels, (N)CHW ones end in the width. checking the
+    # width side keeps this working for frame stacks, which have K * channels channels.
+    return shape[-1] not in IMAGE_CHANNELS
     
 
 def multi_sample_argmax(dist: torch.distributions.Distribution, k: int = 3):
@@ -71,15 +77,19 @@ class Agent(torch.nn.Module):
 
         self.hidden_channels = hidden_channels
         self.embedding_size = embedding_size
+        # gymnasium's Discrete.n is a numpy int, which TorchScript doesn't take as a layer size
+        num_discrete_actions = int(num_discrete_actions)
 
-        if not _is_channel_first(obs_shape):
+        # HWC observations get permuted to CHW on the way in
+        self.channel_first = _is_channel_first(obs_shape)
+        if not self.channel_first:
             obs_shape = (obs_shape[-1], *obs_shape[:-1])
 
 
         # 1. Observation Embedding: Convolutions + AdaptiveAvgPool + Flatten
         self.obs_embedding = nn.Sequential(
             torch.nn.LayerNorm(obs_shape),
-            nn.Conv2d(in_channels=3, out_channels=hidden_channels, kernel_size=7, stride=3),
+            nn.Conv2d(in_channels=obs_shape[0], out_channels=hidden_channels, kernel_size=7, stride=3),
             nn.ReLU(),
             nn.Conv2d(in_channels=hidden_channels, out_channels=hidden_channels, kernel_size=4, stride=2),
             nn.ReLU(),
@@ -102,6 +112,9 @@ class Agent(torch.nn.Module):
 
         # Initialize hidden state to None; it will be dynamically set later
         self.hidden_state = None
+
+        # per-env hidden states for the async (split-batch) mode, see `init_hidden_table`
+        self.hidden_table = None
         
         # 2. Embedding Blender: Combine the observation embedding and hidden state
         self.embedding_blender = nn.Sequential(
@@ -123,8 +136,19 @@ class Agent(torch.nn.Module):
             nn.Sigmoid()
         )
 
-    def reset(self, reset_mask: torch.Tensor):
+    def init_hidden_table(self, num_envs: int, device=None):
+        """Allocates a per-env hidden state table. Once set, `forward`/`reset` calls that pass `env_ids`
+        read and write the rows for those envs only, so groups of envs can be stepped independently.
+        """
+        self.hidden_table = torch.zeros(num_envs, self.embedding_size, device=device)
+
+    def reset(self, reset_mask: torch.Tensor, env_ids: torch.Tensor = None):
         """Resets hidden states for the agent based on the reset mask."""
+
+        if env_ids is not None:
+            self.hidden_table[env_ids[reset_mask.to(env_ids.device) == 1]] = 0
+            return
+
         batch_size = reset_mask.size(0)
         # Initialize hidden state to zeros where the reset mask is 1
         if self.hidden_state is None:
@@ -133,17 +157,12 @@ class Agent(torch.nn.Module):
         # Reset hidden states for entries where reset_mask is True (done flags)
         self.hidden_state[reset_mask == 1] = 0
 
-    def forward(self, observations: torch.Tensor):
+    def embed(self, observations: torch.Tensor) -> torch.Tensor:
+        """The (B, embedding_size) observation embeddings, independent of the hidden state."""
+
         if not _is_channel_first(observations.shape):
             # need to make it NCHW
             observations = observations.float().permute(0, 3, 1, 2)
-        
-        # Get batch size to handle hidden state initialization if needed
-        batch_size = observations.size(0)
-
-        # Initialize hidden state if it's the first forward pass
-        if self.hidden_state is None or self.hidden_state.size(0) != batch_size:
-            self.hidden_state = torch.zeros(batch_size, self.embedding_size, device=observations.device)
 
         # 1. Get the observation embedding
         obs_embedding = self.obs_embedding(observations)
@@ -151,20 +170,86 @@ class Agent(torch.nn.Module):
         # average across all channels
         obs_embedding = obs_embedding.mean(dim=(2, 3))
         # print(obs_embedding.shape, "obs emb shape after avg")
-        obs_embedding = self.embedding_head(obs_embedding)
-
-        # Detach the hidden state from the computation graph (to avoid gradient tracking)
-        hidden_state = self.hidden_state.detach()
+        return self.embedding_head(obs_embedding)
 
+    def blend_embedding(self, obs_embedding: torch.Tensor, hidden_state: torch.Tensor) -> torch.Tensor:
         # 2. Concatenate the observation embedding with the hidden state
         combined_embedding = torch.cat((obs_embedding, hidden_state), dim=1)
 
         # 3. Blend embeddings
-        blended_embedding = self.embedding_blender(combined_embedding)
+        return self.embedding_blender(combined_embedding)
+
+    def blend(self, observations: torch.Tensor, hidden_state: torch.Tensor) -> torch.Tensor:
+        """Embeds the observations and blends them with `hidden_state`. Doesn't touch any stored state."""
+        return self.blend_embedding(self.embed(observations), hidden_state)
+
+    @staticmethod
+    def next_hidden_state(blended_embedding: torch.Tensor, actions: torch.Tensor) -> torch.Tensor:
+        """The hidden state after a step: the blended embedding without gradients, with the action taken in its last unit."""
 
-        # Update the hidden state for the next timestep without storing gradients
         # Ensure we do not modify inplace - create a new tensor
-        self.hidden_state = blended_embedding.detach().clone()
+        next_hidden_state = blended_embedding.detach().clone()
+
+        # HACK: maybe we need a more general way to do this, but store
+        # the previous action in the hidden state
+        next_hidden_state[:, -1] = actions
+        return next_hidden_state
+
+    def forward_sequence(
+        self, observations: torch.Tensor, actions: torch.Tensor, resets: torch.Tensor, hidden_state: torch.Tensor = None,
+    ) -> tuple:
+        """Runs (T, N) observations through the agent at once, feeding the (T, N) `actions` that were taken back
+        into the hidden state. `resets[t]` zeroes an env's hidden state before step t (it starts an episode),
+        `hidden_state` is the (N, embedding_size) state before the first step (zeros if None).
+
+        The conv trunk sees all T * N frames in one batch, only the blender is scanned over T. Gives the same
+        distributions as stepping `forward` through the sequence with `reset` calls in between.
+        Returns the (T, N) action distribution and the hidden state after the last step.
+        """
+
+        seq_len, num_envs = actions.shape
+        obs_embeddings = self.embed(observations.reshape(seq_len * num_envs, *observations.shape[2:]))
+        obs_embeddings = obs_embeddings.view(seq_len, num_envs, -1)
+
+        if hidden_state is None:
+            hidden_state = torch.zeros(num_envs, self.embedding_size, device=obs_embeddings.device)
+
+        # the action head stays inside the scan: it's as cheap as the blender, and running it on the same
+        # (N, embedding_size) batches as `forward` keeps the results bit for bit identical
+        action_logits = []
+        for t in range(seq_len):
+            hidden_state = hidden_state.masked_fill(resets[t].unsqueeze(1), 0)
+            blended_embedding = self.blend_embedding(obs_embeddings[t], hidden_state)
+            action_logits.append(self.action_head(blended_embedding))
+            hidden_state = self.next_hidden_state(blended_embedding, actions[t])
+
+        return self.get_distribution(torch.stack(action_logits)), hidden_state
+
+    def get_hidden_state(self, batch_size: int, device, env_ids: torch.Tensor = None) -> torch.Tensor:
+        """The hidden state the next `forward` call will see (detached)."""
+
+        if env_ids is not None:
+            return self.hidden_table[env_ids].detach()
+
+        # Initialize hidden state if it's the first forward pass
+        if self.hidden_state is None or self.hidden_state.size(0) != batch_size:
+            self.hidden_state = torch.zeros(batch_size, self.embedding_size, device=device)
+
+        # Detach the hidden state from the computation graph (to avoid gradient tracking)
+        return self.hidden_state.detach()
+
+    def distribution_from_hidden(self, observations: torch.Tensor, hidden_state: torch.Tensor) -> torch.distributions.Categorical:
+        """Recomputes the action distribution for a step given the hidden state it was taken from."""
+
+        blended_embedding = self.blend(observations, hidden_state)
+        return self.get_distribution(self.action_head(blended_embedding))
+
+    def forward(self, observations: torch.Tensor, env_ids: torch.Tensor = None):
+        # Get batch size to handle hidden state initialization if needed
+        batch_size = observations.size(0)
+
+        hidden_state = self.get_hidden_state(batch_size, observations.device, env_ids=env_ids)
+        blended_embedding = self.blend(observations, hidden_state)
 
         # 4. Compute action logits
         action_logits = self.action_head(blended_embedding)
@@ -175,9 +260,13 @@ class Agent(torch.nn.Module):
         # NOTE: for some reason, increasing k here makes the agent seem more timid almost lol
         actions = multi_sample_argmax(dist, k=3)
 
-        # HACK: maybe we need a more general way to do this, but store
-        # the previous action in the hidden state
-        self.hidden_state[:, -1] = actions
+        # Update the hidden state for the next timestep without storing gradients
+        next_hidden_state = self.next_hidden_state(blended_embedding, actions)
+
+        if env_ids is not None:
+            self.hidden_table[env_ids] = next_hidden_state
+        else:
+            self.hidden_state = next_hidden_state
 
         return actions, dist
 
@@ -196,16 +285,87 @@ def timestamp_name():
     return datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
 
+def frame_skip_entry(value: str) -> tuple:
+    """`N` (any env id) or `ENV_ID=N`, as (env id or None, tics)."""
+
+    env_id, _, tics = value.rpartition("=")
+    try:
+        return env_id or None, int(tics)
+    except ValueError:
+        raise ArgumentTypeError(f"expected N or ENV_ID=N, got {value}")
+
+
 def mini_cli():
     parser = ArgumentParser()
     parser.add_argument("--use-wandb", action="store_true", default=False)
     parser.add_argument("--watch", action="store_true", default=False)
     parser.add_argument("--save", action="store_true", default=False)
-    return parser.parse_args()
+    parser.add_argument("--env-backend", choices=["serial", "thread", "subproc"], default="serial", help="How the envs are stepped.")
+    parser.add_argument("--num-workers", type=int, default=None, help="Number of env worker threads/processes for the thread and subproc backends (defaults to the cpu count).")
+    parser.add_argument("--reward-spec", type=str, default=None, help="Path to a json reward spec (see custom_doom.RewardSpec), defaults to the built-in weights.")
+    parser.add_argument("--frame-skip", type=frame_skip_entry, nargs="+", default=None, help="Tics every action is repeated for: N, or ENV_ID=N entries (the ids not listed step 1 tic). Defaults to 1.")
+    parser.add_argument("--screen-format", choices=SCREEN_FORMATS, default="RGB24", help="ViZDoom screen buffer format, CRCGCB and GRAY8 are fed to the agent channel-first without a permute.")
+    parser.add_argument("--screen-resolution", type=str, default=None, help="ViZDoom screen resolution, e.g. 160X120 (defaults to the scenario's).")
+    parser.add_argument("--frame-stack", type=int, default=1, help="Number of past frames the agent sees at once (needs a channel-first --screen-format).")
+    parser.add_argument("--obs-resolution", type=int, nargs=2, default=None, metavar=("HEIGHT", "WIDTH"), help="Resize the screens to this resolution on the env workers.")
+    parser.add_argument("--grayscale", action="store_true", default=False, help="Train on single channel grayscale screens.")
+    parser.add_argument("--hud-crop", type=int, default=0, help="Number of pixel rows cut off the bottom of the screen (the HUD) before resizing.")
+    parser.add_argument("--video-storage", choices=["mp4", "frames"], default="mp4", help="Record grid mp4s, or every env's frames losslessly (frame_store.FrameStore).")
+    parser.add_argument("--frame-codec", choices=CODECS, default="zlib", help="Compression of the lossless frame store.")
+    parser.add_argument("--export-grid-video", action="store_true", default=False, help="With --video-storage frames, export a grid mp4 from the store at the end of the run.")
+    parser.add_argument("--highlight-mb", type=int, default=0, help="Memory cap (MB) of the in-memory highlight clip recorder, 0 disables highlight clips.")
+    parser.add_argument("--background-video", action="store_true", default=False, help="Encode the training videos in a separate process.")
+    parser.add_argument("--video-queue-size", type=int, default=8, help="Frames that can wait for the background video encoder.")
+    parser.add_argument("--video-drop-frames", action="store_true", default=False, help="Drop video frames instead of waiting when the background encoder falls behind.")
+    parser.add_argument("--reset-pool", type=int, default=0, help="Spare games per env process kept reset in the background, done envs swap one in instead of restarting the map (see env_worker.ResetPool).")
+    parser.add_argument("--snapshot-every", type=int, default=0, help="With --reset-pool, mean steps between mid-episode snapshots (ViZDoom savegames) of every env, 0 always starts at the map start. A snapshot costs about as much as a reset, on the stepping path.")
+    parser.add_argument("--snapshot-restore-prob", type=float, default=0.5, help="Chance that a spare starts from a random mid-episode snapshot instead of the map start.")
+    parser.add_argument("--async-envs", action="store_true", default=False, help="Overlap env stepping with agent inference by stepping the backend's worker groups independently.")
+    parser.add_argument("--record-trajectories", action="store_true", default=False, help="Stream every transition to trajectory shards in the run folder (see trajectory.py).")
+    parser.add_argument("--trajectory-shard-steps", type=int, default=1024, help="Vectorized steps per trajectory shard.")
+    parser.add_argument("--trajectory-frame-delta", action="store_true", default=False, help="Delta-encode and compress the recorded observations (smaller, but not memory-mappable).")
+    parser.add_argument("--rollout-steps", type=int, default=1, help="Env steps collected per update, 1 updates the agent after every step.")
+    parser.add_argument("--update-epochs", type=int, default=1, help="Passes over every rollout (with --rollout-steps > 1).")
+    parser.add_argument("--minibatches", type=int, default=1, help="Gradient steps per pass over a rollout (with --rollout-steps > 1).")
+    parser.add_argument("--gamma", type=float, default=None, help="Train on the discounted returns of the rollout instead of the instantaneous scores (with --rollout-steps > 1).")
+    parser.add_argument("--clip-coef", type=float, default=0.2, help="Clipping of the importance ratio once a rollout's samples are reused (see --update-epochs/--minibatches).")
+    parser.add_argument("--actor-engine", choices=INFERENCE_BACKENDS, default=None, help="Act with an inference-only copy of the agent (see inference.py), the learner recomputes the log probs (needs --rollout-steps > 1).")
+    parser.add_argument("--quantized-actor", choices=QUANTIZATION_MODES, default=None, help="Act with an int8 copy of the agent on the CPU (see quantization.py, needs --rollout-steps > 1).")
+    parser.add_argument("--quantize-every", type=int, default=10, help="Updates between refreshes of the quantized actor from the learner's weights.")
+    parser.add_argument("--quantize-calibration", type=str, default=None, help="Trajectory recording to calibrate the first static quantization on (defaults to the first observations).")
+    parser.add_argument("--log-every", type=int, default=10, help="Steps the metrics are aggregated over before they're printed/logged.")
+    parser.add_argument("--metrics-jsonl", type=str, default=None, help="Also append the metrics to this JSONL file (works offline).")
+    parser.add_argument("--metrics-parquet", type=str, default=None, help="Also write the metrics as Parquet files into this folder (needs pyarrow).")
+    parser.add_argument("--no-profile", action="store_true", default=False, help="Turn off the per-phase timing scopes (see profiler.py) and their metrics.")
+    parser.add_argument("--profile-trace", type=str, default=None, help="Write a Chrome trace / Perfetto JSON of the last --profile-trace-steps steps here at the end of the run, and whenever the process gets SIGUSR1.")
+    parser.add_argument("--profile-trace-steps", type=int, default=200, help="Steps the profiler trace covers.")
+    args = parser.parse_args()
+    if args.frame_skip is not None:
+        env_ids = [env_id for env_id, _ in args.frame_skip]
+        if env_ids == [None]:
+            args.frame_skip = args.frame_skip[0][1]
+        elif None in env_ids:
+            parser.error("--frame-skip takes either a single N or ENV_ID=N entries")
+        else:
+            args.frame_skip = dict(args.frame_skip)
+    if (args.actor_engine is not None or args.quantized_actor is not None) and args.rollout_steps <= 1:
+        parser.error("--actor-engine and --quantized-actor need --rollout-steps > 1, the per-step update learns on the acting graph")
+    if args.actor_engine is not None and args.quantized_actor is not None:
+        parser.error("--actor-engine and --quantized-actor are two different actors, pick one")
+    if args.rollout_steps > 1 and args.async_envs:
+        parser.error("--rollout-steps > 1 isn't supported with --async-envs")
+    if args.record_trajectories and args.async_envs:
+        parser.error("--record-trajectories records whole vectorized steps, it can't be combined with --async-envs")
+    return args
 
 
 if __name__ == "__main__":
     args = mini_cli()
+    imports_sec = time.perf_counter() - STARTUP_TIME
+
+    if args.use_wandb:
+        # only imported when it's used, it takes longer to import than torch
+        import wandb
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -238,41 +398,74 @@ if __name__ == "__main__":
     else:
         watch_path = None
 
-    interactor = DoomInteractor(NUM_ENVS, watch=args.watch, watch_video_path=watch_path, env_id=ENV_ID)
+    # the envs finish booting in the background, the first reset waits for them
+    interactor_start = time.perf_counter()
+    interactor = DoomInteractor(
+        NUM_ENVS, watch=args.watch, watch_video_path=watch_path, env_id=ENV_ID,
+        backend=args.env_backend, num_workers=args.num_workers,
+        reward_spec=RewardSpec.from_json(args.reward_spec) if args.reward_spec else None,
+        frame_skip=args.frame_skip,
+        preprocess=ScreenPreprocessor(
+            resolution=tuple(args.obs_resolution) if args.obs_resolution else None,
+            grayscale=args.grayscale,
+            crop=(0, args.hud_crop, 0, 0),
+        ),
+        screen_format=args.screen_format,
+        screen_resolution=args.screen_resolution,
+        frame_stack=args.frame_stack,
+        record_path=os.path.join(video_path, "trajectories") if args.record_trajectories else None,
+        record_shard_steps=args.trajectory_shard_steps,
+        record_frame_delta=args.trajectory_frame_delta,
+        reset_pool=ResetPoolSpec(
+            size=args.reset_pool, snapshot_every=args.snapshot_every, restore_prob=args.snapshot_restore_prob,
+        ) if args.reset_pool > 0 else None,
+    )
+    interactor_sec = time.perf_counter() - interactor_start
 
     assert isinstance(interactor.single_action_space, Discrete), f"Expected Discrete action space, got {interactor.single_action_space}"
     
-    # remove the 3 from the shape
-    _obs_shape = interactor.env.obs_shape
-    _obs_shape = tuple([x for x in _obs_shape if x != 3])
-    assert len(_obs_shape) == 2, "Observation shape should be 2D after removing the channel dimension"
-    FRAME_HEIGHT, FRAME_WIDTH = _obs_shape
-
-    video_storage = VideoTensorStorage(
-        folder=video_path,
-        max_video_frames=MAX_VIDEO_FRAMES, grid_size=GRID_SIZE,
-        frame_height=FRAME_HEIGHT, frame_width=FRAME_WIDTH, num_envs=NUM_ENVS
-    )
-
-    agent = Agent(obs_shape=interactor.env.obs_shape, num_discrete_actions=interactor.single_action_space.n)
-    agent = agent.to(device)
-    print(agent.num_params)
+    # the (preprocessed) screens are CHW for the channel-first screen formats, HWC otherwise
+    CHANNEL_FIRST = interactor.env.preprocess.channel_first
+    if CHANNEL_FIRST:
+        NUM_CHANNELS, FRAME_HEIGHT, FRAME_WIDTH = interactor.env.obs_shape
+    else:
+        FRAME_HEIGHT, FRAME_WIDTH, NUM_CHANNELS = interactor.env.obs_shape
 
-    # Reset all environments
-    observations = interactor.reset()
+    if args.video_storage == "frames":
+        video_storage = FrameStore(
+            folder=video_path, num_envs=NUM_ENVS, frame_shape=interactor.env.obs_shape,
+            channel_first=CHANNEL_FIRST, codec=args.frame_codec,
+        )
+    else:
+        video_storage = VideoTensorStorage(
+            folder=video_path,
+            max_video_frames=MAX_VIDEO_FRAMES, grid_size=GRID_SIZE,
+            frame_height=FRAME_HEIGHT, frame_width=FRAME_WIDTH, num_envs=NUM_ENVS,
+            num_channels=NUM_CHANNELS, channel_first=CHANNEL_FIRST,
+            background=args.background_video, queue_size=args.video_queue_size, drop_frames=args.video_drop_frames,
+        )
 
-    cumulative_rewards_no_reset = torch.zeros((NUM_ENVS,))
-    step_counters = torch.zeros((NUM_ENVS,), dtype=torch.float32)
+    # only the metrics writer thread calls `wandb.log`, other threads attach to its next record
+    wandb_sink = WandbSink() if args.use_wandb else None
 
-    optimizer = torch.optim.Adam(agent.parameters(), lr=LR)
+    # clips of new best episodes, cut from memory and written in the background
+    highlights = None
+    if args.highlight_mb > 0:
+        def log_highlight(path: str):
+            print(f"Wrote highlight {path}")
+            if wandb_sink is not None:
+                wandb_sink.attach("best_episode_video", wandb.Video(path, format="mp4"))
 
-    best_episode_cumulative_reward = -float("inf")
-    best_episode_env = None
-    best_episode = None
+        highlights = HighlightRecorder(
+            NUM_ENVS, interactor.env.obs_shape, max_bytes=args.highlight_mb * 1024 * 1024,
+            channel_first=CHANNEL_FIRST, on_written=log_highlight,
+        )
 
-    BATCH_NORM_REWARDS = False
+    agent = Agent(obs_shape=interactor.obs_shape, num_discrete_actions=interactor.single_action_space.n)
+    agent = agent.to(device)
+    print(agent.num_params)
 
-    # Initialize wandb project
+    # Initialize wandb project (before the first reset, so it overlaps with the envs booting)
     if args.use_wandb:
         wandb.init(project=f"doom-rl-{ENV_ID}", config={
             "num_parameters": agent.num_params,
@@ -280,159 +473,373 @@ if __name__ == "__main__":
             "num_envs": NUM_ENVS,
             "lr": LR,
             "norm_with_reward_counter": NORM_WITH_REWARD_COUNTER,
-            "obs_shape": interactor.env.obs_shape,
+            "obs_shape": interactor.obs_shape,
+            "frame_stack": args.frame_stack,
             "num_discrete_actions": interactor.single_action_space.n,
             "env_id": ENV_ID,
+            "frame_skip": interactor.env.frame_skip,
+            "screen_format": args.screen_format,
+            "rollout_steps": args.rollout_steps,
+            "update_epochs": args.update_epochs,
+            "minibatches": args.minibatches,
+            "gamma": args.gamma,
             "agent": agent,
         })
         wandb.watch(agent)
 
-    num_kills_all_time = 0
-    damage_taken_all_time = 0
-    secrets_found_all_time = 0
-    death_count_all_time = 0
+    # Reset all environments
+    reset_start = time.perf_counter()
+    observations = interactor.reset()
+    reset_sec = time.perf_counter() - reset_start
 
-    try:
+    cumulative_rewards_no_reset = torch.zeros((NUM_ENVS,))
+    step_counters = torch.zeros((NUM_ENVS,), dtype=torch.float32)
 
-        # Example of stepping through the environments
-        for step_i in range(VSTEPS):
-            optimizer.zero_grad()
+    optimizer = torch.optim.Adam(agent.parameters(), lr=LR)
 
-            actions, dist = agent.forward(observations.float().to(device))
+    best_episode_cumulative_reward = -float("inf")
+    best_episode_env = None
+    best_episode = None
+
+    BATCH_NORM_REWARDS = False
 
-            assert actions.shape == (NUM_ENVS,)
+    # batched updates: the agent acts for `--rollout-steps` steps, then learns on all of them at once
+    rollout = None
+    if args.rollout_steps > 1:
+        rollout = RolloutBuffer(args.rollout_steps, NUM_ENVS, interactor.obs_shape, agent.embedding_size, device=device)
+
+    # acting without autograd or distribution objects, synced with the agent after every update
+    engine = None
+    if args.actor_engine is not None:
+        engine = InferenceEngine(agent, backend=args.actor_engine)
+    elif args.quantized_actor is not None:
+        # later refreshes recalibrate on the latest rollout
+        if args.quantize_calibration is not None:
+            calibration = calibration_from_recording(agent, args.quantize_calibration)
+        else:
+            calibration = (observations.clone(), agent.get_hidden_state(NUM_ENVS, device).cpu())
+        engine = QuantizedEngine(agent, mode=args.quantized_actor, calibration=calibration)
+    num_updates = 0
+
+    # aggregated every --log-every steps and written out on a background thread
+    metric_sinks = [StdoutSink()]
+    if wandb_sink is not None:
+        metric_sinks.append(wandb_sink)
+    if args.metrics_jsonl is not None:
+        metric_sinks.append(JsonlSink(args.metrics_jsonl))
+    if args.metrics_parquet is not None:
+        metric_sinks.append(ParquetSink(args.metrics_parquet))
+    # per-phase timing percentiles and steps/sec go into every flush
+    profiler.enabled = not args.no_profile
+    if args.profile_trace is not None:
+        profiler.dump_on_signal(args.profile_trace, last_steps=args.profile_trace_steps)
+    metrics = MetricsAggregator(metric_sinks, flush_every=args.log_every, collectors=[profiler.summary])
+
+    def get_scores(rewards, cumulative_rewards, step_counters):
+        if TRAIN_ON_CUMULATIVE_REWARDS:
+            # cumulative rewards
+            if NORM_WITH_REWARD_COUNTER:
+                scores = cumulative_rewards / (step_counters + 1)
+            else:
+                scores = cumulative_rewards
+        else:
+            # instantaneous rewards
+            scores = rewards
+
+        if BATCH_NORM_REWARDS:
+            scores = (scores - scores.mean()) / (scores.std() + 1e-8)
+
+        # specifically symlog after normalizing scores
+        # scores = symlog_torch(scores)
+        return scores
+
+    def update_from_rollout():
+        """`--update-epochs` passes of `--minibatches` gradient steps over the full rollout. The log probs are
+        recomputed from the stored hidden states, and once a sample is reused its importance ratio to the
+        acting policy is clipped (the first gradient step is the same as the per-step update's).
+        """
+
+        scores = rollout.rewards if args.gamma is None else compute_returns(rollout.rewards, rollout.dones, args.gamma)
+
+        flat_observations = rollout.flat(rollout.observations)
+        flat_hidden_states = rollout.flat(rollout.hidden_states)
+        flat_actions = rollout.flat(rollout.actions)
+        flat_log_probs = rollout.flat(rollout.log_probs)
+        flat_scores = rollout.flat(scores)
+
+        if engine is not None:
+            # the engine only picked the actions, the learner's log probs of them (before this update) stand in for the acting ones
+            with torch.no_grad():
+                dist = agent.distribution_from_hidden(flat_observations.float(), flat_hidden_states)
+                flat_log_probs.copy_(dist.log_prob(flat_actions))
+                rollout_entropy = dist.entropy()
+
+        for _ in range(args.update_epochs):
+            for indices in rollout.minibatches(args.minibatches):
+                dist = agent.distribution_from_hidden(flat_observations[indices].float(), flat_hidden_states[indices])
+                ratio = (dist.log_prob(flat_actions[indices]) - flat_log_probs[indices]).exp()
+                minibatch_scores = flat_scores[indices]
+                clipped_ratio = ratio.clamp(1 - args.clip_coef, 1 + args.clip_coef)
+                update_loss = -torch.min(ratio * minibatch_scores, clipped_ratio * minibatch_scores).mean()
+
+                optimizer.zero_grad()
+                with profiler.scope("agent/backward"):
+                    update_loss.backward()
+                with profiler.scope("agent/optimizer"):
+                    optimizer.step()
+
+        global num_updates
+        num_updates += 1
+
+        rollout.reset()
+        if isinstance(engine, QuantizedEngine):
+            # requantizing costs a calibration pass, so the int8 actor lags the learner by a few updates
+            if num_updates % args.quantize_every == 0:
+                with profiler.scope("agent/quantize"):
+                    engine.sync(agent, calibration=(flat_observations, flat_hidden_states))
+                divergence = engine.divergence()
+                print(f"Quantized actor refreshed, KL {divergence['kl_mean']:.2e} (max {divergence['kl_max']:.2e}), argmax agreement {divergence['argmax_agreement']:.3f}")
+                for key, value in divergence.items():
+                    metrics.last(f"quantized_actor/{key}", value)
+        elif engine is not None:
+            engine.sync(agent)
+        if engine is not None:
+            # logged like the per-step values of the other modes
+            entropy[:] = rollout_entropy.view(-1, NUM_ENVS).mean(dim=0)
+            log_probs[:] = flat_log_probs.view(-1, NUM_ENVS).mean(dim=0)
+        return update_loss.detach()
+
+    if args.async_envs:
+        # EnvPool-style split batch: every worker group is stepped on its own, and the agent acts on
+        # whichever group came back first while the others are still simulating. Each env keeps its own
+        # row in the agent's hidden state table.
+        assert len(interactor.groups) > 1, "--async-envs needs the thread or subproc backend with more than one worker"
+
+        agent.init_hidden_table(NUM_ENVS, device=device)
+        group_env_ids = [torch.tensor(group, device=device) for group in interactor.groups]
+
+        # group index -> (weights, actions, action distribution) of the step the group is currently being stepped with
+        pending_groups = {}
+        # the copy of the agent's weights the acting forwards run on, taken once per optimizer step
+        acting_weights = None
+
+        def act_on_group(group_index: int, group_observations: torch.Tensor):
+            global acting_weights
+            env_ids = group_env_ids[group_index]
+            group_observations = group_observations.float().to(device)
+
+            # the acting forward keeps its graph for the group's update once the rewards come back. the optimizer
+            # steps (in place) while groups are still out, so the graphs are built on a copy of the weights that
+            # it never touches
+            if acting_weights is None:
+                acting_weights = {name: param.detach().clone().requires_grad_() for name, param in agent.named_parameters()}
+            with profiler.scope("agent/forward"):
+                group_actions, dist = torch.func.functional_call(agent, acting_weights, (group_observations,), {"env_ids": env_ids})
+
+            pending_groups[group_index] = (acting_weights, group_actions, dist)
+            interactor.send(group_index, group_actions.cpu().numpy())
+
+        # the backend keeps writing into its own tensors while we work, so keep a separate copy per round
+        observations = observations.clone()
+        rewards = torch.zeros((NUM_ENVS,), dtype=torch.float32)
+        dones = torch.zeros((NUM_ENVS,), dtype=torch.bool)
+        entropy = torch.zeros((NUM_ENVS,), dtype=torch.float32)
+        log_probs = torch.zeros((NUM_ENVS,), dtype=torch.float32)
+        infos = {}
+
+        for group_index, group in enumerate(interactor.groups):
+            act_on_group(group_index, observations[group])
+
+    # the loss of the last update (batched updates don't happen every step)
+    loss = torch.zeros(())
+    if engine is not None:
+        # the engine path only knows these after an update
+        entropy = torch.zeros((NUM_ENVS,), device=device)
+        log_probs = torch.zeros((NUM_ENVS,), device=device)
 
-            entropy = dist.entropy()
-            log_probs = dist.log_prob(actions)
+    try:
 
+        # Example of stepping through the environments
+        for step_i in range(VSTEPS):
             interactor.watch_index = 0 if best_episode_env is None else best_episode_env
 
-            observations, rewards, dones, infos = interactor.step(actions.cpu().numpy())
+            if args.async_envs:
+                # one round receives every group exactly once: a group that is back again before the others only
+                # gets received in the next round (it keeps stepping meanwhile), so every row of the round's
+                # rewards/dones/infos is fresh and none is overwritten before the bookkeeping below reads it.
+                # gradients are accumulated over the groups and applied once per round, so the update sees the
+                # same NUM_ENVS samples as the sync loop.
+                optimizer.zero_grad()
+                loss = 0
+
+                waiting_groups = set(range(len(interactor.groups)))
+                while waiting_groups:
+                    group_index, group_observations, group_rewards, group_dones, group_infos = interactor.recv(waiting_groups)
+                    waiting_groups.discard(group_index)
+                    env_ids = interactor.groups[group_index]
+
+                    observations[env_ids] = group_observations
+                    rewards[env_ids] = group_rewards
+                    dones[env_ids] = group_dones
+                    for key, value in group_infos.items():
+                        if key not in infos:
+                            infos[key] = torch.zeros((NUM_ENVS, *value.shape[1:]), dtype=value.dtype)
+                        infos[key][env_ids] = value
+
+                    # count the number of steps taken (reset if done)
+                    step_counters[env_ids] += 1
+                    step_counters[env_ids] *= 1 - group_dones.float()
+
+                    # learn on the step this group just finished
+                    weights, acted_actions, dist = pending_groups.pop(group_index)
+                    group_log_probs = dist.log_prob(acted_actions)
+
+                    # the scores are computed per group, so BATCH_NORM_REWARDS normalizes within the group
+                    scores = get_scores(group_rewards, interactor.current_episode_cumulative_rewards[env_ids], step_counters[env_ids])
+                    group_loss = (-group_log_probs * scores.to(device)).sum() / NUM_ENVS
+                    with profiler.scope("agent/backward"):
+                        # other groups' graphs can share the copy, so the gradients go onto the agent's weights directly
+                        grads = torch.autograd.grad(group_loss, list(weights.values()), allow_unused=True)
+                        for param, grad in zip(agent.parameters(), grads):
+                            if grad is not None:
+                                param.grad = grad if param.grad is None else param.grad + grad
+
+                    loss += group_loss.detach()
+                    entropy[env_ids] = dist.entropy().detach().cpu()
+                    log_probs[env_ids] = group_log_probs.detach().cpu()
+
+                    # call agent.reset with done flags for hidden state resetting, then send the group right back
+                    agent.reset(group_dones, env_ids=group_env_ids[group_index])
+                    act_on_group(group_index, group_observations)
+
+                with profiler.scope("agent/optimizer"):
+                    optimizer.step()
+                acting_weights = None
+
+            elif rollout is not None:
+                # acting doesn't need a graph, the log probs are recomputed in the update
+                with torch.no_grad(), profiler.scope("agent/forward"):
+                    hidden_state = agent.get_hidden_state(NUM_ENVS, device)
+                    if engine is not None:
+                        # the quantized actor runs on the CPU whatever the learner's device is
+                        actions, next_hidden_state = engine.act(observations, hidden_state)
+                        actions, agent.hidden_state = actions.to(device), next_hidden_state.to(device)
+                    else:
+                        actions, dist = agent.forward(observations.float().to(device))
+                        entropy = dist.entropy()
+                        log_probs = dist.log_prob(actions)
+
+                rollout.add(observations, hidden_state, actions, log_probs if engine is None else None)
+
+                observations, rewards, dones, infos = interactor.step(actions.cpu().numpy())
+
+                # count the number of steps taken (reset if done)
+                step_counters += 1
+                step_counters *= 1 - dones.float()
+
+                # call agent.reset with done flags for hidden state resetting
+                agent.reset(dones)
+
+                scores = get_scores(rewards, interactor.current_episode_cumulative_rewards, step_counters)
+                rollout.add_outcome(scores, dones)
+
+                if rollout.full:
+                    with profiler.scope("agent/update"):
+                        loss = update_from_rollout()
 
-            cumulative_rewards_no_reset += rewards
+            else:
+                optimizer.zero_grad()
 
-            # Update the video storage with the new frame and episode tracking
-            video_storage.update_and_save_frame(observations, dones)
+                with profiler.scope("agent/forward"):
+                    actions, dist = agent.forward(observations.float().to(device))
 
-            episodic_rewards = []
+                assert actions.shape == (NUM_ENVS,)
 
-            for i in range(NUM_ENVS):
-                if dones[i]:
-                    episodic_rewards.append(interactor.current_episode_cumulative_rewards[i].item())
+                entropy = dist.entropy()
+                log_probs = dist.log_prob(actions)
 
-                # TODO: criteria for best episode maybe should be most kills
-                if interactor.current_episode_cumulative_rewards[i].item() > best_episode_cumulative_reward:
-                    best_episode_cumulative_reward = interactor.current_episode_cumulative_rewards[i].item()
-                    best_episode_env = i  # Track which environment achieved the best reward
-                    best_episode = int(video_storage.episode_counters[i].item())  # Track the episode number
+                observations, rewards, dones, infos = interactor.step(actions.cpu().numpy())
 
-            episodic_rewards = torch.tensor(episodic_rewards)
+                # count the number of steps taken (reset if done)
+                step_counters += 1
+                step_counters *= 1 - dones.float()
 
-            # count the number of steps taken (reset if done)
-            step_counters += 1
-            step_counters *= 1 - dones.float()
+                # call agent.reset with done flags for hidden state resetting
+                agent.reset(dones)
 
-            # call agent.reset with done flags for hidden state resetting
-            agent.reset(dones)
+                scores = get_scores(rewards, interactor.current_episode_cumulative_rewards, step_counters)
+                loss = (-log_probs * scores.to(device)).mean()
 
-            logging_cumulative_rewards = interactor.current_episode_cumulative_rewards.clone()
+                with profiler.scope("agent/backward"):
+                    loss.backward()
+                with profiler.scope("agent/optimizer"):
+                    optimizer.step()
 
-            if TRAIN_ON_CUMULATIVE_REWARDS:
-                # cumulative rewards
-                if NORM_WITH_REWARD_COUNTER:
-                    scores = interactor.current_episode_cumulative_rewards / (step_counters + 1)
-                else:
-                    scores = interactor.current_episode_cumulative_rewards
-            else:
-                # instantaneous rewards
-                scores = rewards
-
-            if BATCH_NORM_REWARDS:
-                scores = (scores - scores.mean()) / (scores.std() + 1e-8)
-
-            # specifically symlog after normalizing scores
-            # scores = symlog_torch(scores)
-            loss = (-log_probs * scores.to(device)).mean()
-
-            loss.backward()
-            optimizer.step()
-
-            print(f"------------- {step_i} -------------")
-            print(f"Loss:\t\t{loss.item():.4f}")
-            print(f"Entropy:\t{entropy.mean().item():.4f}")
-            print(f"Log Prob:\t{log_probs.mean().item():.4f}")
-            print(f"Reward:\t\t{rewards.mean().item():.4f}")
-
-            # TODO: fix the highlight reel (supporting sub-clips instead of full episodes and make configurable)
-            # # If we have a new best episode, log the video to wandb
-            # if best_episode_cumulative_reward > MIN_EP_REWARD_SUM and args.use_wandb:
-            #     if best_episode_env is not None and best_episode is not None:
-            #         print(f"New best episode found for environment {best_episode_env}, episode {best_episode}!")
-
-            #         # Extract the video slice for the best episode and environment
-            #         video_slice_tensor = video_storage.get_video_slice(env_i=best_episode_env, episode=best_episode - 1)
-
-            #         # Log the video slice to wandb
-            #         if video_slice_tensor.size(0) > 0:  # Ensure the tensor has frames
-            #             video_np = video_slice_tensor.cpu().numpy()
-
-            #             highlight_path = os.path.join(video_path, "highlights")
-            #             os.makedirs(highlight_path, exist_ok=True)
-            #             highlight_file_path = os.path.join(highlight_path, f"env_{best_episode_env}-ep_{best_episode}.mp4")
-
-            #             height, width = video_np.shape[2], video_np.shape[3]
-            #             out = cv2.VideoWriter(highlight_file_path, cv2.VideoWriter_fourcc(*'mp4v'), 20, (video_storage.frame_width, video_storage.frame_height))
-
-            #             # write each frame (it expects shape to be HWC)
-            #             for frame in video_np:
-            #                 out.write(frame.transpose(1, 2, 0))
-
-            #             out.release()
-
-            #             # TODO: fix wandb video logging
-            #             # wandb_video = wandb.Video(highlight_file_path, format="mp4")
-            #             # wandb.log({
-            #             #     "best_episode_video": wandb_video,
-            #             # }, commit=False)
-
-            #         # Reset the best episode tracking after logging
-            #         best_episode_env = None
-            #         best_episode = None
-
-            # Log wandb metrics
-            if args.use_wandb:
-                for info in infos:
-                    if "deltas" not in info:
-                        continue
-                    deltas = info["deltas"]
-                    num_kills_all_time += deltas.KILLCOUNT
-                    damage_taken_all_time += deltas.DAMAGE_TAKEN
-                    secrets_found_all_time += deltas.SECRETCOUNT
-                    death_count_all_time += deltas.DEATHCOUNT
-
-                data = {
-                    "step": step_i,
-                    "avg_entropy": entropy.mean().item(),
-                    "avg_log_prob": log_probs.mean().item(),
-                    "num_done": dones.sum().item(),
-                    "loss": loss.item(),
-                    "scores/num_kills_all_time": num_kills_all_time,
-                    "scores/damage_taken_all_time": damage_taken_all_time,
-                    "scores/secrets_found_all_time": secrets_found_all_time,
-                    "scores/death_count_all_time": death_count_all_time,
-                    "rewards/best_episodic_reward": best_episode_cumulative_reward,
-                    "rewards/avg_instantaneous_reward": rewards.mean().item(),
-                    "rewards/avg_cumulative_reward": logging_cumulative_rewards.mean().item(),
-                    "rewards/avg_cumulative_reward_no_reset": cumulative_rewards_no_reset.mean().item(),
-                }
-
-                if len(episodic_rewards) > 0:
-                    data["episodic_rewards"] = episodic_rewards.mean()
-
-                wandb.log(data)
+            cumulative_rewards_no_reset += rewards
+
+            # Update the video storage with the new frame and episode tracking
+            # (the newest frame of a stack is in its last channels)
+            newest_frames = observations[:, -NUM_CHANNELS:] if args.frame_stack > 1 else observations
+            with profiler.scope("video"):
+                video_storage.update_and_save_frame(newest_frames, dones)
+                if highlights is not None:
+                    highlights.push(newest_frames, dones)
+
+            episode_rewards = interactor.current_episode_cumulative_rewards
+
+            # TODO: criteria for best episode maybe should be most kills
+            best_env_reward, best_env = episode_rewards.max(dim=0)
+            if best_env_reward.item() > best_episode_cumulative_reward:
+                best_episode_cumulative_reward = best_env_reward.item()
+                best_episode_env = int(best_env)  # Track which environment achieved the best reward
+                best_episode = int(video_storage.episode_counters[best_episode_env])  # Track the episode number
+
+                # the clip is written once this episode is over
+                if highlights is not None and best_episode_cumulative_reward > MIN_EP_REWARD_SUM:
+                    highlights.request(best_episode_env, os.path.join(video_path, "highlights", f"env_{best_episode_env}-ep_{best_episode}.mp4"))
+
+            # all of these stay tensors until the metrics are flushed
+            metrics.mean("loss", loss)
+            metrics.mean("avg_entropy", entropy)
+            metrics.mean("avg_log_prob", log_probs)
+            metrics.total("num_done", dones)
+            metrics.mean("episodic_rewards", episode_rewards[dones])
+            metrics.last("rewards/best_episodic_reward", best_episode_cumulative_reward)
+            metrics.mean("rewards/avg_instantaneous_reward", rewards)
+            metrics.mean("rewards/avg_cumulative_reward", episode_rewards)
+            metrics.mean("rewards/avg_cumulative_reward_no_reset", cumulative_rewards_no_reset)
+
+            if "deltas" in infos:
+                # (NUM_ENVS, F) columnar deltas, one column per game variable
+                delta_totals = infos["deltas"].sum(dim=0)
+                metrics.cumulative("scores/num_kills_all_time", delta_totals[FEATURE_INDEX["KILLCOUNT"]])
+                metrics.cumulative("scores/damage_taken_all_time", delta_totals[FEATURE_INDEX["DAMAGE_TAKEN"]])
+                metrics.cumulative("scores/secrets_found_all_time", delta_totals[FEATURE_INDEX["SECRETCOUNT"]])
+                metrics.cumulative("scores/death_count_all_time", delta_totals[FEATURE_INDEX["DEATHCOUNT"]])
+
+            if step_i == 0:
+                time_to_first_step = time.perf_counter() - STARTUP_TIME
+                print(
+                    f"Time to first step: {time_to_first_step:.2f}s (imports {imports_sec:.2f}s,"
+                    f" interactor {interactor_sec:.2f}s, first reset {reset_sec:.2f}s)"
+                )
+                metrics.last("startup/time_to_first_step_sec", time_to_first_step)
+
+            with profiler.scope("metrics"):
+                metrics.step()
+            profiler.step()
 
     except KeyboardInterrupt as e:
         print("Interrupted by user, finalizing data...")
-        video_storage.close()
-        interactor.env.close()
         raise e
+
+    finally:
+        if args.video_storage == "frames" and args.export_grid_video:
+            video_storage.export_grid_video(os.path.join(video_path, "grid.mp4"), GRID_SIZE)
+        metrics.close()
+        if args.profile_trace is not None:
+            profiler.dump_chrome_trace(args.profile_trace, last_steps=args.profile_trace_steps)
+        video_storage.close()
+        if highlights is not None:
+            highlights.close()
+        interactor.close()
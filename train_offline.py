@@ -0,0 +1,117 @@
+"""Trains the `train_doom.Agent` from a recorded trajectory folder (see `trajectory.py` and
+`train_doom.py --record-trajectories`) instead of live envs.
+
+The recording can be relabeled with a different reward spec, so reward weights and architectures can be
+compared on the same experience at disk speed. The objective is the one of `train_doom.py`: the log prob of
+the recorded actions weighted by their instantaneous rewards.
+"""
+
+import os
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from custom_doom import RewardSpec
+from offline_dataset import TrajectoryDataset, SequenceLoader
+from metrics import MetricsAggregator, StdoutSink, WandbSink, JsonlSink
+from train_doom import Agent, timestamp_name
+
+
+def mini_cli():
+    parser = ArgumentParser()
+    parser.add_argument("trajectories", type=str, help="Folder of a trajectory recording.")
+    parser.add_argument("--reward-spec", type=str, default=None, help="Path to a json reward spec to relabel the recorded rewards with (see custom_doom.RewardSpec).")
+    parser.add_argument("--steps", type=int, default=10_000, help="Number of updates.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Sequences per batch.")
+    parser.add_argument("--seq-len", type=int, default=32, help="Steps per sequence.")
+    parser.add_argument("--burn-in", type=int, default=8, help="Steps that only warm up the hidden state of sequences starting mid-episode.")
+    parser.add_argument("--frame-stack", type=int, default=1, help="Number of past frames the agent sees at once (needs a channel-first recording).")
+    parser.add_argument("--num-workers", type=int, default=2, help="Batch assembling threads.")
+    parser.add_argument("--prefetch", type=int, default=4, help="Batches kept ready ahead of the training loop.")
+    parser.add_argument("--lr", type=float, default=5e-4)
+    parser.add_argument("--checkpoint", type=str, default=None, help="Where to save the agent's state dict at the end.")
+    parser.add_argument("--use-wandb", action="store_true", default=False)
+    parser.add_argument("--log-every", type=int, default=10, help="Updates the metrics are aggregated over before they're printed/logged.")
+    parser.add_argument("--metrics-jsonl", type=str, default=None, help="Also append the metrics to this JSONL file.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = mini_cli()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    dataset = TrajectoryDataset(args.trajectories, reward_spec=RewardSpec.from_json(args.reward_spec) if args.reward_spec else None)
+    print(f"{len(dataset.shards)} shards, {dataset.num_steps} steps of {dataset.num_envs} envs")
+
+    loader = SequenceLoader(
+        dataset, batch_size=args.batch_size, seq_len=args.seq_len, burn_in=args.burn_in,
+        frame_stack=args.frame_stack, num_workers=args.num_workers, prefetch=args.prefetch,
+        pin_memory=device.type == "cuda",
+    )
+
+    agent = Agent(obs_shape=loader.obs_shape, num_discrete_actions=dataset.num_actions)
+    agent = agent.to(device)
+    print(agent.num_params)
+
+    optimizer = torch.optim.Adam(agent.parameters(), lr=args.lr)
+
+    if args.use_wandb:
+        import wandb
+        wandb.init(project=f"doom-rl-offline-{dataset.meta.get('env_id')}", name=timestamp_name(), config={
+            "num_parameters": agent.num_params,
+            "trajectories": args.trajectories,
+            "reward_spec": args.reward_spec,
+            "steps": args.steps,
+            "batch_size": args.batch_size,
+            "seq_len": args.seq_len,
+            "burn_in": args.burn_in,
+            "frame_stack": args.frame_stack,
+            "lr": args.lr,
+            "obs_shape": loader.obs_shape,
+            "agent": agent,
+        })
+        wandb.watch(agent)
+
+    metric_sinks = [StdoutSink()]
+    if args.use_wandb:
+        metric_sinks.append(WandbSink())
+    if args.metrics_jsonl is not None:
+        metric_sinks.append(JsonlSink(args.metrics_jsonl))
+    metrics = MetricsAggregator(metric_sinks, flush_every=args.log_every)
+
+    try:
+        for step_i in range(args.steps):
+            # time spent waiting on the loader, should stay near zero if the prefetching keeps up
+            wait_start = time.perf_counter()
+            batch = next(loader)
+            wait_time = time.perf_counter() - wait_start
+
+            batch = {key: value.to(device, non_blocking=True) for key, value in batch.items()}
+            mask = batch["mask"].float()
+
+            optimizer.zero_grad()
+            dist, _ = agent.forward_sequence(batch["observations"].float(), batch["actions"], batch["resets"])
+            log_probs, entropy = dist.log_prob(batch["actions"]), dist.entropy()
+            loss = (-log_probs * batch["rewards"] * mask).sum() / mask.sum().clamp(min=1)
+            loss.backward()
+            optimizer.step()
+
+            metrics.mean("loss", loss)
+            metrics.mean("avg_entropy", entropy)
+            metrics.mean("avg_log_prob", log_probs)
+            metrics.mean("rewards/avg_instantaneous_reward", batch["rewards"])
+            metrics.mean("loader_wait_ms", wait_time * 1000)
+            metrics.step()
+
+    except KeyboardInterrupt as e:
+        print("Interrupted by user, finalizing data...")
+        raise e
+
+    finally:
+        metrics.close()
+        loader.close()
+        if args.checkpoint is not None:
+            os.makedirs(os.path.dirname(args.checkpoint) or ".", exist_ok=True)
+            torch.save(agent.state_dict(), args.checkpoint)
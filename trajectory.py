@@ -0,0 +1,206 @@
+"""Recorded transitions, so experiments can be re-run from disk instead of re-simulating Doom.
+
+A recording is a folder of fixed size shards, each holding `shard_steps` consecutive vectorized steps
+of every env, time-major:
+
+    <folder>/trajectories.json            num_envs, obs_shape, feature names, env id, number of actions, ...
+    <folder>/shard_000000/meta.json       steps actually in the shard, which fields, frame_delta
+    <folder>/shard_000000/actions.npy     (T, N) int64
+    <folder>/shard_000000/rewards.npy     (T, N) float32
+    <folder>/shard_000000/dones.npy       (T, N) bool
+    <folder>/shard_000000/deltas.npy      (T, N, F) float32, custom reward envs only
+    <folder>/shard_000000/features.npy    (T, N, F) float32, raw game variables, custom reward envs only
+    <folder>/shard_000000/observations.npy  (T, N, *obs_shape) uint8
+        or observations.delta             the same frames delta-encoded and zlib compressed (frame_delta)
+
+Row t is the observation the action was taken on, the action, and what came back for it: the reward,
+whether the episode ended, the deltas and the game variables after the step. The observation of the
+step after a done is the first one of the next episode. Everything but delta-encoded observations can
+be memory-mapped.
+"""
+
+import os
+import json
+import zlib
+import queue
+import threading
+import numpy as np
+
+from custom_doom import FEATURE_NAMES
+
+FIELD_DTYPES = {
+    "observations": np.uint8,
+    "actions": np.int64,
+    "rewards": np.float32,
+    "dones": np.bool_,
+    "deltas": np.float32,
+    "features": np.float32,
+}
+
+
+def encode_frame_deltas(observations: np.ndarray) -> bytes:
+    """(T, ...) uint8 frames -> the first frame followed by the wrapping differences of consecutive
+    frames, zlib compressed. Consecutive screens barely change, so the differences are mostly zeros.
+    """
+
+    deltas = np.empty_like(observations)
+    deltas[0] = observations[0]
+    np.subtract(observations[1:], observations[:-1], out=deltas[1:])  # wraps around in uint8
+    return zlib.compress(deltas.tobytes(), 1)
+
+
+def decode_frame_deltas(data: bytes, shape: tuple) -> np.ndarray:
+    deltas = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(shape)
+    # a running sum in uint8 undoes the wrapping differences exactly
+    return np.cumsum(deltas, axis=0, dtype=np.uint8)
+
+
+def read_recording(folder: str) -> dict:
+    """The trajectories.json of a recording."""
+
+    with open(os.path.join(folder, "trajectories.json")) as f:
+        return json.load(f)
+
+
+def read_shard(path: str, mmap: bool = True) -> dict:
+    """{field: (T, N, ...) array} of a shard, memory-mapped where the format allows it."""
+
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+
+    shard = {}
+    for field in meta["fields"]:
+        if field == "observations" and meta["frame_delta"]:
+            with open(os.path.join(path, "observations.delta"), "rb") as f:
+                shard[field] = decode_frame_deltas(f.read(), (meta["steps"], meta["num_envs"], *meta["obs_shape"]))
+        else:
+            shard[field] = np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r" if mmap else None)
+    return shard
+
+
+def list_shards(folder: str) -> list:
+    """The complete shards of a recording, in order."""
+
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.startswith("shard_"))
+    return [path for path in paths if os.path.exists(os.path.join(path, "meta.json"))]
+
+
+class TrajectoryWriter:
+    """Streams vectorized transitions into shards (see the module docstring).
+
+    Steps are copied into one of `num_buffers` preallocated in-memory shards. A full shard goes to a
+    writer thread (which also does the optional `frame_delta` compression) while the next one fills, so
+    the step loop only waits on the disk if it's slower than filling a whole shard.
+    """
+
+    def __init__(
+        self, folder: str, num_envs: int, obs_shape: tuple, reward_features: bool, shard_steps: int = 1024,
+        frame_delta: bool = False, num_buffers: int = 2, metadata: dict = None,
+    ):
+        """`metadata` (e.g. the env id and the number of actions) is stored in trajectories.json as is."""
+
+        self.folder = folder
+        self.num_envs = num_envs
+        self.obs_shape = tuple(obs_shape)
+        self.shard_steps = shard_steps
+        self.frame_delta = frame_delta
+
+        self.fields = ["observations", "actions", "rewards", "dones"]
+        if reward_features:
+            self.fields += ["deltas", "features"]
+
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "trajectories.json"), "w") as f:
+            json.dump({
+                "num_envs": num_envs, "obs_shape": self.obs_shape, "shard_steps": shard_steps,
+                "fields": self.fields, "feature_names": FEATURE_NAMES if reward_features else [],
+                **(metadata or {}),
+            }, f)
+
+        feature_shape = (len(FEATURE_NAMES),)
+        shapes = {
+            "observations": self.obs_shape, "actions": (), "rewards": (), "dones": (),
+            "deltas": feature_shape, "features": feature_shape,
+        }
+
+        self._free_buffers = queue.Queue()
+        for _ in range(num_buffers):
+            self._free_buffers.put({
+                field: np.zeros((shard_steps, num_envs, *shapes[field]), dtype=FIELD_DTYPES[field]) for field in self.fields
+            })
+        self._full_buffers = queue.Queue()
+        self._buffer = self._free_buffers.get()
+        self._step = 0  # row of the current shard
+        self.num_shards = 0
+
+        self._error = None
+        self._writer = threading.Thread(target=self._write_shards, name="trajectory-writer", daemon=True)
+        self._writer.start()
+
+    def record_observations(self, observations):
+        """The (N, *obs_shape) observations the next step's actions are taken on, call right before stepping."""
+        self._buffer["observations"][self._step] = observations
+
+    def record_step(self, actions, rewards, dones, infos: dict):
+        """What came back for the step, `infos` are the columnar infos of the backend."""
+
+        buffer, row = self._buffer, self._step
+        buffer["actions"][row] = actions
+        buffer["rewards"][row] = rewards
+        buffer["dones"][row] = dones
+        if "deltas" in buffer:
+            buffer["deltas"][row] = infos["deltas"]
+            buffer["features"][row] = infos["features"]
+
+        self._step += 1
+        if self._step == self.shard_steps:
+            self._submit()
+
+    def _submit(self):
+        if self._error is not None:
+            raise RuntimeError("Trajectory writer failed") from self._error
+
+        self._full_buffers.put((self._buffer, self._step, self.num_shards))
+        self.num_shards += 1
+        self._buffer = self._free_buffers.get()
+        self._step = 0
+
+    def _write_shards(self):
+        while True:
+            item = self._full_buffers.get()
+            if item is None:
+                break
+
+            buffer, steps, index = item
+            try:
+                self._write_shard(buffer, steps, os.path.join(self.folder, f"shard_{index:06d}"))
+            except Exception as e:
+                self._error = e
+            self._free_buffers.put(buffer)
+
+    def _write_shard(self, buffer: dict, steps: int, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        for field in self.fields:
+            if field == "observations" and self.frame_delta:
+                with open(os.path.join(path, "observations.delta"), "wb") as f:
+                    f.write(encode_frame_deltas(buffer[field][:steps]))
+            else:
+                np.save(os.path.join(path, f"{field}.npy"), buffer[field][:steps])
+
+        # written last, a shard without it is incomplete
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({
+                "steps": steps, "num_envs": self.num_envs, "obs_shape": self.obs_shape,
+                "fields": self.fields, "frame_delta": self.frame_delta,
+            }, f)
+
+    def close(self):
+        """Writes the last (partial) shard and waits for everything to be on disk."""
+
+        if self._step > 0:
+            self._submit()
+        self._full_buffers.put(None)
+        self._writer.join()
+        if self._error is not None:
+            raise RuntimeError("Trajectory writer failed") from self._error
@@ -1,28 +1,94 @@
 import os
 import cv2
+import glob
+import re
+import threading
+import queue
 import numpy as np
-import csv
 import torch
 
+from video_encoder import BackgroundVideoEncoder, compose_grid
+from profiler import profiler
+
+VIDEO_FPS = 20.0
+
+# one row per contiguous run of frames an (env, episode) has in a chunk, frames [start, stop)
+EPISODE_RANGE_DTYPE = np.dtype([("env", np.int32), ("episode", np.int32), ("start", np.int32), ("stop", np.int32)])
+
+
+class EpisodeIndex:
+    """Maps (env, episode) to the frame ranges it covers in the video chunks, built up incrementally while
+    the frames are written. Every frame holds all envs, so within one chunk an episode is always a single
+    contiguous range, and finding a clip is a dict lookup no matter how many chunks the run has.
+
+    Each finished chunk's ranges are saved next to its video as `episodes_<chunk>.npy` (`EPISODE_RANGE_DTYPE`
+    rows), `load` rebuilds the index from those files.
+    """
+
+    def __init__(self):
+        self.ranges = {}  # (env, episode) -> [(chunk, start, stop), ...] in chunk order
+        self._chunk_rows = []  # ranges of the chunk being written, saved with it
+
+    def add(self, chunk: int, env: int, episode: int, start: int, stop: int):
+        self.ranges.setdefault((env, episode), []).append((chunk, start, stop))
+        self._chunk_rows.append((env, episode, start, stop))
+
+    def lookup(self, env: int, episode: int) -> list:
+        return self.ranges.get((env, episode), [])
+
+    def save_chunk(self, path: str):
+        np.save(path, np.array(self._chunk_rows, dtype=EPISODE_RANGE_DTYPE))
+        self._chunk_rows = []
+
+    @classmethod
+    def load(cls, folder: str) -> "EpisodeIndex":
+        index = cls()
+        chunks = {int(re.search(r"episodes_(\d+)\.npy$", path).group(1)): path for path in glob.glob(os.path.join(folder, "episodes_*.npy"))}
+        for chunk, path in sorted(chunks.items()):
+            for env, episode, start, stop in np.load(path).tolist():
+                index.ranges.setdefault((env, episode), []).append((chunk, start, stop))
+        return index
+
+
 class VideoTensorStorage:
-    def __init__(self, folder: str, max_video_frames, grid_size, frame_height, frame_width, num_envs):
+    def __init__(
+        self, folder: str, max_video_frames, grid_size, frame_height, frame_width, num_envs, num_channels: int = 3, channel_first: bool = False,
+        background: bool = False, queue_size: int = 8, drop_frames: bool = False,
+    ):
+        """With `background` the grid frames are handed to a `BackgroundVideoEncoder` process through a
+        ring of `queue_size` shared memory frames. If the encoder falls behind, `drop_frames` decides
+        between dropping the frame (it's left out of the video and of the episode index, so the two
+        stay aligned) and blocking until a slot frees up.
+        """
         self.max_video_frames = max_video_frames
         self.grid_size = grid_size
         self.frame_height = frame_height
         self.frame_width = frame_width
+        self.num_channels = num_channels  # 3 for RGB observations, 1 for grayscale (written as gray video)
+        self.channel_first = channel_first  # observations are NCHW instead of NHWC
         self.num_envs = num_envs
         self.video_file_count = 0
         self.frame_count = 0
         self.video_writer = None
-        self.episode_tracker = []
-        self.unsaved_episode_tracker = []  # New: Track unsaved episode data
         self.episode_counters = torch.zeros((num_envs,), dtype=torch.int32)
         self.video_paths = []
-        self.csv_paths = []
+
+        # frame of the current chunk where each env's current episode started
+        self.episode_index = EpisodeIndex()
+        self._episode_starts = np.zeros((num_envs,), dtype=np.int64)
 
         self.folder = folder
         os.makedirs(self.folder, exist_ok=True)
 
+        grid_shape = (self.frame_height * self.grid_size, self.frame_width * self.grid_size, self.num_channels)
+        self.encoder = None
+        self.dropped_frames = 0
+        if background:
+            self.encoder = BackgroundVideoEncoder(grid_shape, num_slots=queue_size, block=not drop_frames)
+        else:
+            # composed in place every frame, the tiles without an env just stay black
+            self._grid = np.zeros(grid_shape, dtype=np.uint8)
+
         self.open_video_writer()
 
     def open_video_writer(self):
@@ -30,77 +96,109 @@ class VideoTensorStorage:
         self.video_file_count += 1
         video_path = os.path.join(self.folder, f"frames_{self.video_file_count}.mp4")
         self.video_paths.append(video_path)
+        if self.encoder is not None:
+            self.encoder.open(video_path, VIDEO_FPS)
+            return
+
         fourcc = cv2.VideoWriter_fourcc(*"mp4v")
         self.video_writer = cv2.VideoWriter(
-            video_path, fourcc, 20.0, (self.frame_width * self.grid_size, self.frame_height * self.grid_size)
+            video_path, fourcc, VIDEO_FPS, (self.frame_width * self.grid_size, self.frame_height * self.grid_size)
         )
 
     def close_video_writer(self):
         """Close the current video writer."""
+        if self.encoder is not None:
+            self.encoder.close_video()
         if self.video_writer:
             self.video_writer.release()
             self.video_writer = None
 
-    def save_episode_csv(self):
-        csv_path = os.path.join(self.folder, f"episodes_{self.video_file_count}.csv")
-        self.csv_paths.append(csv_path)
-        with open(csv_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerows(self.episode_tracker)
+    def _close_episode_ranges(self, envs, stop: int):
+        """Ends the current frame range of `envs` at `stop` (exclusive), the next one starts there."""
+
+        for env in envs:
+            start = int(self._episode_starts[env])
+            if stop > start:
+                self.episode_index.add(self.video_file_count, int(env), int(self.episode_counters[env]), start, stop)
+            self._episode_starts[env] = stop
+
+    def save_episode_index(self):
+        """Closes every open episode range at the end of the current chunk and saves the chunk's ranges."""
 
-        # Clear the in-memory tracker since it's now saved
-        self.unsaved_episode_tracker = []
+        self._close_episode_ranges(range(self.num_envs), self.frame_count)
+        self.episode_index.save_chunk(os.path.join(self.folder, f"episodes_{self.video_file_count}.npy"))
+        self._episode_starts[:] = 0
 
     def update_and_save_frame(self, observations, done_flags):
-        # Same logic for updating video frames
         frames = observations.cpu().numpy()
-        grid_frame = np.zeros((self.frame_height * self.grid_size, self.frame_width * self.grid_size, 3), dtype=np.uint8)
+        if self.channel_first:
+            frames = frames.transpose(0, 2, 3, 1)
+        done_envs = np.flatnonzero(np.asarray(done_flags))
 
-        for i in range(self.num_envs):
-            row = i // self.grid_size
-            col = i % self.grid_size
-            grid_frame[row * self.frame_height:(row + 1) * self.frame_height, col * self.frame_width:(col + 1) * self.frame_width] = frames[i]
+        if self.encoder is not None:
+            with profiler.scope("video/encoder_wait"):
+                acquired = self.encoder.acquire()
+            if acquired is None:
+                # the encoder is behind, leave this frame out entirely
+                self.dropped_frames += 1
+                self._close_episode_ranges(done_envs, self.frame_count)
+                self.episode_counters[done_envs] += 1
+                return
 
-        self.video_writer.write(cv2.cvtColor(grid_frame, cv2.COLOR_RGB2BGR))
+            slot, grid_frame = acquired
+            with profiler.scope("video/grid"):
+                compose_grid(frames, grid_frame, self.grid_size)
+            self.encoder.submit(slot)
+        else:
+            with profiler.scope("video/grid"):
+                compose_grid(frames, self._grid, self.grid_size)
+            with profiler.scope("video/encode"):
+                color_conversion = cv2.COLOR_GRAY2BGR if self.num_channels == 1 else cv2.COLOR_RGB2BGR
+                self.video_writer.write(cv2.cvtColor(self._grid, color_conversion))
 
-        self.episode_tracker.append(self.episode_counters.clone().tolist())
-        self.unsaved_episode_tracker.append(self.episode_counters.clone().tolist())  # Also track in-memory unsaved data
-
-        for i, done in enumerate(done_flags):
-            if done:
-                self.episode_counters[i] += 1
+        # this frame is the last one of the episodes that just finished
+        self._close_episode_ranges(done_envs, self.frame_count + 1)
+        self.episode_counters[done_envs] += 1
 
         self.frame_count += 1
         if self.frame_count >= self.max_video_frames:
-            self.close_video_writer()
-            self.save_episode_csv()
-            self.open_video_writer()
-            self.frame_count = 0
-            self.episode_tracker = []
+            self._clip_current_chunk()
 
     def _clip_current_chunk(self):
         """
-        Finalize the current video capture by closing the VideoWriter and saving the episode CSV.
+        Finalize the current video capture by closing the VideoWriter and saving the episode index.
         This will allow you to manually clip the current video and start a new one.
         """
 
-        # Close the current video writer and finalize the CSV for the current segment
+        # Close the current video writer and finalize the index for the current segment
         self.close_video_writer()
-        self.save_episode_csv()
-        
-        # Reset frame count and episode tracker for the next segment
+        self.save_episode_index()
+
+        # Reset frame count for the next segment
         self.frame_count = 0
-        self.episode_tracker = []
-        
+
         # Open a new video writer for the next video segment
         self.open_video_writer()
 
     def get_video_slice(self, env_i: int, episode: int):
-        """Will clip the video before filling the full videos if it's partially through a chunk.
+        """Will clip the video before filling the full videos if the episode has frames in the current chunk.
+        Returns the episode's frames as a (T, 3, H, W) uint8 tensor (BGR, like the decoder hands them out).
         """
 
-        if len(self.unsaved_episode_tracker) > 0:
+        in_current_chunk = any(chunk == self.video_file_count for chunk, _, _ in self.episode_index.lookup(env_i, episode))
+        in_current_chunk |= int(self.episode_counters[env_i]) == episode and self._episode_starts[env_i] < self.frame_count
+        if in_current_chunk:
             self._clip_current_chunk()
+        if self.encoder is not None:
+            # the chunks have to be on disk before they can be read back
+            self.encoder.flush()
+
+        ranges = self.episode_index.lookup(env_i, episode)
+        num_frames = sum(stop - start for _, start, stop in ranges)
+
+        print(f"Found {num_frames} frames for environment {env_i}, episode {episode}")
+        if num_frames == 0:
+            raise ValueError(f"No frames found for environment {env_i}, episode {episode}")
 
         row = env_i // self.grid_size
         col = env_i % self.grid_size
@@ -109,49 +207,123 @@ class VideoTensorStorage:
         y_start = row * self.frame_height
         y_end = y_start + self.frame_height
 
-        episode_frames = []
-
-        # Check the CSV paths for frames associated with the episode
-        for csv_path, video_path in zip(self.csv_paths, self.video_paths):
-            with open(csv_path, newline='') as csvfile:
-                reader = csv.reader(csvfile)
-                for frame_idx, row in enumerate(reader):
-                    if int(row[env_i]) == episode:
-                        episode_frames.append((frame_idx, video_path))
-        
-        # Check unsaved data first
-        for frame_idx, tracker_row in enumerate(self.unsaved_episode_tracker):
-            if int(tracker_row[env_i]) == episode:
-                episode_frames.append((self.frame_count - len(self.unsaved_episode_tracker) + frame_idx, self.video_paths[-1]))
-
-        print(f"Found {len(episode_frames)} frames for environment {env_i}, episode {episode}")
-        if len(episode_frames) == 0:
-            raise ValueError(f"No frames found for environment {env_i}, episode {episode}")
+        video_tensor = torch.zeros((num_frames, 3, self.frame_height, self.frame_width), dtype=torch.uint8)
 
-        video_tensor = torch.zeros((len(episode_frames), 3, self.frame_height, self.frame_width), dtype=torch.uint8)
+        # one seek per chunk, the rest of the range is read sequentially
+        i = 0
+        for chunk, start, stop in ranges:
+            cap = cv2.VideoCapture(self.video_paths[chunk - 1])
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            for _ in range(stop - start):
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                video_tensor[i] = torch.from_numpy(frame[y_start:y_end, x_start:x_end]).permute(2, 0, 1)
+                i += 1
+            cap.release()
 
-        # Create a dictionary to cache cv2.VideoCapture instances for reuse
-        capture_cache = {}
+        return video_tensor[:i]
 
-        for i, (frame_idx, video_path) in enumerate(episode_frames):
-            # Reuse VideoCapture if already opened for the same video_path
-            if video_path not in capture_cache:
-                capture_cache[video_path] = cv2.VideoCapture(video_path)
+    def close(self):
+        """Finalize the storage by closing the video writer and saving the last episode index chunk."""
+        self.close_video_writer()
+        self.save_episode_index()  # Save the index for the last video segment
+        if self.encoder is not None:
+            self.encoder.close()
 
-            cap = capture_cache[video_path]
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            ret, frame = cap.read()
-            if ret:
-                tile = frame[y_start:y_end, x_start:x_end]
-                video_tensor[i] = torch.from_numpy(tile).permute(2, 0, 1)
 
-        # Release all VideoCapture objects
-        for cap in capture_cache.values():
-            cap.release()
+class HighlightRecorder:
+    """Keeps the most recent frames of every env in a preallocated in-memory ring, so the clip of a good
+    episode can be cut straight from memory instead of re-decoding the recorded videos mid-training.
+
+    `request(env, path)` marks the env's current episode; once it ends, its frames (the last `capacity`
+    of them for longer episodes) are copied out of the ring and handed to a background writer thread.
+    If the writer is still busy with `max_queued` clips the new clip is dropped, nothing ever waits on it.
+
+    `max_bytes` is a hard cap on everything this holds: the ring plus every clip that can be queued or
+    being written, so `capacity` is the number of frames per env that fits.
+    """
+
+    def __init__(self, num_envs: int, frame_shape: tuple, max_bytes: int, channel_first: bool = False, max_queued: int = 2, on_written=None):
+        self.num_envs = num_envs
+        self.frame_shape = tuple(frame_shape)
+        self.channel_first = channel_first
+        self.on_written = on_written  # called with the path of every clip written, on the writer thread
+
+        frame_bytes = int(np.prod(frame_shape))
+        self.capacity = max_bytes // ((num_envs + max_queued + 1) * frame_bytes)
+        if self.capacity < 1:
+            raise ValueError(f"max_bytes={max_bytes} doesn't fit a single {frame_shape} frame per env")
+
+        self.frames = np.zeros((num_envs, self.capacity, *self.frame_shape), dtype=np.uint8)
+        self.position = 0  # slot the next frame goes to (all envs are pushed together)
+        self.episode_lengths = np.zeros((num_envs,), dtype=np.int64)
+        self.requests = {}  # env -> path of the clip to write once its episode ends
 
-        return video_tensor
+        self.dropped_clips = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._writer = threading.Thread(target=self._write_clips, name="highlight-writer", daemon=True)
+        self._writer.start()
+
+    def request(self, env: int, path: str):
+        """Writes the clip of `env`'s current episode to `path` once the episode is over (replaces any earlier request)."""
+        self.requests[env] = path
+
+    def push(self, observations, done_flags):
+        """Adds a step of (N, *frame_shape) frames. Like everywhere else, the frame of a done env already
+        belongs to its next episode.
+        """
+
+        dones = np.asarray(done_flags, dtype=bool)
+        for env in np.flatnonzero(dones):
+            path = self.requests.pop(int(env), None)
+            if path is not None:
+                self._snapshot(int(env), path)
+        self.episode_lengths[dones] = 0
+
+        with profiler.scope("video/highlights"):
+            self.frames[:, self.position] = observations.cpu().numpy()
+        self.position = (self.position + 1) % self.capacity
+        self.episode_lengths += 1
+
+    def _snapshot(self, env: int, path: str):
+        length = min(int(self.episode_lengths[env]), self.capacity)
+        if length == 0:
+            return
+        if self._queue.full():
+            self.dropped_clips += 1
+            return
+
+        # oldest first, the ring wraps at most once
+        start = (self.position - length) % self.capacity
+        if start + length <= self.capacity:
+            clip = self.frames[env, start:start + length].copy()
+        else:
+            clip = np.concatenate((self.frames[env, start:], self.frames[env, :self.position]))
+        self._queue.put_nowait((clip, path))
+
+    def _write_clips(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            clip, path = item
+            if self.channel_first:
+                clip = clip.transpose(0, 2, 3, 1)
+            conversion = cv2.COLOR_GRAY2BGR if clip.shape[-1] == 1 else cv2.COLOR_RGB2BGR
+
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), VIDEO_FPS, (clip.shape[2], clip.shape[1]))
+            for frame in clip:
+                writer.write(cv2.cvtColor(frame, conversion))
+            writer.release()
+            clip = item = None
+
+            if self.on_written is not None:
+                self.on_written(path)
 
     def close(self):
-        """Finalize the storage by closing the video writer and saving the last episode CSV."""
-        self.close_video_writer()
-        self.save_episode_csv()  # Save the CSV for the last video segment
+        """Finishes writing the queued clips (unfinished episodes are not written)."""
+        self._queue.put(None)
+        self._writer.join()
@@ -0,0 +1,141 @@
+"""Encodes the training grid videos in a separate process, so the training loop only pays for one
+copy of the frames into shared memory instead of the color conversion and the mp4 encode.
+
+The encoder process is spawned with this module as its entry point (the trainer's script isn't re-run in
+it), so it stays light: numpy, cv2 and the shared memory helpers only.
+"""
+
+import multiprocessing as mp
+import numpy as np
+import cv2
+
+from shared_arrays import create_shared_array, attach_shared_array, lightweight_spawn
+
+
+def compose_grid(frames: np.ndarray, grid: np.ndarray, grid_size: int):
+    """Tiles (N, H, W, C) frames row-major into the preallocated (G * H, G * W, C) `grid`, in place.
+    Viewing the grid as (G, G, H, W, C) turns the tiling into (at most) two block copies. Tiles
+    without an env are never written, so they keep whatever the grid was initialized with.
+    """
+
+    num_frames, height, width, channels = frames.shape
+    tiles = grid.reshape(grid_size, height, grid_size, width, channels).transpose(0, 2, 1, 3, 4)
+
+    full_rows, rest = divmod(num_frames, grid_size)
+    tiles[:full_rows] = frames[:full_rows * grid_size].reshape(full_rows, grid_size, height, width, channels)
+    if rest:
+        tiles[full_rows, :rest] = frames[full_rows * grid_size:]
+
+
+def encoder_loop(remote, parent_remote, slots_spec: tuple, free_slots):
+    """Writes the grid frames of the shared `slots` ring to mp4 files in the order they are queued,
+    releasing `free_slots` once a slot has been encoded.
+    """
+
+    parent_remote.close()
+
+    shm, slots = attach_shared_array(slots_spec)
+    conversion = cv2.COLOR_GRAY2BGR if slots.shape[-1] == 1 else cv2.COLOR_RGB2BGR
+    frame_size = (slots.shape[2], slots.shape[1])
+    writer = None
+
+    try:
+        while True:
+            cmd, arg = remote.recv()
+
+            if cmd == "frame":
+                writer.write(cv2.cvtColor(slots[arg], conversion))
+                free_slots.release()
+            elif cmd == "open":
+                path, fps = arg
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, frame_size)
+            elif cmd == "close":
+                if writer is not None:
+                    writer.release()
+                writer = None
+            elif cmd == "flush":
+                # everything queued before this is on disk
+                remote.send(None)
+            elif cmd == "stop":
+                break
+            else:
+                raise ValueError(f"Unknown command: {cmd}")
+    except (KeyboardInterrupt, EOFError, ConnectionResetError):
+        pass
+    finally:
+        if writer is not None:
+            writer.release()
+        slots = None
+        shm.close()
+        remote.close()
+
+
+class BackgroundVideoEncoder:
+    """Parent side of `encoder_loop`. Frames go through a ring of `num_slots` preallocated grid frames in
+    shared memory, the pipe only carries slot indices. The encoder frees slots in the order they were
+    queued, so the next slot to fill is always the oldest one.
+
+    When all slots are taken (the encoder fell behind), `acquire` either waits for one (`block=True`)
+    or gives up and returns None so the caller can drop the frame (`block=False`).
+    """
+
+    def __init__(self, frame_shape: tuple, num_slots: int = 8, block: bool = True):
+        self.num_slots = num_slots
+        self.block = block
+        self._next_slot = 0
+
+        self._shm, self.slots = create_shared_array((num_slots, *frame_shape), np.uint8)
+
+        ctx = mp.get_context("spawn")
+        self._free_slots = ctx.Semaphore(num_slots)
+        self.remote, work_remote = ctx.Pipe()
+        slots_spec = (self._shm.name, self.slots.shape, self.slots.dtype.str)
+        self.process = ctx.Process(target=encoder_loop, args=(work_remote, self.remote, slots_spec, self._free_slots), daemon=True)
+        with lightweight_spawn():
+            self.process.start()
+        work_remote.close()
+
+        self.closed = False
+
+    def open(self, path: str, fps: float):
+        self.remote.send(("open", (path, fps)))
+
+    def close_video(self):
+        self.remote.send(("close", None))
+
+    def acquire(self) -> tuple:
+        """Returns (slot index, grid frame to fill) or None if the frame should be dropped."""
+
+        if not self._free_slots.acquire(block=self.block):
+            return None
+
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.num_slots
+        return slot, self.slots[slot]
+
+    def submit(self, slot: int):
+        self.remote.send(("frame", slot))
+
+    def flush(self):
+        """Waits until every frame queued so far has been written."""
+
+        self.remote.send(("flush", None))
+        self.remote.recv()
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.remote.send(("stop", None))
+        except (BrokenPipeError, EOFError):
+            pass
+        self.process.join(timeout=30)
+        if self.process.is_alive():
+            self.process.kill()
+        self.remote.close()
+
+        self.slots = None
+        self._shm.close()
+        self._shm.unlink()
+        self.closed = True